@@ -3,16 +3,19 @@ from dotenv import load_dotenv
 import os
 load_dotenv()
 import json 
+import tracing
 from logging_utils import get_logger
 
 logger = get_logger(__name__)
 
 PARTNER_KEY = os.getenv("PARTNER_KEY")
 JWT = os.getenv("JWT")
+ARENA_API_BASE = os.getenv("ARENA_API_BASE", "https://api.starsarena.com").rstrip("/")
 
 
+@tracing.traced("arena.recent_threads")
 def get_latest_post():
-    url = "https://api.starsarena.com/partners/recent-threads?offset=0"
+    url = f"{ARENA_API_BASE}/partners/recent-threads?offset=0"
     headers = {
         "Authorization": f'Bearer {PARTNER_KEY}'
     }
@@ -20,8 +23,9 @@ def get_latest_post():
     return response
 
 
+@tracing.traced("arena.community_search")
 def token_community_search(name_query: str):
-    url = f"https://api.starsarena.com/communities/search?searchString={name_query}"
+    url = f"{ARENA_API_BASE}/communities/search?searchString={name_query}"
     logger.info("token community search | url=%s", url)
     headers = {
         "Authorization": f'Bearer {JWT}'
@@ -31,8 +35,9 @@ def token_community_search(name_query: str):
     return response
 
 
+@tracing.traced("arena.followers")
 def get_followers_by_user_id(user_id: str):
-    url = f'https://api.starsarena.com/follow/followers/list?followersOfUserId={user_id}&searchString=&pageNumber=1&pageSize={50}'
+    url = f'{ARENA_API_BASE}/follow/followers/list?followersOfUserId={user_id}&searchString=&pageNumber=1&pageSize={50}'
     headers = {
         "Authorization": f'Bearer {JWT}'
     }
@@ -3,12 +3,13 @@ import re
 import time
 import json
 from datetime import datetime, timedelta, timezone
-from bs4 import BeautifulSoup
 
-from db import supabase
+from db import repo
 from function import getNotifications, getNested, replyToPost, store_bot_reply, clean_html, _extract_reply_meta, _build_post_url
 from terminalAI import ask
 from logging_utils import get_logger
+from textclean import html_to_text
+import tracing
 
 logger = get_logger(__name__)
 
@@ -30,9 +31,9 @@ def _excerpt(s: str, max_len: int = 280) -> str:
     return s[: max_len - 3] + "..."
 
 def clean_html_to_text(html: str) -> str:
-    txt = BeautifulSoup(html or "", "html.parser").get_text(separator=" ")
-    txt = re.sub(r"\s+", " ", txt).strip()
-    return txt
+    # matches BeautifulSoup(...).get_text(" ") on post HTML, stray "<" and script bodies
+    # included (benchmarks/bench_textclean.py checks it), without parsing a DOM per post
+    return html_to_text(html)
 
 def is_post_within_6_hours(iso_timestamp: str) -> bool:
     post_time = datetime.fromisoformat(iso_timestamp.replace("Z", "+00:00"))
@@ -40,26 +41,22 @@ def is_post_within_6_hours(iso_timestamp: str) -> bool:
 
 def load_seen_notifications():
     try:
-        cutoff = (datetime.utcnow() - timedelta(hours=48)).isoformat()
-        res = (
-            supabase.table("seen_notifications")
-            .select("id")
-            .gte("created_at", cutoff)
-            .order("created_at", desc=True)
-            .limit(1000)
-            .execute()
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=48)
+        res = repo.select("seen_notifications", "id, created_at", order="created_at", desc=True, limit=1000)
+        return set(
+            row["id"] for row in res.data
+            if datetime.fromisoformat(str(row["created_at"]).replace("Z", "+00:00")) >= cutoff
         )
-        return set(row["id"] for row in (res.data or []))
     except Exception as e:
         logger.exception("load_seen_notifications failed")
         return set()
 
 def store_seen_notification(notif_id: str):
     try:
-        supabase.table("seen_notifications").insert({
+        repo.insert("seen_notifications", {
             "id": notif_id,
-            "created_at": datetime.utcnow().isoformat()
-        }).execute()
+            "created_at": datetime.now(timezone.utc).isoformat()
+        })
     except Exception as e:
         logger.exception("store_seen_notification failed")
 
@@ -105,6 +102,7 @@ def safe_html_wrap(s: str) -> str:
 
 # --- Core ---
 
+@tracing.traced("mention")
 def handle_single_mention(notif: dict) -> bool:
     """
     Returns True if processed (and should be marked seen), False to skip.
@@ -116,6 +114,7 @@ def handle_single_mention(notif: dict) -> bool:
         return False
 
     comment_post_id = extract_arena_post_id(link)
+    tracing.annotate(notif_id=notif.get("id"), post_id=comment_post_id)
     if not comment_post_id:
         logger.warning("could not extract comment post_id from link")
         # return True  # mark seen to avoid spinning
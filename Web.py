@@ -2,9 +2,12 @@ import httpx  # already a dep via openai
 from dotenv import load_dotenv
 import os
 load_dotenv()
+import tracing
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
+TAVILY_API_BASE = os.getenv("TAVILY_API_BASE", "https://api.tavily.com").rstrip("/")
 
 
+@tracing.traced("tavily.search")
 def tool_search_web(query: str,
                     max_results: int = 6,
                     search_depth: str = "basic",   # "basic" | "advanced"
@@ -28,7 +31,7 @@ def tool_search_web(query: str,
     if exclude_domains: payload["exclude_domains"] = exclude_domains
 
     try:
-        r = httpx.post("https://api.tavily.com/search", json=payload, timeout=20.0)
+        r = httpx.post(f"{TAVILY_API_BASE}/search", json=payload, timeout=20.0)
         r.raise_for_status()
         data = r.json() or {}
 
@@ -0,0 +1,421 @@
+# ann_index.py
+import os
+import json
+import time
+import fcntl
+import pathlib
+import threading
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Any, List, Optional
+import numpy as np
+from db import repo
+from embedding_quant import Codec
+import metrics
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+# Optional local mirror of the thread embeddings in sa_embeddings (image_id is null),
+# so semantic search and duplicate detection don't need a network round trip.
+#
+# Layout under ANN_DIR (all append-only, like phash_index, so several processes can share it):
+#   vectors.bin   fixed-size rows encoded by embedding_quant.Codec (ANN_CODEC at ANN_DIMS)
+#   rescore.bin   binary codec only: the same rows as int8 (Codec.companion), read for the shortlist
+#   meta.jsonl    one line per row: embedding id, thread id, filters + display fields
+#   ivf.npz       IVF centroids + list assignment of the first n_trained rows
+# Only the process holding ANN_DIR/lock writes; everyone else tails the files.
+# Each codec/dims combination gets its own subdirectory, so switching settings starts a fresh mirror.
+
+# -------------------------
+# Config
+# -------------------------
+ENABLED        = os.getenv("ANN_ENABLED", "0") == "1"
+ANN_DIR        = pathlib.Path(os.getenv("ANN_DIR", "./ann_index"))
+DIM            = int(os.getenv("ANN_DIM", "1536"))               # raw embedding size in sa_embeddings
+DIMS           = int(os.getenv("ANN_DIMS", str(DIM)))           # stored size (Matryoshka truncation)
+CODEC          = os.getenv("ANN_CODEC", "int8")                 # f16 | int8 | binary (+ int8 rescore file)
+RESCORE        = int(os.getenv("ANN_RESCORE", "10"))            # binary: shortlist k*RESCORE by hamming
+MAX_AGE_DAYS   = int(os.getenv("ANN_MAX_AGE_DAYS", "60"))      # rows older than this are not mirrored
+SYNC_BATCH     = int(os.getenv("ANN_SYNC_BATCH", "500"))
+SYNC_SECONDS   = int(os.getenv("ANN_SYNC_SECONDS", "60"))      # background sync interval
+TRAIN_MIN_ROWS = int(os.getenv("ANN_TRAIN_MIN_ROWS", "4096"))  # below this, exact search is fast enough
+NPROBE         = int(os.getenv("ANN_NPROBE", "8"))
+DUP_SIMILARITY = float(os.getenv("ANN_DUP_SIMILARITY", "0.97"))
+_TEXT_CHARS = 300
+
+
+def _parse_vec(v) -> Optional[np.ndarray]:
+    if isinstance(v, str):  # PostgREST returns pgvector as "[0.1,0.2,...]"
+        v = json.loads(v)
+    if v is None or len(v) != DIM:
+        return None
+    a = np.asarray(v, dtype=np.float32)
+    n = float(np.linalg.norm(a))
+    return a / n if n > 0 else None
+
+
+def _ts(iso: Optional[str]) -> float:
+    if not iso:
+        return 0.0
+    return datetime.fromisoformat(iso.replace("Z", "+00:00")).timestamp()
+
+
+def _kmeans(x: np.ndarray, k: int, iters: int = 8, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on normalized rows; returns (k, dims) normalized centroids."""
+    rng = np.random.default_rng(seed)
+    c = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ c.T, axis=1)
+        for j in range(k):
+            members = x[assign == j]
+            if len(members):
+                c[j] = members.sum(axis=0)
+            else:
+                c[j] = x[rng.integers(len(x))]
+        c /= np.maximum(np.linalg.norm(c, axis=1, keepdims=True), 1e-12)
+    return c
+
+
+# -------------------------
+# Index
+# -------------------------
+class AnnIndex:
+    """
+    IVF over a memory-mapped array of quantized rows. Until TRAIN_MIN_ROWS rows exist (or when filters
+    leave few candidates) search is exact; afterwards only the NPROBE nearest lists are scanned.
+    Re-embedded threads append a new row and the old one is masked out.
+    """
+
+    def __init__(self, path: pathlib.Path = ANN_DIR, codec: Optional[Codec] = None):
+        self.codec = codec or Codec(CODEC, DIMS)
+        self._companion = self.codec.companion
+        tag = f"{self.codec.name}-{self.codec.dims}" + (f"+{self._companion.name}" if self._companion else "")
+        self.path = path / tag
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._vec_path = self.path / "vectors.bin"
+        self._rescore_path = self.path / "rescore.bin"
+        self._meta_path = self.path / "meta.jsonl"
+        self._ivf_path = self.path / "ivf.npz"
+        self._lock = threading.Lock()
+        self._row_bytes = self.codec.bytes_per_vector
+
+        self.meta: List[Dict[str, Any]] = []
+        self._alive = np.zeros(0, dtype=bool)
+        self._pos_by_thread: Dict[str, int] = {}
+        self._ts = np.zeros(0, dtype=np.float64)
+        self._mat: Optional[np.ndarray] = None
+        self._rmat: Optional[np.ndarray] = None  # companion rows (binary codec)
+        self._meta_offset = 0
+
+        self._centroids: Optional[np.ndarray] = None
+        self._lists: List[np.ndarray] = []
+        self._assign = np.zeros(0, dtype=np.int32)
+        self._lists_n = 0
+        self._ivf_mtime = 0.0
+
+    def __len__(self) -> int:
+        return len(self.meta)
+
+    @property
+    def watermark(self) -> int:
+        """Highest sa_embeddings.id examined (rows skipped as too old still advance it)."""
+        try:
+            scanned = int((self.path / "scanned_to").read_text() or 0)
+        except (OSError, ValueError):
+            scanned = 0
+        return max(scanned, int(self.meta[-1]["id"]) if self.meta else 0)
+
+    # ---- loading / tailing ----
+    def _refresh_locked(self) -> None:
+        """Pick up rows (and IVF retrains) written by other processes."""
+        try:
+            vec_rows = os.path.getsize(self._vec_path) // self._row_bytes
+            if self._companion:
+                vec_rows = min(vec_rows, os.path.getsize(self._rescore_path) // self._companion.bytes_per_vector)
+        except OSError:
+            vec_rows = 0
+        if vec_rows > len(self.meta):
+            with open(self._meta_path, "rb") as f:
+                f.seek(self._meta_offset)
+                data = f.read()
+            usable = data[: data.rfind(b"\n") + 1]
+            lines = usable.split(b"\n")[:-1]
+            lines = lines[: vec_rows - len(self.meta)]  # never get ahead of the vector file
+            new = [json.loads(line) for line in lines]
+            self._meta_offset += sum(len(line) + 1 for line in lines)
+            start = len(self.meta)
+            if new:
+                self._alive = np.concatenate([self._alive, np.ones(len(new), dtype=bool)])
+            for i, m in enumerate(new):
+                pos = start + i
+                old = self._pos_by_thread.get(m["thread_id"])
+                if old is not None:
+                    self._alive[old] = False
+                self._pos_by_thread[m["thread_id"]] = pos
+                self.meta.append(m)
+            if new:
+                self._ts = np.concatenate([self._ts, np.array([m.get("ts") or 0.0 for m in new])])
+                self._mat = np.memmap(self._vec_path, dtype=self.codec.dtype, mode="r", shape=(len(self.meta),))
+                if self._companion:
+                    self._rmat = np.memmap(self._rescore_path, dtype=self._companion.dtype, mode="r",
+                                           shape=(len(self.meta),))
+
+        try:
+            mtime = os.path.getmtime(self._ivf_path)
+        except OSError:
+            mtime = 0.0
+        if mtime and mtime != self._ivf_mtime:
+            with np.load(self._ivf_path) as z:
+                self._centroids = z["centroids"].astype(np.float32)
+                self._assign = z["assign"].astype(np.int32)
+            self._ivf_mtime = mtime
+            self._lists_n = 0
+        self._assign_tail_locked()
+
+    def _assign_tail_locked(self) -> None:
+        """Assign rows past the trained prefix to their nearest centroid and rebuild the lists."""
+        if self._centroids is None:
+            return
+        if len(self._assign) < len(self.meta):
+            tail = self.codec.decode(self._mat[len(self._assign):])
+            self._assign = np.concatenate([self._assign, np.argmax(tail @ self._centroids.T, axis=1).astype(np.int32)])
+        if self._lists_n == len(self._assign):
+            return
+        self._lists_n = len(self._assign)
+        order = np.argsort(self._assign, kind="stable")
+        bounds = np.searchsorted(self._assign[order], np.arange(len(self._centroids) + 1))
+        self._lists = [order[bounds[j]:bounds[j + 1]] for j in range(len(self._centroids))]
+
+    # ---- writing (lock holder only) ----
+    def _repair_locked(self) -> None:
+        """
+        Cut the files back to the rows the metadata covers. An append writes vectors.bin, then
+        rescore.bin, then meta.jsonl, so a crash part-way leaves vector rows (or half a meta line)
+        with no metadata; appending after them would pair every later vector with the wrong line.
+        Runs right after _refresh_locked, which reads metadata only up to the vector row count.
+        """
+        n = len(self.meta)
+        files = [(self._vec_path, n * self._row_bytes), (self._meta_path, self._meta_offset)]
+        if self._companion:
+            files.append((self._rescore_path, n * self._companion.bytes_per_vector))
+        for path, size in files:
+            try:
+                if os.path.getsize(path) > size:
+                    logger.warning("ann index: dropping torn tail | file=%s | keep_bytes=%s", path.name, size)
+                    metrics.incr("ann.torn_tail")
+                    os.truncate(path, size)
+            except FileNotFoundError:
+                pass
+
+    def _append_locked(self, rows: List[Dict[str, Any]]) -> int:
+        vecs, metas = [], []
+        for r in rows:
+            v = _parse_vec(r.get("embedding"))
+            if v is None:
+                continue
+            vecs.append(v)
+            metas.append(r["meta"])
+        if vecs:
+            mat = np.stack(vecs)
+            with open(self._vec_path, "ab") as f:
+                f.write(self.codec.encode(mat).tobytes())
+            if self._companion:
+                with open(self._rescore_path, "ab") as f:
+                    f.write(self._companion.encode(mat).tobytes())
+            with open(self._meta_path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(m, separators=(",", ":")) + "\n" for m in metas))
+        if rows:
+            (self.path / "scanned_to").write_text(str(rows[-1]["meta"]["id"]))
+        return len(vecs)
+
+    def _train_locked(self) -> None:
+        n = len(self.meta)
+        trained = len(self._assign) if self._centroids is not None else 0
+        if n < TRAIN_MIN_ROWS or (trained and n < 2 * trained):
+            return
+        t0 = time.perf_counter()
+        k = max(16, int(np.sqrt(n)))
+        rng = np.random.default_rng(n)
+        sample = self.codec.decode(self._mat[np.sort(rng.choice(n, size=min(n, 64 * k), replace=False))])
+        sample /= np.maximum(np.linalg.norm(sample, axis=1, keepdims=True), 1e-12)
+        centroids = _kmeans(sample, k)
+        assign = np.empty(n, dtype=np.int32)
+        for s in range(0, n, 8192):
+            assign[s:s + 8192] = np.argmax(self.codec.decode(self._mat[s:s + 8192]) @ centroids.T, axis=1)
+        tmp = self.path / "ivf.tmp.npz"
+        np.savez(tmp, centroids=centroids.astype(np.float16), assign=assign)
+        os.replace(tmp, self._ivf_path)
+        logger.info("ann index trained | rows=%s | lists=%s | seconds=%.2f", n, k, time.perf_counter() - t0)
+
+    def sync(self) -> int:
+        """Mirror new sa_embeddings rows past the local watermark. Returns rows appended (0 if another process syncs)."""
+        with open(self.path / "lock", "a") as lockf:
+            try:
+                fcntl.flock(lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                with self._lock:
+                    self._refresh_locked()
+                return 0
+            try:
+                with self._lock:
+                    self._refresh_locked()
+                    self._repair_locked()
+                added = 0
+                while True:
+                    # DB fetch outside self._lock: searches keep running against the rows we have
+                    rows = _fetch_after(self.watermark, SYNC_BATCH)
+                    if not rows:
+                        break
+                    added += self._append_locked(rows)
+                    with self._lock:
+                        self._refresh_locked()
+                    if len(rows) < SYNC_BATCH:
+                        break
+                with self._lock:
+                    self._train_locked()
+                    self._refresh_locked()
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+        if added:
+            metrics.incr("ann.synced", added)
+            logger.info("ann index synced | added=%s | rows=%s | watermark=%s", added, len(self), self.watermark)
+        return added
+
+    # ---- querying ----
+    def search(self, vec, k: int = 10, start_ts: Optional[float] = None, end_ts: Optional[float] = None,
+               user_id: Optional[str] = None, community_id: Optional[str] = None,
+               exclude_thread: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Top-k rows by cosine similarity: [{**meta, "similarity"}]."""
+        q = _parse_vec(vec)
+        if q is None:
+            return []
+        q = self.codec.prepare(q)
+        t0 = time.perf_counter()
+        with self._lock:
+            self._refresh_locked()
+            n = len(self.meta)
+            if not n:
+                return []
+            alive = self._alive
+
+            def _filter(cand: np.ndarray) -> np.ndarray:
+                keep = alive[cand]
+                if start_ts is not None:
+                    keep &= self._ts[cand] >= start_ts
+                if end_ts is not None:
+                    keep &= self._ts[cand] < end_ts
+                cand = cand[keep]
+                if user_id or community_id or exclude_thread:
+                    cand = np.array([
+                        p for p in cand
+                        if (not user_id or self.meta[p].get("user_id") == user_id)
+                        and (not community_id or self.meta[p].get("community_id") == community_id)
+                        and self.meta[p]["thread_id"] != exclude_thread
+                    ], dtype=np.int64)
+                return cand
+
+            cand = None
+            if self._centroids is not None and self._lists:
+                probe = np.argsort(-(self._centroids @ q))[:NPROBE]
+                cand = _filter(np.concatenate([self._lists[j] for j in probe]))
+                if len(cand) < k:  # selective filters: the probed lists may not hold enough matches
+                    cand = None
+            if cand is None:
+                cand = _filter(np.arange(n))
+            if not len(cand):
+                return []
+
+            cand = np.sort(cand)  # sequential reads from the memmap
+            rmat = self._rmat
+            companion = (lambda pos: rmat[cand[pos]]) if rmat is not None else None
+            top, scores = self.codec.scores(self._mat[cand], q, k, RESCORE, companion)
+            out = [{**self.meta[cand[i]], "similarity": float(sc)} for i, sc in zip(top, scores)]
+        metrics.observe("ann.search", time.perf_counter() - t0)
+        return out
+
+
+def _fetch_after(after_id: int, limit: int) -> List[Dict[str, Any]]:
+    """Thread-embedding rows with id > after_id, shaped as {"embedding", "meta"}; old threads get no embedding."""
+    rows = repo.rpc("ann_embeddings_after", {"p_after": after_id, "p_limit": limit}) or []
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=MAX_AGE_DAYS)).timestamp()
+    out = []
+    for t in rows:
+        ts = _ts(t.get("created_at"))
+        meta = {
+            "id": t["id"],
+            "thread_id": t["thread_id"],
+            "ts": ts,
+            "created_at": t.get("created_at"),
+            "user_id": t.get("user_id"),
+            "community_id": t.get("community_id"),
+            "handle": t.get("handle"),
+            "content_text": (t.get("content_text") or "")[:_TEXT_CHARS],
+            "like_count": t.get("like_count"),
+            "repost_count": t.get("repost_count"),
+        }
+        out.append({"embedding": t.get("embedding") if ts >= cutoff else None, "meta": meta})
+    return out
+
+
+_index: Optional[AnnIndex] = None
+_index_lock = threading.Lock()
+
+
+def _syncer(idx: AnnIndex) -> None:
+    while True:
+        try:
+            idx.sync()
+        except Exception:
+            logger.exception("ann index sync failed")
+        time.sleep(SYNC_SECONDS)
+
+
+def get_index() -> Optional[AnnIndex]:
+    """The shared index, or None when ANN_ENABLED is off. The first call starts the background syncer."""
+    global _index
+    if not ENABLED:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = AnnIndex()
+            with _index._lock:
+                _index._refresh_locked()
+            logger.info("ann index loaded | rows=%s | path=%s", len(_index), _index.path)
+            threading.Thread(target=_syncer, args=(_index,), name="ann-syncer", daemon=True).start()
+        return _index
+
+
+def search(vec, k: int = 10, **filters) -> Optional[List[Dict[str, Any]]]:
+    """
+    Local semantic search, or None if the index is disabled/empty (callers fall back to the DB).
+    Read-only: rows appear as the background syncer (or a `python ann_index.py` process) mirrors them.
+    """
+    idx = get_index()
+    if idx is None or not len(idx):
+        return None
+    return idx.search(vec, k, **filters)
+
+
+def find_duplicate(vec, thread_id: Optional[str] = None, min_similarity: float = DUP_SIMILARITY) -> Optional[Dict[str, Any]]:
+    """Closest already-mirrored post with similarity >= min_similarity (excluding `thread_id` itself)."""
+    hits = search(vec, 1, exclude_thread=thread_id)
+    if hits and hits[0]["similarity"] >= min_similarity:
+        return hits[0]
+    return None
+
+
+def main():
+    idx = AnnIndex()
+    backoff = SYNC_SECONDS
+    while True:
+        try:
+            idx.sync()
+            backoff = SYNC_SECONDS
+        except Exception:
+            logger.exception("ann index sync error")
+            backoff = min(max(backoff * 2, SYNC_SECONDS), 600)
+        time.sleep(backoff)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+# audit_log.py
+import os
+import glob
+import json
+import time
+import uuid
+import atexit
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from db import repo
+import metrics
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+# Write-behind logger for append-only audit tables (bot_replies, image_creations). log() only
+# appends to an in-memory buffer; a background thread inserts in batches when AUDIT_BATCH rows
+# are waiting or every AUDIT_FLUSH_SECONDS. Rows that can't be written (DB error, buffer full,
+# shutdown timeout) go to a local JSONL spill file and are replayed once inserts work again.
+# Only transient (connection-level) failures are spilled: a batch the DB rejects is split in halves
+# until the offending rows are isolated, and those go to a dead-letter file instead, so one bad
+# row can't hold its whole batch in the spill/replay loop forever.
+#
+# Every row gets its id and created_at at log() time, and batches are upserted with
+# ignore_duplicates on id, so replaying a batch that did land is harmless.
+
+# -------------------------
+# Config
+# -------------------------
+WRITE_BEHIND    = os.getenv("AUDIT_WRITE_BEHIND", "1").lower() not in ("0", "false", "no")
+BUFFER_MAX      = int(os.getenv("AUDIT_BUFFER_MAX", "5000"))
+BATCH_SIZE      = int(os.getenv("AUDIT_BATCH", "200"))
+FLUSH_SECONDS   = float(os.getenv("AUDIT_FLUSH_SECONDS", "2"))
+SPILL_DIR       = os.getenv("AUDIT_SPILL_DIR", "./audit_spill")
+REPLAY_SECONDS  = float(os.getenv("AUDIT_REPLAY_SECONDS", "60"))
+SHUTDOWN_SECONDS = float(os.getenv("AUDIT_SHUTDOWN_SECONDS", "5"))
+_SPILL_PATH = os.path.join(SPILL_DIR, "spill.jsonl")
+_DEAD_PATH = os.path.join(SPILL_DIR, "dead.jsonl")
+_ORPHAN_SECONDS = 600  # replay files left behind by a process that died mid-replay
+
+_buf: "deque[Tuple[str, Dict[str, Any]]]" = deque()
+_lock = threading.Lock()
+_spill_lock = threading.Lock()
+_flush_lock = threading.Lock()  # one flusher at a time (thread vs atexit)
+_wake = threading.Event()
+_started = False
+_last_replay = 0.0
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+# -------------------------
+# Spill file
+# -------------------------
+def _spill(items: List[Tuple[str, Dict[str, Any]]], reason: str) -> None:
+    if not items:
+        return
+    try:
+        with _spill_lock:
+            os.makedirs(SPILL_DIR, exist_ok=True)
+            with open(_SPILL_PATH, "a", encoding="utf-8") as f:
+                for table, row in items:
+                    f.write(json.dumps({"table": table, "row": row}, default=str) + "\n")
+        metrics.incr("audit.spilled", len(items))
+        logger.warning("audit rows spilled | rows=%s | reason=%s | path=%s", len(items), reason, _SPILL_PATH)
+    except OSError:
+        metrics.incr("audit.lost", len(items))
+        logger.exception("audit spill failed, rows lost | rows=%s", len(items))
+
+
+def _dead_letter(table: str, rejected: List[Tuple[Dict[str, Any], str]]) -> None:
+    """Rows the DB rejected on their own (constraint/type errors): kept for inspection, never replayed."""
+    try:
+        with _spill_lock:
+            os.makedirs(SPILL_DIR, exist_ok=True)
+            with open(_DEAD_PATH, "a", encoding="utf-8") as f:
+                for row, err in rejected:
+                    f.write(json.dumps({"table": table, "row": row, "error": err}, default=str) + "\n")
+    except OSError:
+        logger.exception("audit dead-letter write failed | rows=%s", len(rejected))
+    metrics.incr("audit.dead_lettered", len(rejected))
+    logger.error("audit rows rejected | table=%s | rows=%s | error=%s | path=%s",
+                 table, len(rejected), rejected[0][1], _DEAD_PATH)
+
+
+def _claim_spill() -> List[str]:
+    """Move the shared spill file aside (atomic rename) and return replay files this process owns."""
+    paths = []
+    with _spill_lock:
+        if os.path.exists(_SPILL_PATH):
+            claimed = os.path.join(SPILL_DIR, f"replay-{os.getpid()}-{int(time.time() * 1000)}.jsonl")
+            try:
+                os.rename(_SPILL_PATH, claimed)
+                paths.append(claimed)
+            except OSError:
+                pass  # another process claimed it first
+    now = time.time()
+    for p in glob.glob(os.path.join(SPILL_DIR, "replay-*.jsonl")):
+        if p in paths:
+            continue
+        try:
+            if now - os.path.getmtime(p) > _ORPHAN_SECONDS:
+                orphan = p + f".{os.getpid()}"
+                os.rename(p, orphan)
+                paths.append(orphan)
+        except OSError:
+            pass
+    return paths
+
+
+def _replay() -> None:
+    global _last_replay
+    _last_replay = time.time()
+    for path in _claim_spill():
+        items = []
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        items.append((rec["table"], rec["row"]))
+                    except (ValueError, KeyError, TypeError):
+                        logger.warning("skipping bad audit spill line | path=%s", path)
+        except OSError:
+            logger.exception("reading audit spill failed | path=%s", path)
+            continue
+        failed = _write(items)
+        _spill(failed, "replay failed")
+        os.remove(path)
+        metrics.incr("audit.replayed", len(items) - len(failed))
+        logger.info("audit spill replayed | rows=%s | failed=%s", len(items), len(failed))
+
+
+# -------------------------
+# Writer
+# -------------------------
+# connection-level failures by class name (psycopg2, httpx, requests, sqlite "database is locked")
+_TRANSIENT_ERRORS = {"OperationalError", "InterfaceError", "ConnectionError", "ConnectError", "TimeoutException",
+                     "ReadTimeout", "ConnectTimeout", "RemoteProtocolError", "PoolTimeout"}
+# SQLSTATE classes: connection, transaction rollback, resources, operator intervention, system
+_TRANSIENT_SQLSTATES = ("08", "40", "53", "57", "58")
+
+
+def _is_transient(e: Exception) -> bool:
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    if any(c.__name__ in _TRANSIENT_ERRORS for c in type(e).__mro__):
+        return True
+    code = getattr(e, "pgcode", None) or getattr(e, "code", None)
+    return isinstance(code, str) and code[:2] in _TRANSIENT_SQLSTATES
+
+
+def _insert(table: str, rows: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Tuple[Dict[str, Any], str]]]:
+    """Upsert rows, halving on rejection to isolate bad ones. Returns (retry_later, [(row, error)] rejected)."""
+    try:
+        repo.upsert(table, rows, on_conflict="id", ignore_duplicates=True)
+        metrics.incr(f"audit.flushed.{table}", len(rows))
+        return [], []
+    except Exception as e:
+        if _is_transient(e):
+            return rows, []
+        if len(rows) == 1:
+            return [], [(rows[0], f"{type(e).__name__}: {e}")]
+    mid = len(rows) // 2
+    retry_a, bad_a = _insert(table, rows[:mid])
+    retry_b, bad_b = _insert(table, rows[mid:])
+    return retry_a + retry_b, bad_a + bad_b
+
+
+def _write(items: List[Tuple[str, Dict[str, Any]]]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Insert items grouped by (table, columns). Returns the items to retry later (transient failures)."""
+    groups: Dict[Tuple[str, Tuple[str, ...]], List[Dict[str, Any]]] = {}
+    for table, row in items:
+        groups.setdefault((table, tuple(sorted(row))), []).append(row)
+    failed = []
+    for (table, _), rows in groups.items():
+        for i in range(0, len(rows), BATCH_SIZE):
+            retry, rejected = _insert(table, rows[i:i + BATCH_SIZE])
+            if retry:
+                logger.warning("audit insert failed, will retry | table=%s | rows=%s", table, len(retry))
+                failed.extend((table, r) for r in retry)
+            if rejected:
+                _dead_letter(table, rejected)
+    return failed
+
+
+def flush() -> int:
+    """Write everything buffered now. Returns rows written."""
+    with _flush_lock:
+        with _lock:
+            items = list(_buf)
+            _buf.clear()
+        if not items:
+            return 0
+        t0 = time.perf_counter()
+        failed = _write(items)
+        metrics.observe("audit.flush", time.perf_counter() - t0)
+        _spill(failed, "insert failed")
+        if not failed and time.time() - _last_replay >= REPLAY_SECONDS:
+            _replay()
+        return len(items) - len(failed)
+
+
+def _flusher() -> None:
+    while True:
+        _wake.wait(FLUSH_SECONDS)
+        _wake.clear()
+        try:
+            if _buf:
+                flush()
+            elif time.time() - _last_replay >= REPLAY_SECONDS and os.path.exists(_SPILL_PATH):
+                with _flush_lock:
+                    _replay()
+        except Exception:
+            logger.exception("audit flusher error")
+
+
+def _shutdown() -> None:
+    # Give the DB a bounded window, then spill whatever is left so nothing is lost on exit.
+    done = threading.Event()
+
+    def _run():
+        try:
+            flush()
+        finally:
+            done.set()
+
+    threading.Thread(target=_run, name="audit-shutdown-flush", daemon=True).start()
+    if not done.wait(SHUTDOWN_SECONDS):
+        with _lock:
+            items = list(_buf)
+            _buf.clear()
+        _spill(items, "shutdown timeout")
+
+
+def start() -> None:
+    global _started
+    with _lock:
+        if _started:
+            return
+        threading.Thread(target=_flusher, name="audit-flusher", daemon=True).start()
+        atexit.register(_shutdown)
+        _started = True
+        logger.info("audit writer started | batch=%s | flush_s=%s | buffer_max=%s", BATCH_SIZE, FLUSH_SECONDS, BUFFER_MAX)
+
+
+# -------------------------
+# Public API
+# -------------------------
+def log(table: str, row: Dict[str, Any]) -> None:
+    """Queue one row for `table`. Never blocks on the database (unless AUDIT_WRITE_BEHIND=0)."""
+    row = dict(row)
+    row.setdefault("id", str(uuid.uuid4()))
+    row.setdefault("created_at", _now_iso())
+    if not WRITE_BEHIND:
+        _spill(_write([(table, row)]), "insert failed")
+        return
+    start()
+    overflow = None
+    with _lock:
+        if len(_buf) >= BUFFER_MAX:
+            overflow = _buf.popleft()
+        _buf.append((table, row))
+        depth = len(_buf)
+    metrics.incr("audit.enqueued")
+    if overflow is not None:
+        _spill([overflow], "buffer full")
+    if depth >= BATCH_SIZE:
+        _wake.set()
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        depth = len(_buf)
+    try:
+        spill_bytes = os.path.getsize(_SPILL_PATH)
+    except OSError:
+        spill_bytes = 0
+    try:
+        dead_bytes = os.path.getsize(_DEAD_PATH)
+    except OSError:
+        dead_bytes = 0
+    return {"buffered": depth, "spill_bytes": spill_bytes, "dead_bytes": dead_bytes}
@@ -0,0 +1,259 @@
+# benchmarks/bench_e2e.py
+"""
+End-to-end load benchmark against benchmarks/mock_services.py (no network, no Supabase).
+
+    python benchmarks/bench_e2e.py                                   # all stages, production-like latencies
+    python benchmarks/bench_e2e.py --stages ask,mention --requests 200 --concurrency 16
+    python benchmarks/bench_e2e.py --time-scale 0 --json out.json    # our code only, mocks answer instantly
+    python benchmarks/bench_e2e.py --errors "gemini=0.1,openai=0.02"  # exercise retry / fallback paths
+    python benchmarks/bench_e2e.py --stages mention --trace spans.jsonl && python tracing.py spans.jsonl
+
+Stages (each runs --requests calls from --concurrency threads):
+    cron     cron.run_once(): recent-threads poll -> dedupe -> ingest (embeddings, rollups)
+    mention  ArenaBot.handle_single_mention(): getNested -> ask() -> reply -> audit log
+    ask      terminalAI.ask() on its own, with the mention's thread as the event
+    image    image_jobs.enqueue() x N, timed from enqueue to the reply carrying the image
+
+The mock server starts in-process and the app runs on DB_BACKEND=sqlite (a file in the scratch
+dir unless --sqlite is given), so results compare across machines only roughly; compare runs on
+one box. Image jobs queued by the mention/ask stages are drained before the next stage starts.
+
+The app swallows most DB failures (audit spill, tool fallbacks), so a stage can look healthy
+while timing error paths: the db_err column counts exceptions raised by `repo` during the stage.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_services  # noqa: E402
+
+STAGES = ("cron", "mention", "ask", "image")
+
+
+def configure_env(server: "mock_services.MockServer", args) -> None:
+    """Point every client at the mock and keep all local state in a scratch dir. Must run before app imports."""
+    scratch = tempfile.mkdtemp(prefix="bench_e2e_")
+    os.environ.update(server.env())
+    os.environ.update({
+        "DB_BACKEND": "sqlite",
+        "SQLITE_PATH": args.sqlite or os.path.join(scratch, "store.sqlite3"),
+        "IMG_WORKERS": str(args.img_workers),
+        "ANN_ENABLED": "0",
+        "IMG_ARCHIVE": "0",
+        "AUDIT_SPILL_DIR": os.path.join(scratch, "audit_spill"),
+        "REF_IMG_CACHE_DIR": os.path.join(scratch, "ref_image_cache"),
+        "AI_IMG_DIR": os.path.join(scratch, "generated_images"),
+    })
+    for key in ("JWT", "PARTNER_KEY", "OPEN_AI_KEY", "OPENAI_API_KEY", "GENAI_API_KEY", "TAVILY_API_KEY"):
+        os.environ[key] = "mock"
+    # real limits would throttle the mock, not measure us
+    os.environ.setdefault("GENAI_RPM", "0")
+    if args.trace:
+        os.environ.update({"TRACE_EXPORT": "jsonl", "TRACE_FILE": args.trace})
+
+
+def run_stage(name: str, fn: Callable[[int], Any], n: int, concurrency: int) -> Dict[str, Any]:
+    lat: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i: int) -> None:
+        nonlocal errors
+        t0 = time.perf_counter()
+        ok = True
+        try:
+            ok = fn(i) is not False
+        except Exception as e:
+            ok = False
+            print(f"  {name}[{i}] failed: {type(e).__name__}: {e}", file=sys.stderr)
+        dt = time.perf_counter() - t0
+        with lock:
+            lat.append(dt)
+            errors += 0 if ok else 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"bench-{name}") as pool:
+        list(pool.map(one, range(n)))
+    return _report(name, lat, errors, time.perf_counter() - t0, concurrency)
+
+
+def _report(name: str, lat: List[float], errors: int, wall: float, concurrency: int) -> Dict[str, Any]:
+    a = np.asarray(lat) * 1000.0 if lat else np.zeros(1)
+    return {
+        "stage": name,
+        "requests": len(lat),
+        "errors": errors,
+        "concurrency": concurrency,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(lat) / wall, 2) if wall > 0 else 0.0,
+        "p50_ms": round(float(np.percentile(a, 50)), 1),
+        "p95_ms": round(float(np.percentile(a, 95)), 1),
+        "p99_ms": round(float(np.percentile(a, 99)), 1),
+        "max_ms": round(float(a.max()), 1),
+    }
+
+
+class RepoErrorCounter:
+    """Counts exceptions raised by db.repo, per stage (they're mostly swallowed by the callers)."""
+
+    def __init__(self, repo):
+        self.stage = "setup"
+        self.counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        for name in ("select", "insert", "upsert", "rpc"):
+            setattr(repo, name, self._counted(getattr(repo, name)))
+        scan = repo.scan
+
+        def counted_scan(*a, **kw):
+            try:
+                yield from scan(*a, **kw)
+            except Exception:
+                self._hit()
+                raise
+        repo.scan = counted_scan
+
+    def _hit(self) -> None:
+        with self._lock:
+            self.counts[self.stage] = self.counts.get(self.stage, 0) + 1
+
+    def _counted(self, fn):
+        def wrapped(*a, **kw):
+            try:
+                return fn(*a, **kw)
+            except Exception:
+                self._hit()
+                raise
+        return wrapped
+
+    def take(self, stage: str) -> int:
+        with self._lock:
+            return self.counts.pop(stage, 0)
+
+
+class ImageTracker:
+    """Wraps image_jobs.replyToPost to time each job from enqueue to its reply."""
+
+    def __init__(self, image_jobs):
+        self._jobs = image_jobs
+        self._reply = image_jobs.replyToPost
+        self._started: Dict[str, float] = {}
+        self.done: Dict[str, float] = {}
+        self.failed = 0
+        self._lock = threading.Lock()
+        image_jobs.replyToPost = self._wrapped
+
+    def _wrapped(self, postID, userID, content, imageURL=None):
+        resp = self._reply(postID, userID, content, imageURL=imageURL)
+        with self._lock:
+            t0 = self._started.pop(postID, None)
+            if t0 is not None:
+                self.done[postID] = time.perf_counter() - t0
+                self.failed += 0 if imageURL else 1
+        return resp
+
+    def enqueue(self, post_id: str, user_id: str, prompt: str) -> None:
+        with self._lock:
+            self._started[post_id] = time.perf_counter()
+        self._jobs.enqueue(prompt, post_id, user_id, "Forged.", [])
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--stages", default=",".join(STAGES))
+    ap.add_argument("--requests", type=int, default=50, help="calls per stage")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--img-workers", type=int, default=3)
+    ap.add_argument("--warmup", type=int, default=2, help="untimed calls per stage first")
+    ap.add_argument("--sqlite", help="SQLite file to use (default: a throwaway one in the scratch dir)")
+    ap.add_argument("--json", help="write the full report here")
+    ap.add_argument("--trace", help="also write tracing spans to this JSONL (view with: python tracing.py FILE)")
+    mock_services.add_args(ap)
+    args = ap.parse_args()
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        ap.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    server = mock_services.MockServer(mock_services.world_from_args(args)).start()
+    world = server.world
+    configure_env(server, args)
+
+    # app imports only after the environment points at the mock; db first, so every module's
+    # `from db import repo` gets the counted instance
+    import db
+    repo_errors = RepoErrorCounter(db.repo)
+    import metrics
+    import cron
+    import ArenaBot
+    import image_jobs
+    from terminalAI import ask
+
+    tracker = ImageTracker(image_jobs)
+
+    def do_cron(i):
+        return cron.run_once() >= 0
+
+    def do_mention(i):
+        return ArenaBot.handle_single_mention(world.notification(i))
+
+    def do_ask(i):
+        thread = world.thread(mock_services.mock_id("ask", i))
+        question = thread["content"].replace("<p>", "").replace("</p>", "")
+        return ask(question, event=thread) is not None
+
+    calls = {"cron": do_cron, "mention": do_mention, "ask": do_ask}
+    results = []
+    for name in stages:
+        repo_errors.stage = name
+        if name == "image":
+            wall0 = time.perf_counter()
+            for i in range(args.requests):
+                tracker.enqueue(mock_services.mock_id("image", i), mock_services.mock_id("user", i % 200),
+                                mock_services.PROMPTS["image"])
+            image_jobs.join_queue()
+            lat = [tracker.done.pop(mock_services.mock_id("image", i), None) for i in range(args.requests)]
+            errors = tracker.failed + sum(1 for x in lat if x is None)  # None: job never replied
+            results.append(_report("image", [x for x in lat if x is not None], errors,
+                                   time.perf_counter() - wall0, args.img_workers))
+            tracker.failed = 0
+        else:
+            for i in range(args.warmup):
+                try:
+                    calls[name](-1 - i)
+                except Exception:
+                    pass
+            results.append(run_stage(name, calls[name], args.requests, args.concurrency))
+            image_jobs.join_queue()  # don't let this stage's image jobs bleed into the next
+        r = results[-1]
+        r["repo_errors"] = repo_errors.take(name)
+        print(f"{r['stage']:<8} n={r['requests']:<5} err={r['errors']:<4} db_err={r['repo_errors']:<4} "
+              f"rps={r['throughput_rps']:<8} "
+              f"p50={r['p50_ms']:>8.1f}ms  p95={r['p95_ms']:>8.1f}ms  p99={r['p99_ms']:>8.1f}ms  max={r['max_ms']:>8.1f}ms")
+
+    snap = metrics.snapshot()
+    print("\ninternal timings (metrics.snapshot, seconds):")
+    for k in sorted(snap["timings"]):
+        s = snap["timings"][k]
+        print(f"  {k:<40} n={s['count']:<6} p50={s['p50']:.4f}  p95={s['p95']:.4f}  p99={s['p99']:.4f}")
+    print("\nmock calls:", json.dumps(world.counts, sort_keys=True))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "stages": results, "metrics": snap, "mock_calls": world.counts}, f, indent=2)
+    if args.trace:
+        import tracing
+        tracing.flush()
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
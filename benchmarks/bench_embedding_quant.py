@@ -0,0 +1,94 @@
+# benchmarks/bench_embedding_quant.py
+"""
+Recall / latency / memory of embedding_quant codecs at several truncation sizes.
+
+    python benchmarks/bench_embedding_quant.py                      # synthetic vectors
+    python benchmarks/bench_embedding_quant.py --npy emb.npy        # (n, 1536) float array
+    python benchmarks/bench_embedding_quant.py --from-db 20000      # pull thread embeddings from sa_embeddings
+
+Ground truth is exact float32 cosine at full dimensionality, so the recall column shows the
+combined cost of truncation + quantization. Search here is brute force (no IVF), to isolate the codec.
+"binary" re-scores its hamming shortlist with the int8 companion codes (B/vec and MB count the bits
+only, the part scanned per query; the companion adds one int8 row per vector on disk); "bin-sign"
+re-scores with the signs alone, for comparison.
+Synthetic data only approximates real embeddings (decaying per-dim variance); prefer --from-db.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from embedding_quant import Codec, CODECS  # noqa: E402
+
+
+def synthetic(n: int, d: int = 1536, clusters: int = 200, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    spectrum = (1.0 + np.arange(d)) ** -0.5  # earlier dims carry more variance, Matryoshka-like
+    centers = rng.normal(size=(clusters, d)) * spectrum
+    x = centers[rng.integers(clusters, size=n)] + 0.6 * rng.normal(size=(n, d)) * spectrum
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+
+def from_db(n: int) -> np.ndarray:
+    from db import repo
+    out, after = [], 0
+    while len(out) < n:
+        rows = repo.rpc("ann_embeddings_after", {"p_after": after, "p_limit": min(1000, n - len(out))}) or []
+        if not rows:
+            break
+        for r in rows:
+            v = r["embedding"]
+            out.append(json.loads(v) if isinstance(v, str) else v)
+        after = rows[-1]["id"]
+    x = np.asarray(out, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=50000)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--dims", default="1536,1024,512,256")
+    ap.add_argument("--rescore", type=int, default=10)
+    ap.add_argument("--npy")
+    ap.add_argument("--from-db", type=int, default=0)
+    args = ap.parse_args()
+
+    if args.npy:
+        x = np.load(args.npy).astype(np.float32)
+        x /= np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+    elif args.from_db:
+        x = from_db(args.from_db)
+    else:
+        x = synthetic(args.n)
+    rng = np.random.default_rng(1)
+    qi = rng.choice(len(x), size=min(args.queries, len(x)), replace=False)
+    queries = x[qi] + 0.05 * rng.normal(size=(len(qi), x.shape[1])).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    truth = [set(np.argpartition(-(x @ q), args.k)[: args.k]) for q in queries]
+
+    print(f"n={len(x)} dim={x.shape[1]} queries={len(queries)} k={args.k}")
+    print(f"{'dims':>5} {'codec':>7} {'B/vec':>6} {'MB':>8} {'recall':>7} {'ms/q':>7}")
+    print(f"{x.shape[1]:>5} {'f32':>7} {x.shape[1] * 4:>6} {x.nbytes / 2**20:>8.1f} {1.0:>7.3f} {'-':>7}")
+    for dims in [int(d) for d in args.dims.split(",") if int(d) <= x.shape[1]]:
+        for name in CODECS + ("bin-sign",):
+            codec = Codec("binary" if name == "bin-sign" else name, dims)
+            codes = codec.encode(x)
+            companion = codec.companion.encode(x) if codec.companion and name != "bin-sign" else None
+            hits, t = 0, 0.0
+            for q, tr in zip(queries, truth):
+                t0 = time.perf_counter()
+                top, _ = codec.scores(codes, q, args.k, args.rescore, companion)
+                t += time.perf_counter() - t0
+                hits += len(tr & set(top.tolist()))
+            recall = hits / (len(queries) * args.k)
+            print(f"{dims:>5} {name:>7} {codec.bytes_per_vector:>6} {codes.nbytes / 2**20:>8.1f} "
+                  f"{recall:>7.3f} {t / len(queries) * 1000:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+# benchmarks/bench_textclean.py
+"""
+Speed and output parity of textclean.html_to_text against the per-module cleaners it replaced.
+
+    python benchmarks/bench_textclean.py                         # synthetic Arena-style posts
+    python benchmarks/bench_textclean.py --corpus posts.jsonl    # {"content": "<p>..</p>"} per line
+    python benchmarks/bench_textclean.py --from-db 20000         # sa_threads.content_html
+    python benchmarks/bench_textclean.py --dump-corpus c.jsonl   # write the synthetic corpus and exit
+
+Each legacy cleaner below is a verbatim copy of the code as it was before textclean; every pair
+is checked for identical output on the whole corpus first (exit status 1 on any mismatch), then
+timed. The old regex cleaners were wrong on posts with a "<" that isn't a tag (they ate text up
+to the next ">") or with script/style bodies (kept); on such posts (EDGE_CASES are always added)
+only the bs4 baseline is held to parity, and the regex cleaners' differences count as intended. "per post" runs all five, which is what a post costs on the ingest + mention paths.
+bs4 is only needed for the ArenaBot baseline; without it that row is skipped.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+from html import unescape
+from typing import Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from textclean import html_to_text  # noqa: E402
+
+try:
+    import warnings
+    from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
+    warnings.filterwarnings("ignore", category=MarkupResemblesLocatorWarning)  # plain-text posts
+except ImportError:
+    BeautifulSoup = None
+
+
+# -------------------------
+# Legacy implementations
+# -------------------------
+_LEGACY_TAG_RE = re.compile(r"<[^>]+>")
+
+
+def legacy_strip_html_to_text(html):  # ingest.py
+    if not html:
+        return ""
+    txt = _LEGACY_TAG_RE.sub("", html)
+    return unescape(txt).strip()
+
+
+def legacy_clean_html(raw_html):  # function.py
+    if raw_html is None:
+        return ""
+    clean_text = re.sub(r'<[^>]+>', '', raw_html)
+    clean_text = re.sub(r'\s+', ' ', clean_text).strip()
+    return clean_text
+
+
+def legacy_clean_text(s):  # function.py / terminalAI.py
+    s = re.sub(r"<[^>]+>", " ", s or "")
+    s = re.sub(r"https?://\S+", "", s)
+    s = re.sub(r"\s+", " ", s)
+    return s.strip()
+
+
+def legacy_clean_html_to_text(html):  # ArenaBot.py
+    txt = BeautifulSoup(html or "", "html.parser").get_text(separator=" ")
+    txt = re.sub(r"\s+", " ", txt).strip()
+    return txt
+
+
+def legacy_event_text(text):  # terminalAI.format_event_for_prompt
+    text = unescape(text)
+    text_plain = re.sub(r"<[^>]+>", " ", text)
+    text_plain = re.sub(r"\s+", " ", text_plain).strip()
+    return text_plain
+
+
+# name -> (legacy, replacement), replacement exactly as the call site now invokes it
+PAIRS: Dict[str, Tuple[Callable[[str], str], Callable[[str], str]]] = {
+    "ingest.strip_html_to_text": (legacy_strip_html_to_text, lambda h: html_to_text(h, sep="", collapse=False)),
+    "function.clean_html": (legacy_clean_html, lambda h: html_to_text(h, sep="", unescape=False)),
+    "function.clean_text": (legacy_clean_text, lambda h: html_to_text(h, unescape=False, drop_urls=True)),
+    "ArenaBot.clean_html_to_text": (legacy_clean_html_to_text, lambda h: html_to_text(h)),
+    "terminalAI.format_event_for_prompt": (legacy_event_text, lambda h: html_to_text(unescape(h), unescape=False)),
+}
+
+
+# -------------------------
+# Corpus
+# -------------------------
+_WORDS = ("gm frens", "wagmi", "this is the way", "AVAX to the moon", "ngl", "who's buying", "rekt", "ser",
+          "few understand", "stake your keys", "arena is cooking", "lfg", "touch grass", "bullish", "gn")
+_EMOJI = ("🔥", "🚀", "⚔️", "😂", "🫡", "💎", "👀", "🏛️")
+_ENTITIES = ("&amp;", "&#39;", "&quot;", "&nbsp;", "&gt;", "&lt;3", "AT&amp;T", "&#x1F525;", "&hellip;")
+
+
+# Stray "<" that isn't a tag, and script/style bodies. BeautifulSoup keeps the first as text and
+# drops the second, as html_to_text now does.
+EDGE_CASES = [
+    "I <3 you, see you <p>soon</p>",
+    "1 < 2 and 3 > 2",
+    "<p>a <3 b</p>",
+    "x <b y",
+    "<p>before</p><script>var x = 1 < 2;</script><p>after</p>",
+    "<style>p { color: red }</style><p>styled</p>",
+    "a<!-- note -->b",
+]
+
+
+def _mention(rng: random.Random) -> str:
+    h = f"user{rng.randrange(5000)}"
+    return f'<a href="https://arena.social/{h}" target="_blank" rel="noopener noreferrer">@{h}</a>'
+
+
+def _sentence(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 8)):
+        r = rng.random()
+        if r < 0.55:
+            parts.append(rng.choice(_WORDS))
+        elif r < 0.65:
+            parts.append(rng.choice(_EMOJI))
+        elif r < 0.75:
+            parts.append(rng.choice(_ENTITIES))
+        elif r < 0.85:
+            parts.append(_mention(rng))
+        elif r < 0.92:
+            url = f"https://x.com/u{rng.randrange(999)}/status/{rng.randrange(10 ** 18)}"
+            parts.append(url if rng.random() < 0.5 else f'<a href="{url}" target="_blank">{url}</a>')
+        else:
+            tag = rng.choice(("strong", "em", "u", "s", "code"))
+            parts.append(f"<{tag}>{rng.choice(_WORDS)}</{tag}>")
+    return " ".join(parts)
+
+
+def synthetic(n: int, seed: int = 0) -> List[str]:
+    """Arena post HTML: <p> paragraphs, <br>, mention links, bare/linked URLs, entities, emoji."""
+    rng = random.Random(seed)
+    out = []
+    for _ in range(n):
+        paras = []
+        for _ in range(rng.choice((1, 1, 1, 2, 3, 6))):
+            p = _sentence(rng)
+            if rng.random() < 0.2:
+                p += "<br>" + _sentence(rng)
+            if rng.random() < 0.1:
+                p += "\n" + _sentence(rng)
+            paras.append(f"<p>{p}</p>" if rng.random() < 0.9 else p)
+        if rng.random() < 0.05:
+            paras.append("<p></p>")
+        if rng.random() < 0.03:
+            paras = [rng.choice(_WORDS)]  # plain text, no markup at all
+        out.append("".join(paras))
+    return out
+
+
+def from_db(n: int) -> List[str]:
+    from db import repo
+    out = []
+    for row in repo.scan("sa_threads", "id, content_html"):
+        if row.get("content_html"):
+            out.append(row["content_html"])
+        if len(out) >= n:
+            break
+    return out
+
+
+def from_file(path: str) -> List[str]:
+    out = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            out.append(rec.get("content") or rec.get("content_html") or "")
+    return out
+
+
+# -------------------------
+# Bench
+# -------------------------
+_STRAY_LT_RE = re.compile(r"<(?![A-Za-z/!])|<(?:script|style)\b", re.I)
+
+
+def _legacy_regex_wrong(html: str) -> bool:
+    """True when the old `<[^>]+>` cleaners mangle this post (checked after unescape, as the
+    prompt formatter unescapes "&lt;3" before stripping tags)."""
+    return bool(_STRAY_LT_RE.search(html) or _STRAY_LT_RE.search(unescape(html)))
+
+
+def check(corpus: List[str], names: List[str]) -> int:
+    bad = intended = 0
+    for name in names:
+        legacy, new = PAIRS[name]
+        for html in corpus:
+            a, b = legacy(html), new(html)
+            if a != b and name != "ArenaBot.clean_html_to_text" and _legacy_regex_wrong(html):
+                intended += 1
+                if html in EDGE_CASES:
+                    print(f"intended {name}\n  in:  {html!r}\n  old: {a!r}\n  new: {b!r}")
+            elif a != b:
+                bad += 1
+                if bad <= 5:
+                    print(f"MISMATCH {name}\n  in:  {html[:200]!r}\n  old: {a[:200]!r}\n  new: {b[:200]!r}")
+    if intended:
+        print(f"{intended} intended differences from the regex cleaners (stray '<' / script bodies)")
+    return bad
+
+
+def timeit(fn: Callable[[str], str], corpus: List[str], repeat: int) -> float:
+    """Best-of-`repeat` seconds for one pass over the corpus."""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for html in corpus:
+            fn(html)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=5000)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--corpus")
+    ap.add_argument("--from-db", type=int, default=0)
+    ap.add_argument("--dump-corpus")
+    ap.add_argument("--json", help="write results here")
+    args = ap.parse_args()
+
+    if args.corpus:
+        corpus = from_file(args.corpus)
+    elif args.from_db:
+        corpus = from_db(args.from_db)
+    else:
+        corpus = synthetic(args.n, args.seed)
+    corpus += EDGE_CASES
+    if args.dump_corpus:
+        with open(args.dump_corpus, "w", encoding="utf-8") as f:
+            for html in corpus:
+                f.write(json.dumps({"content": html}, ensure_ascii=False) + "\n")
+        print(f"wrote {len(corpus)} posts to {args.dump_corpus}")
+        return
+
+    names = [n for n in PAIRS if BeautifulSoup is not None or n != "ArenaBot.clean_html_to_text"]
+    if len(names) < len(PAIRS):
+        print("bs4 not installed: skipping ArenaBot.clean_html_to_text baseline")
+    mb = sum(len(h.encode()) for h in corpus) / 1e6
+    print(f"corpus: {len(corpus)} posts, {mb:.2f} MB")
+
+    bad = check(corpus, names)
+    print(f"parity: {'OK' if not bad else f'{bad} mismatches'}\n")
+
+    rows = []
+    print(f"{'cleaner':<36} {'old us/post':>12} {'new us/post':>12} {'speedup':>8}")
+    for name in names + ["per post (all five)"]:
+        if name in PAIRS:
+            legacy, new = PAIRS[name]
+        else:
+            legacy = lambda h: [PAIRS[k][0](h) for k in names]  # noqa: E731
+            new = lambda h: [PAIRS[k][1](h) for k in names]  # noqa: E731
+        old_s, new_s = timeit(legacy, corpus, args.repeat), timeit(new, corpus, args.repeat)
+        row = {"cleaner": name, "old_us": old_s / len(corpus) * 1e6, "new_us": new_s / len(corpus) * 1e6,
+               "speedup": old_s / new_s if new_s else 0.0, "new_mb_s": mb / new_s if new_s else 0.0}
+        rows.append(row)
+        print(f"{name:<36} {row['old_us']:>12.2f} {row['new_us']:>12.2f} {row['speedup']:>7.1f}x")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"posts": len(corpus), "mb": mb, "mismatches": bad, "results": rows}, f, indent=2)
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == "__main__":
+    main()
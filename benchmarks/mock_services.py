@@ -0,0 +1,494 @@
+# benchmarks/mock_services.py
+"""
+Local stand-ins for every external service the bot talks to, so load tests measure our code.
+
+    python benchmarks/mock_services.py --port 8799
+    python benchmarks/mock_services.py --latency "openai=900:0.5,gemini=8000:0.3" --errors "gemini=0.1"
+
+One HTTP server, one path prefix per service:
+
+    /arena/...                StarsArena API        ARENA_API_BASE=http://host:port/arena
+    /storage/                 upload bucket         ARENA_UPLOAD_URL=http://host:port/storage/
+    /static/...               static image host     ARENA_STATIC_BASE=http://host:port/static
+    /openai/v1/...            chat + embeddings     OPENAI_BASE_URL=http://host:port/openai/v1
+    /gemini/v1beta/...        image generation      GENAI_BASE_URL=http://host:port/gemini
+    /tavily/search            web search            TAVILY_API_BASE=http://host:port/tavily
+
+`env()` returns exactly those variables for a running server. Each service gets a lognormal
+latency (median ms : sigma) and an error rate; errors are the status codes the real service
+sends under load (502 Arena, 429 OpenAI, 503 Gemini...), so client retry paths run too.
+Everything is deterministic per id (same thread id -> same thread), stdlib only.
+"""
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import zlib
+import base64
+import random
+import struct
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+SERVICES = ("arena", "storage", "static", "openai", "gemini", "tavily")
+
+# median ms, sigma: rough production numbers (Gemini image gen dominates everything)
+DEFAULT_LATENCY = {
+    "arena": (120.0, 0.5),
+    "storage": (250.0, 0.5),
+    "static": (40.0, 0.4),
+    "openai": (1200.0, 0.6),
+    "gemini": (9000.0, 0.4),
+    "tavily": (700.0, 0.5),
+}
+_ERROR_STATUS = {"arena": 502, "storage": 503, "static": 503, "openai": 429, "gemini": 503, "tavily": 502}
+
+_NS = uuid.UUID("5b1f7e1e-0000-4000-8000-6d6f636b6172")  # uuid5 namespace for synthetic ids
+
+# Prompts that threads/mentions carry. The mock chat model picks its tool from the words in
+# the user message (see _TOOL_TRIGGERS), so the mix here is the mix of ask() paths exercised.
+PROMPTS = {
+    "chat": "@ArenaGladius what do you think about this?",
+    "stats": "@ArenaGladius get user stats for @mockuser3",
+    "top": "@ArenaGladius top communities this week",
+    "search": "@ArenaGladius search web for avax news",
+    "image": "@ArenaGladius make an image of a gladius riding a rocket",
+}
+_TOOL_TRIGGERS = (
+    ("image", "generate_image", lambda q, ev: {"prompt": q, "caption": "Forged."}),
+    ("user stats", "get_user_stats", lambda q, ev: {"username": "mockuser3"}),
+    ("top communities", "get_top_communities", lambda q, ev: {"since_days": 7}),
+    ("search web", "search_web", lambda q, ev: {"query": "avax news"}),
+)
+
+
+def parse_spec(spec: str, pairs: bool = False) -> Dict[str, Any]:
+    """"a=1,b=2" -> {"a": 1.0, "b": 2.0}; with pairs, "a=900:0.5" -> {"a": (900.0, 0.5)}."""
+    out: Dict[str, Any] = {}
+    for part in (spec or "").split(","):
+        if "=" not in part:
+            continue
+        k, v = part.split("=", 1)
+        k = k.strip()
+        if k not in SERVICES:
+            raise ValueError(f"unknown service {k!r} (expected one of {', '.join(SERVICES)})")
+        if pairs:
+            med, _, sigma = v.partition(":")
+            out[k] = (float(med), float(sigma or DEFAULT_LATENCY[k][1]))
+        else:
+            out[k] = float(v)
+    return out
+
+
+def mock_id(*parts: Any) -> str:
+    return str(uuid.uuid5(_NS, "/".join(str(p) for p in parts)))
+
+
+def _h(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big")
+
+
+def _png(seed: int, side: int = 64) -> bytes:
+    """Noise PNG (compresses poorly, so it's a realistic few KB and passes min-size checks)."""
+    rng = random.Random(seed)
+    raw = b"".join(b"\x00" + bytes(rng.getrandbits(8) for _ in range(side * 3)) for _ in range(side))
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    ihdr = struct.pack(">IIBBBBB", side, side, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b"")
+
+
+class MockWorld:
+    """Deterministic fake StarsArena data plus the knobs shared by all handlers."""
+
+    def __init__(self, latency: Optional[Dict[str, Tuple[float, float]]] = None,
+                 errors: Optional[Dict[str, float]] = None, time_scale: float = 1.0,
+                 feed_size: int = 50, new_per_poll: int = 10, image_ratio: float = 0.2,
+                 media_ratio: float = 0.3, seed: int = 0):
+        self.latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self.errors = {s: 0.0 for s in SERVICES}
+        self.errors.update(errors or {})
+        self.time_scale = time_scale
+        self.feed_size = feed_size
+        self.new_per_poll = new_per_poll
+        self.image_ratio = image_ratio
+        self.media_ratio = media_ratio
+        self.base_url = ""
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._feed_head = 0
+        self._png_cache: Dict[int, bytes] = {}
+        self.counts: Dict[str, int] = {}
+
+    # -- behaviour --
+    def delay(self, service: str) -> None:
+        med, sigma = self.latency[service]
+        with self._lock:
+            z = self._rng.gauss(0.0, 1.0)
+        time.sleep(med / 1000.0 * math.exp(sigma * z) * self.time_scale)
+
+    def should_fail(self, service: str) -> bool:
+        rate = self.errors.get(service, 0.0)
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._rng.random() < rate
+
+    def count(self, key: str) -> None:
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def png(self, seed: int) -> bytes:
+        with self._lock:
+            data = self._png_cache.get(seed % 64)
+            if data is None:
+                data = self._png_cache[seed % 64] = _png(seed % 64)
+        return data
+
+    # -- data --
+    def prompt_kind(self, thread_id: str) -> str:
+        x = (_h(thread_id) % 1000) / 1000.0
+        if x < self.image_ratio:
+            return "image"
+        kinds = [k for k in PROMPTS if k != "image"]
+        return kinds[_h(thread_id + "k") % len(kinds)]
+
+    def user(self, n: int) -> Dict[str, Any]:
+        return {
+            "id": mock_id("user", n),
+            "handle": f"mockuser{n}",
+            "twitterHandle": f"mockuser{n}",
+            "twitterName": f"Mock User {n}",
+            "twitterPicture": f"{self.base_url}/static/avatar/{n}.png",
+            "address": "0x" + hashlib.sha1(str(n).encode()).hexdigest(),
+            "followerCount": 100 + n, "followingsCount": 20, "threadCount": 500,
+            "twitterDescription": "synthetic user", "createdOn": "2024-01-01T00:00:00.000Z",
+            "lastKeyPrice": str(10 ** 17 * (1 + n % 9)),
+        }
+
+    def thread(self, thread_id: str, seq: Optional[int] = None) -> Dict[str, Any]:
+        h = _h(thread_id)
+        n_user = h % 200
+        u = self.user(n_user)
+        created = datetime.now(timezone.utc) - timedelta(minutes=(h >> 8) % 600)
+        images = []
+        if (h >> 16) % 1000 < self.media_ratio * 1000:
+            images = [{"id": mock_id("img", thread_id), "url": f"{self.base_url}/static/img/{h % 64}.png"}]
+        community = None
+        if (h >> 24) % 3 == 0:
+            c = (h >> 24) % 20
+            community = {"id": mock_id("community", c), "contractAddress": "0x" + hashlib.sha1(f"c{c}".encode()).hexdigest(),
+                         "name": f"Mock Community {c}", "type": "token", "photoURL": None}
+        content = PROMPTS[self.prompt_kind(thread_id)] if seq is None else f"mock post {seq} about avax and arena"
+        return {
+            "id": thread_id,
+            "content": f"<p>{content}</p>",
+            "threadType": "answer" if seq is None else "thread",
+            "answerId": None, "repostId": None,
+            "userId": u["id"], "userHandle": u["handle"], "userName": u["twitterName"],
+            "user": {"id": u["id"], "handle": u["handle"], "twitterHandle": u["handle"],
+                     "twitterName": u["twitterName"], "twitterPicture": u["twitterPicture"], "address": u["address"]},
+            "community": community,
+            "images": images, "videos": [],
+            "createdDate": created.isoformat().replace("+00:00", "Z"),
+            "updatedAt": created.isoformat().replace("+00:00", "Z"),
+            "answerCount": h % 7, "likeCount": h % 50, "bookmarkCount": h % 3, "repostCount": h % 5,
+            "tipAmount": "0", "tipCount": 0, "language": "en", "displayStatus": 1,
+        }
+
+    def recent_threads(self) -> Dict[str, Any]:
+        # Sliding window: each poll shows new_per_poll threads the previous poll didn't.
+        with self._lock:
+            self._feed_head += self.new_per_poll
+            head = self._feed_head
+        seqs = range(head, head - self.feed_size, -1)
+        return {"threads": [self.thread(mock_id("feed", s), seq=s) for s in seqs if s > 0]}
+
+    def notification(self, n: int) -> Dict[str, Any]:
+        tid = mock_id("mention", n)
+        return {"id": mock_id("notif", n), "title": "mockuser mentioned you in a post",
+                "link": f"/mockuser/status/{tid}", "createdOn": datetime.now(timezone.utc).isoformat()}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real services
+    world: MockWorld = None  # set on the subclass built by start()
+
+    def log_message(self, fmt, *args):  # quiet
+        pass
+
+    # -- plumbing --
+    def _body(self) -> bytes:
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _json_body(self) -> Dict[str, Any]:
+        try:
+            return json.loads(self._body() or b"{}")
+        except ValueError:
+            return {}
+
+    def _send(self, status: int, body: bytes = b"", ctype: str = "application/json") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def _json(self, obj: Any, status: int = 200) -> None:
+        self._send(status, json.dumps(obj).encode())
+
+    def _route(self, method: str) -> None:
+        url = urlparse(self.path)
+        service, _, rest = url.path.lstrip("/").partition("/")
+        if service not in SERVICES:
+            self._body()
+            return self._json({"error": "not found"}, 404)
+        w = self.world
+        w.count(f"{service}.{method}")
+        if method == "POST" and service not in ("storage",):
+            body = self._json_body()
+        else:
+            body = {}
+            if method == "POST":
+                self._body()
+        w.delay(service)
+        if w.should_fail(service):
+            w.count(f"{service}.error")
+            status = _ERROR_STATUS[service]
+            return self._json({"error": {"message": "mock failure", "code": status}}, status)
+        handler = getattr(self, f"_{service}", None)
+        handler(method, "/" + rest, parse_qs(url.query), body)
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    # -- StarsArena --
+    def _arena(self, method, path, qs, body):
+        w = self.world
+        q = lambda k, d=None: (qs.get(k) or [d])[0]
+        if path == "/partners/recent-threads":
+            return self._json(w.recent_threads())
+        if path == "/threads" and method == "GET":
+            tid = q("threadId")
+            return self._json({"thread": w.thread(tid)}) if tid else self._json({"error": "threadId"}, 400)
+        if path == "/threads/answer" or (path == "/threads" and method == "POST"):
+            new_id = str(uuid.uuid4())
+            return self._json({"thread": {
+                "id": new_id, "threadId": body.get("threadId"), "content": body.get("content"),
+                "files": body.get("files") or [], "userId": mock_id("bot"),
+                "user": {"id": mock_id("bot"), "handle": "arenagladius"}, "userHandle": "arenagladius",
+            }})
+        if path == "/notifications":
+            size = int(q("pageSize", "20"))
+            return self._json({"notifications": [w.notification(n) for n in range(size)]})
+        if path == "/user/handle":
+            m = re.search(r"(\d+)$", q("handle", "") or "")
+            return self._json({"user": w.user(int(m.group(1)) if m else 0)})
+        if path == "/shares/stats":
+            return self._json({"totalHoldings": "12", "totalHolders": "34", "portfolioValue": str(10 ** 18),
+                               "stats": {"buys": 5, "sells": 2, "feesPaid": str(10 ** 16),
+                                         "feesEarned": str(10 ** 16), "referralsEarned": "0"}})
+        if path == "/user/search":
+            return self._json({"users": [w.user(n) for n in range(5)]})
+        if path in ("/threads/feed/user", "/threads/feed/trendingPosts", "/threads/feed/my"):
+            size = int(q("pageSize", "20"))
+            key = q("userId", path)
+            return self._json({"threads": [w.thread(mock_id(key, i), seq=i) for i in range(size)]})
+        if path == "/communities/search":
+            return self._json({"communities": []})
+        if path == "/follow/followers/list":
+            return self._json({"followersWithRelationship": [], "numberOfPages": 0})
+        if path == "/follow/follow":
+            return self._json({"success": True})
+        if path == "/uploads/getUploadPolicy":
+            name = q("fileName", "file.png")
+            expiration = (datetime.now(timezone.utc) + timedelta(minutes=10)).isoformat().replace("+00:00", "Z")
+            policy = base64.b64encode(json.dumps({"expiration": expiration}).encode()).decode()
+            return self._json({"uploadPolicy": {"url": f"{w.base_url}/storage/", "key": f"uploads/{uuid.uuid4()}-{name}",
+                                                "policy": policy, "x-goog-signature": "mock"}})
+        return self._json({"error": f"no mock for {path}"}, 404)
+
+    # -- storage / static --
+    def _storage(self, method, path, qs, body):
+        self._send(204)
+
+    def _static(self, method, path, qs, body):
+        self._send(200, self.world.png(_h(path)), "image/png")
+
+    # -- OpenAI --
+    def _openai(self, method, path, qs, body):
+        if path == "/v1/embeddings":
+            inputs = body.get("input")
+            inputs = [inputs] if isinstance(inputs, str) else (inputs or [])
+            dim = int(body.get("dimensions") or 1536)
+            data = []
+            for i, text in enumerate(inputs):
+                rng = random.Random(_h(str(text)))
+                v = [rng.gauss(0.0, 1.0) for _ in range(dim)]
+                norm = math.sqrt(sum(x * x for x in v)) or 1.0
+                data.append({"object": "embedding", "index": i, "embedding": [x / norm for x in v]})
+            return self._json({"object": "list", "data": data, "model": body.get("model"),
+                               "usage": {"prompt_tokens": 8 * len(inputs), "total_tokens": 8 * len(inputs)}})
+        if path == "/v1/chat/completions":
+            return self._json(self._chat(body))
+        return self._json({"error": {"message": f"no mock for {path}"}}, 404)
+
+    def _chat(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        messages = body.get("messages") or []
+        last = messages[-1] if messages else {}
+        msg: Dict[str, Any] = {"role": "assistant", "content": None}
+        user_content = last.get("content") if last.get("role") == "user" else None
+        if isinstance(user_content, list):
+            # vision request: one analysis per image part
+            n = sum(1 for p in user_content if isinstance(p, dict) and p.get("type") == "image_url")
+            one = {"caption": "a synthetic test image", "ocr_text": None, "topics": ["mock"], "entities": {},
+                   "safety_flags": [], "sentiment": "neutral", "meme_template": None, "meta": {}}
+            msg["content"] = json.dumps({"images": [one] * n} if n > 1 else one)
+        elif body.get("tools") and last.get("role") != "tool":
+            call = self._pick_tool(body, messages)
+            if call:
+                name, args = call
+                msg["tool_calls"] = [{"id": "call_" + uuid.uuid4().hex[:12], "type": "function",
+                                      "function": {"name": name, "arguments": json.dumps(args)}}]
+            else:
+                msg["content"] = "Steel answers steel. (mock reply)"
+        else:
+            msg["content"] = "Done. The arena has spoken. (mock reply)"
+        finish = "tool_calls" if msg.get("tool_calls") else "stop"
+        return {
+            "id": "chatcmpl-" + uuid.uuid4().hex, "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model") or "mock", "choices": [{"index": 0, "message": msg, "finish_reason": finish}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+        }
+
+    @staticmethod
+    def _pick_tool(body, messages):
+        event = {}
+        for m in messages:
+            if m.get("role") == "developer" and isinstance(m.get("content"), str) and m["content"].startswith("EVENT:"):
+                event = dict(re.findall(r"^(\w+): (.*)$", m["content"], re.M))
+        choice = body.get("tool_choice")
+        if isinstance(choice, dict):
+            return choice["function"]["name"], {"url_or_id": event.get("id", "")}
+        question = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+        for word, name, make_args in _TOOL_TRIGGERS:
+            if word in question.lower():
+                return name, make_args(question, event)
+        return None
+
+    # -- Gemini --
+    def _gemini(self, method, path, qs, body):
+        m = re.match(r"^/v1beta/models/([^/:]+):generateContent$", path)
+        if not m:
+            return self._json({"error": {"message": f"no mock for {path}"}}, 404)
+        img = base64.b64encode(self.world.png(_h(json.dumps(body)[:256]))).decode()
+        return self._json({
+            "candidates": [{"content": {"role": "model", "parts": [
+                {"text": "Here is your image."},
+                {"inlineData": {"mimeType": "image/png", "data": img}},
+            ]}, "finishReason": "STOP", "index": 0}],
+            "modelVersion": m.group(1),
+            "usageMetadata": {"promptTokenCount": 50, "candidatesTokenCount": 1290, "totalTokenCount": 1340},
+        })
+
+    # -- Tavily --
+    def _tavily(self, method, path, qs, body):
+        n = int(body.get("max_results") or 5)
+        query = body.get("query") or ""
+        return self._json({
+            "query": query, "answer": f"Mock answer for {query}." if body.get("include_answer") else None,
+            "results": [{"title": f"Result {i} for {query}", "url": f"https://example.com/{i}",
+                         "content": "Synthetic search snippet. " * 8, "score": round(1.0 - i * 0.1, 2)}
+                        for i in range(n)],
+        })
+
+
+class MockServer:
+    """ThreadingHTTPServer running in a daemon thread; use as a context manager or start()/stop()."""
+
+    def __init__(self, world: Optional[MockWorld] = None, host: str = "127.0.0.1", port: int = 0):
+        self.world = world or MockWorld()
+        handler = type("Handler", (_Handler,), {"world": self.world})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.request_queue_size = 256
+        self.base_url = f"http://{host}:{self.httpd.server_address[1]}"
+        self.world.base_url = self.base_url
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "MockServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mock-services", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def env(self) -> Dict[str, str]:
+        b = self.base_url
+        return {
+            "ARENA_API_BASE": f"{b}/arena",
+            "ARENA_UPLOAD_URL": f"{b}/storage/",
+            "ARENA_STATIC_BASE": f"{b}/static",
+            "OPENAI_BASE_URL": f"{b}/openai/v1",
+            "GENAI_BASE_URL": f"{b}/gemini",
+            "TAVILY_API_BASE": f"{b}/tavily",
+        }
+
+
+def add_args(ap: argparse.ArgumentParser) -> None:
+    ap.add_argument("--latency", default="", help='per service "median_ms:sigma", e.g. "openai=900:0.5,gemini=8000:0.3"')
+    ap.add_argument("--errors", default="", help='per service error rate, e.g. "gemini=0.05,arena=0.01"')
+    ap.add_argument("--time-scale", type=float, default=1.0, help="multiply every mock latency (0 = no delay)")
+    ap.add_argument("--image-ratio", type=float, default=0.2, help="share of mentions that ask for an image")
+    ap.add_argument("--new-per-poll", type=int, default=10, help="new threads per recent-threads poll")
+    ap.add_argument("--seed", type=int, default=0)
+
+
+def world_from_args(args) -> MockWorld:
+    return MockWorld(latency=parse_spec(args.latency, pairs=True), errors=parse_spec(args.errors),
+                     time_scale=args.time_scale, image_ratio=args.image_ratio,
+                     new_per_poll=args.new_per_poll, seed=args.seed)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8799)
+    add_args(ap)
+    args = ap.parse_args()
+    server = MockServer(world_from_args(args), args.host, args.port)
+    for k, v in server.env().items():
+        print(f"export {k}={v}")
+    sys.stdout.flush()
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.world.counts, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
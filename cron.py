@@ -1,7 +1,8 @@
 import os, time
-from db import supabase
+from db import repo
 from Arena import get_latest_post              # your function
 from ingest import ingest_payload        # from earlier
+import tracing
 from logging_utils import get_logger
 
 logger = get_logger(__name__)
@@ -12,10 +13,10 @@ BATCH_LIMIT  = int(os.getenv("BATCH_LIMIT", "100"))  # optional cap per poll
 def fetch_existing_ids(ids):
     if not ids:
         return set()
-    res = supabase.table("sa_threads").select("id").in_("id", ids).execute()
-    rows = (res.data or []) if hasattr(res, "data") else []
-    return {r["id"] for r in rows}
+    res = repo.select("sa_threads", "id", in_={"id": ids})
+    return {r["id"] for r in res.data}
 
+@tracing.traced("poll")
 def run_once():
     data = get_latest_post()                    # hits StarsArena partners API
     threads = data.get("threads", [])
@@ -30,6 +31,7 @@ def run_once():
     existing = fetch_existing_ids(ids)
 
     new_threads = [t for t in threads if t["id"] not in existing]
+    tracing.annotate(fetched=len(threads), new=len(new_threads))
     if not new_threads:
         logger.info("poll | no new threads | seen=%s", len(existing))
         return 0
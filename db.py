@@ -1,12 +1,49 @@
 from dotenv import load_dotenv
 import os
 load_dotenv()
-from supabase import create_client
+from repository import PostgrestRepository, PostgresRepository, TracedRepository
+import tracing
 from logging_utils import get_logger
 
 logger = get_logger(__name__)
 
+# Data-access backend for `repo` (see repository.py):
+#   DB_BACKEND=auto (default) -> direct Postgres when DATABASE_URL is set, else PostgREST
+#   DB_BACKEND=postgres       -> direct Postgres (DATABASE_URL required)
+#   DB_BACKEND=postgrest      -> always the supabase client
+#   DB_BACKEND=sqlite         -> local file at SQLITE_PATH (sqlite_store.py); no Supabase needed
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_BACKEND = os.getenv("DB_BACKEND", "auto").lower()
+
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
-logger.debug("supabase client initialized")
+if SUPABASE_URL or DB_BACKEND != "sqlite":
+    from supabase import create_client  # not needed (or installed) for an offline sqlite run
+    supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+    logger.debug("supabase client initialized")
+else:
+    supabase = None  # offline: only `repo` is available
+
+
+def _make_repo():
+    if DB_BACKEND == "sqlite":
+        from sqlite_store import SqliteRepository
+        return SqliteRepository()
+    if DB_BACKEND == "postgres" or (DB_BACKEND == "auto" and DATABASE_URL):
+        if not DATABASE_URL:
+            raise RuntimeError("DB_BACKEND=postgres needs DATABASE_URL")
+        try:
+            return PostgresRepository(DATABASE_URL)
+        except Exception:
+            if DB_BACKEND == "postgres":
+                raise
+            logger.exception("direct postgres unavailable; using postgrest")
+    elif DB_BACKEND not in ("auto", "postgrest"):
+        raise RuntimeError(f"unknown DB_BACKEND: {DB_BACKEND}")
+    return PostgrestRepository(supabase)
+
+
+repo = _make_repo()
+if tracing.ENABLED:
+    repo = TracedRepository(repo)
+logger.info("db backend | backend=%s", repo.name)
@@ -0,0 +1,106 @@
+# embedding_quant.py
+import numpy as np
+
+# Compact encodings for local copies of text-embedding-3 vectors (ANN mirror, caches).
+#
+#   truncate   text-embedding-3 is trained Matryoshka-style: the first d dims, renormalized,
+#              are a usable d-dim embedding (what the API's `dimensions` parameter returns).
+#   f16        2 bytes/dim, effectively lossless for cosine ranking.
+#   int8       1 byte/dim + a float32 scale per vector (symmetric, max-abs).
+#   binary     1 bit/dim (sign). Scored by hamming distance to shortlist candidates, which are
+#              re-scored with int8 codes of the same vectors (Codec.companion) kept next to the bits
+#              - only the shortlist's rows of those are read. Without them the shortlist is re-scored
+#              against the signs alone, which barely changes the hamming order (recall@10 ~0.5):
+#              a low-recall mode for benchmarks, not for serving.
+#
+# All codecs score against a float32, L2-normalized query; higher is more similar.
+
+CODECS = ("f16", "int8", "binary")
+
+
+def truncate(x: np.ndarray, dims: int) -> np.ndarray:
+    """First `dims` components, re-L2-normalized. Works on a vector or a (n, d) matrix."""
+    x = np.asarray(x, dtype=np.float32)[..., :dims]
+    n = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(n, 1e-12)
+
+
+class Codec:
+    """Fixed-size row encoding usable as a numpy dtype (so rows can live in a memmap)."""
+
+    def __init__(self, name: str, dims: int):
+        if name not in CODECS:
+            raise ValueError(f"unknown codec {name!r} (expected one of {CODECS})")
+        if name == "binary" and dims % 8:
+            raise ValueError("binary codec needs dims divisible by 8")
+        self.name = name
+        self.dims = dims
+        if name == "f16":
+            self.dtype = np.dtype((np.float16, (dims,)))
+        elif name == "int8":
+            self.dtype = np.dtype([("q", np.int8, (dims,)), ("s", "<f4")])
+        else:
+            self.dtype = np.dtype((np.uint8, (dims // 8,)))
+        # full-precision-enough rows for re-scoring the binary shortlist (stored separately)
+        self.companion = Codec("int8", dims) if name == "binary" else None
+
+    @property
+    def bytes_per_vector(self) -> int:
+        return self.dtype.itemsize
+
+    def prepare(self, x) -> np.ndarray:
+        """Truncate + normalize raw embeddings to this codec's dimensionality (float32)."""
+        return truncate(x, self.dims)
+
+    def encode(self, x: np.ndarray) -> np.ndarray:
+        """(n, d) normalized float32 -> (n,) array of self.dtype."""
+        x = np.atleast_2d(self.prepare(x))
+        out = np.empty(len(x), dtype=self.dtype)
+        if self.name == "f16":
+            out[:] = x.astype(np.float16)
+        elif self.name == "int8":
+            scale = np.maximum(np.abs(x).max(axis=1), 1e-12)
+            out["q"] = np.round(x / scale[:, None] * 127).astype(np.int8)
+            out["s"] = scale / 127
+        else:
+            out[:] = np.packbits(x > 0, axis=1)
+        return out
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """Approximate float32 rows (used for IVF training/assignment)."""
+        if self.name == "f16":
+            return np.asarray(codes, dtype=np.float32)
+        if self.name == "int8":
+            return codes["q"].astype(np.float32) * codes["s"][:, None]
+        signs = np.unpackbits(codes, axis=1).astype(np.float32) * 2 - 1
+        return signs / np.sqrt(self.dims)
+
+    def scores(self, codes: np.ndarray, q: np.ndarray, k: int, rescore: int = 10, companion=None):
+        """
+        (positions, scores) of the top-k rows of `codes` for query `q`, best first.
+        For binary, the top k*rescore by hamming distance are re-scored against the float query,
+        using `companion` when given: the companion codec's rows aligned with `codes`, or a
+        function positions -> those rows (so a memmap only pages in the shortlist).
+        """
+        q = self.prepare(q)
+        if self.name == "binary":
+            qbits = np.packbits(q > 0)
+            ham = np.bitwise_count(np.bitwise_xor(codes, qbits)).sum(axis=1, dtype=np.int32)
+            m = min(len(ham), k * rescore)
+            short = np.argpartition(ham, m - 1)[:m]
+            if companion is not None:
+                rows = companion(short) if callable(companion) else companion[short]
+                s = (rows["q"].astype(np.float32) @ q) * rows["s"]
+            else:
+                # signs only; divided by the query's own best case, so identical sign patterns score 1.0
+                s = (self.decode(codes[short]) @ q) / max(float(np.abs(q).sum()) / np.sqrt(self.dims), 1e-12)
+            top = np.argsort(-s)[:k]
+            return short[top], s[top]
+        if self.name == "int8":
+            s = (codes["q"].astype(np.float32) @ q) * codes["s"]
+        else:
+            s = np.asarray(codes, dtype=np.float32) @ q
+        k = min(k, len(s))
+        top = np.argpartition(-s, k - 1)[:k]
+        top = top[np.argsort(-s[top])]
+        return top, s[top]
@@ -0,0 +1,122 @@
+# engagement_refresh.py
+import os
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+from db import repo
+from function import JWT, ARENA_API_BASE
+from ratelimit import TokenBucket
+import rollups
+import metrics
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+# Keeps sa_threads counters (likes, reposts, answers, tips) current for recent posts.
+# Which threads are due comes from threads_due_for_counter_refresh (decaying schedule, see
+# migrations/004); every cycle's results go back in one update_thread_counters call.
+POLL_SECONDS  = int(os.getenv("COUNTER_REFRESH_POLL_SECONDS", "60"))
+BATCH_SIZE    = int(os.getenv("COUNTER_REFRESH_BATCH", "100"))
+MAX_AGE_DAYS  = int(os.getenv("COUNTER_REFRESH_MAX_AGE_DAYS", "30"))
+API_RPM       = float(os.getenv("COUNTER_REFRESH_RPM", "120"))
+CONCURRENCY   = int(os.getenv("COUNTER_REFRESH_CONCURRENCY", "4"))
+
+_rate = TokenBucket.per_minute(API_RPM, burst=max(1.0, min(CONCURRENCY, API_RPM)))
+
+_session = requests.Session()
+_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=CONCURRENCY * 2))
+_HEADERS = {
+    "Authorization": f"Bearer {JWT}",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:133.0) Gecko/20100101 Firefox/133.0",
+    "Referrer": "https://arena.social",
+    "Content-Type": "application/json",
+}
+
+
+def _int(x) -> Optional[int]:
+    return int(x) if x is not None else None
+
+
+def fetch_counters(thread_id: str) -> Dict[str, Any]:
+    """
+    Current counters for one thread as an update_thread_counters row. Counters are None when
+    the fetch failed (the DB keeps the old values); a 404 marks the thread deleted.
+    """
+    row: Dict[str, Any] = {"id": thread_id}
+    _rate.acquire()
+    try:
+        r = _session.get(f"{ARENA_API_BASE}/threads?threadId={thread_id}", headers=_HEADERS, timeout=15)
+        if r.status_code == 404:
+            row["is_deleted"] = True
+            return row
+        r.raise_for_status()
+        t = r.json().get("thread") or {}
+    except (requests.exceptions.RequestException, ValueError):
+        metrics.incr("counter_refresh.fetch_failed")
+        logger.warning("counter refresh fetch failed | thread_id=%s", thread_id)
+        return row
+    row.update({
+        "like_count": _int(t.get("likeCount")),
+        "repost_count": _int(t.get("repostCount")),
+        "answer_count": _int(t.get("answerCount")),
+        "bookmark_count": _int(t.get("bookmarkCount")),
+        "tip_amount": t.get("tipAmount"),
+        "tip_count": _int(t.get("tipCount")),
+        "is_deleted": bool(t.get("isDeleted")) if t.get("isDeleted") is not None else None,
+    })
+    return row
+
+
+def fetch_due(limit: int) -> List[Dict[str, Any]]:
+    return repo.rpc("threads_due_for_counter_refresh", {
+        "p_limit": limit,
+        "p_max_age_days": MAX_AGE_DAYS,
+    }) or []
+
+
+def run_once() -> int:
+    """Refresh one batch of due threads. Returns number of threads processed (0 = nothing due)."""
+    due = fetch_due(BATCH_SIZE)
+    if not due:
+        return 0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as ex:
+        rows = list(ex.map(fetch_counters, [d["id"] for d in due]))
+    fetch_secs = time.perf_counter() - t0
+
+    n = repo.rpc("update_thread_counters", {"p_rows": rows})
+    updated = int(n) if isinstance(n, (int, float)) else len(rows)
+    rollups.refresh_for_threads(r["id"] for r in rows if len(r) > 1)  # only rows that changed
+
+    fetched = sum(1 for r in rows if "like_count" in r)
+    metrics.incr("counter_refresh.updated", updated)
+    metrics.observe("counter_refresh.batch", time.perf_counter() - t0)
+    logger.info(
+        "counter refresh | due=%s | fetched=%s | updated=%s | fetch_seconds=%.2f | max_overdue=%.2f",
+        len(due),
+        fetched,
+        updated,
+        fetch_secs,
+        due[0].get("overdue") or 0.0,
+    )
+    return len(due)
+
+
+def main():
+    backoff = POLL_SECONDS
+    while True:
+        try:
+            n = run_once()
+            backoff = POLL_SECONDS
+            if n >= BATCH_SIZE:
+                continue  # backlog: the rate limiter paces us
+        except Exception:
+            logger.exception("counter refresh error")
+            backoff = min(max(backoff * 2, POLL_SECONDS), 600)
+        time.sleep(backoff)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,23 @@ import re
 import urllib.parse
 load_dotenv()
 from datetime import datetime, timezone, timedelta
-from db import supabase
+from db import repo
 import json
+import time
 POST_UUID_RE = re.compile(r"[0-9a-fA-F-]{36}")
 from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor
 from logging_utils import get_logger
+from textclean import html_to_text
+from uploader import upload_bytes
+from ingest import sha256_of_url
+from ref_image_cache import content_sha256
+import phash_index
+import metrics
+import tracing
+import sync_scheduler
+import rollups
+import audit_log
 
 logger = get_logger(__name__)
 
@@ -20,8 +32,25 @@ def _excerpt(s: str, max_len: int = 400) -> str:
     return s[: max_len - 3] + "..."
 
 JWT = os.getenv("JWT")
+ARENA_API_BASE = os.getenv("ARENA_API_BASE", "https://api.starsarena.com").rstrip("/")
+
+# Vision analysis engine
+VISION_CONCURRENCY      = int(os.getenv("VISION_CONCURRENCY", "4"))
+VISION_MULTI_IMAGE      = os.getenv("VISION_MULTI_IMAGE", "0").lower() in ("1", "true", "yes")
+VISION_MULTI_MAX        = int(os.getenv("VISION_MULTI_MAX", "4"))
+VISION_SMALL_MAX_PIXELS = int(os.getenv("VISION_SMALL_MAX_PIXELS", str(512 * 512)))
+_VISION_POOL = ThreadPoolExecutor(max_workers=VISION_CONCURRENCY, thread_name_prefix="vision")
+
+# Reuse analyses for the same image URL (and optionally the same bytes) across threads.
+# Perceptual-hash matches only lend meme_template/topics: same-template memes with different
+# text land within a few bits, so their OCR/caption are never copied.
+VISION_DEDUPE              = os.getenv("VISION_DEDUPE", "1").lower() not in ("0", "false", "no")
+VISION_DEDUPE_CONTENT_HASH = os.getenv("VISION_DEDUPE_CONTENT_HASH", "0").lower() in ("1", "true", "yes")
+VISION_DEDUPE_PHASH        = os.getenv("VISION_DEDUPE_PHASH", "0").lower() in ("1", "true", "yes")
+
+@tracing.traced("arena.post")
 def post_to_starsarena(content, imageURL = None):
-    url = "https://api.starsarena.com/threads"
+    url = f"{ARENA_API_BASE}/threads"
     headersVal = {
         "Accept": "application/json, text/plain, */*",
         "Accept-Encoding": "gzip, deflate, br, zstd",
@@ -58,12 +87,9 @@ def _get_thread_images(thread_id: str, mediaList = None):
 
     if mediaList is not None:
         return mediaList
-    res = supabase.table("sa_images") \
-        .select("id, source_url, storage_path, mime, width, height, is_gif") \
-        .eq("thread_id", thread_id) \
-        .order("id", desc=False) \
-        .execute()
-    return res.data or []
+    res = repo.select("sa_images", "id, source_url, storage_path, mime, width, height, is_gif, sha256",
+                      eq={"thread_id": thread_id}, order="id")
+    return res.data
 
 
 def _strip_at(s):
@@ -119,12 +145,14 @@ def store_bot_reply(
 
         "response_json": response_json or {},
     }
+    # write-behind: the reply is already posted, don't wait on the DB for the log row
     try:
-        supabase.table("bot_replies").insert(row).execute()
-        logger.info("logged bot reply | parent_post_id=%s", parent_post_id)
+        audit_log.log("bot_replies", row)
+        logger.info("queued bot reply log | parent_post_id=%s", parent_post_id)
     except Exception as e:
         logger.exception("store_bot_reply failed")
 
+@tracing.traced("get_nested")
 def getNested(comment_post_id):
     """
     Builds a minimal 'threads' payload containing the comment and its root
@@ -144,14 +172,203 @@ def _get_existing_analyses(image_ids):
     """Return a set of image_ids that already have analysis."""
     if not image_ids:
         return set()
-    res = supabase.table("sa_image_analysis") \
-        .select("image_id") \
-        .in_("image_id", image_ids) \
-        .execute()
-    return {r["image_id"] for r in (res.data or [])}
+    res = repo.select("sa_image_analysis", "image_id", in_={"image_id": image_ids})
+    return {r["image_id"] for r in res.data}
 
 
 
+def _image_url(img):
+    return img.get("storage_path") or img.get("source_url") or img.get("url")
+
+
+def _is_small_image(img):
+    w, h = img.get("width"), img.get("height")
+    return bool(w and h and int(w) * int(h) <= VISION_SMALL_MAX_PIXELS)
+
+
+_ANALYSIS_COLS = "image_id, caption, ocr_text, topics, entities, safety_flags, sentiment, meme_template, meta"
+
+
+def _analyses_for_fingerprints(fps, exclude_ids):
+    """{url_fingerprint: analysis_row} for images elsewhere whose sa_images.sha256 matches."""
+    if not fps:
+        return {}
+    res = repo.select("sa_images", "id, sha256", in_={"sha256": list(fps)})
+    fp_by_id = {r["id"]: r["sha256"] for r in res.data if r["id"] not in exclude_ids}
+    if not fp_by_id:
+        return {}
+    res = repo.select("sa_image_analysis", _ANALYSIS_COLS, in_={"image_id": list(fp_by_id)})
+    return {fp_by_id[r["image_id"]]: r for r in res.data}
+
+
+def _analyses_for_content_hashes(hashes):
+    """{content_sha256: analysis_row} for analyses recorded with a matching meta.content_sha256."""
+    if not hashes:
+        return {}
+    res = repo.select("sa_image_analysis", _ANALYSIS_COLS, in_={"meta->>content_sha256": list(hashes)})
+    out = {}
+    for r in res.data:
+        out.setdefault((r.get("meta") or {}).get("content_sha256"), r)
+    return out
+
+
+def _analysis_for_near_duplicate(img):
+    """
+    Perceptual-hash `img` and return (hash, analysis row of the closest already-analyzed
+    near-duplicate or None). The hash is only added to the index once `img` has an analysis
+    of its own (see analyze_and_persist_images), so every indexed id has a row to reuse.
+    """
+    h = None
+    try:
+        h = phash_index.hash_cached(_image_url(img))
+        if h is None:
+            return None, None
+        matches = [(mid, d) for mid, d in phash_index.get_index().query(h) if mid != img["id"]]
+        if not matches:
+            return h, None
+        res = repo.select("sa_image_analysis", _ANALYSIS_COLS, in_={"image_id": [mid for mid, _ in matches]})
+        rows = {r["image_id"]: r for r in res.data}
+        for mid, _ in matches:  # closest first
+            if mid in rows:
+                return h, rows[mid]
+    except Exception:
+        logger.exception("phash dedupe failed | image_id=%s", img.get("id"))
+    return h, None
+
+
+def find_same_meme(url_or_id, max_distance = None, limit = 10):
+    """
+    Images that look like the given image (near-duplicate perceptual hash), with their
+    thread and any stored analysis. Accepts an image URL or a post URL/UUID (first image).
+    """
+    s = (url_or_id or "").strip()
+    post_id = extract_post_id_from_url(s)
+    exclude = set()
+    if POST_UUID_RE.fullmatch(post_id):
+        imgs = _get_thread_images(post_id)
+        if not imgs:
+            return {"success": False, "error": "No images stored for that post."}
+        s = _image_url(imgs[0])
+        exclude = {i["id"] for i in imgs}
+    matches = phash_index.find_near_duplicates(s, max_distance=max_distance, limit=limit, exclude_ids=exclude)
+    if not matches:
+        return {"success": True, "matches": []}
+    ids = [mid for mid, _ in matches]
+    imgs = repo.select("sa_images", "id, thread_id, source_url", in_={"id": ids}).data
+    ana = repo.select("sa_image_analysis", "image_id, caption, meme_template", in_={"image_id": ids}).data
+    by_img = {r["id"]: r for r in imgs}
+    by_ana = {r["image_id"]: r for r in ana}
+    out = []
+    for mid, d in matches:
+        im = by_img.get(mid) or {}
+        a = by_ana.get(mid) or {}
+        out.append({
+            "image_id": mid,
+            "distance": d,
+            "thread_id": im.get("thread_id"),
+            "url": im.get("source_url"),
+            "caption": a.get("caption"),
+            "meme_template": a.get("meme_template"),
+        })
+    return {"success": True, "matches": out}
+
+
+def _copy_analysis(row, how):
+    analysis = {k: row.get(k) for k in ("caption", "ocr_text", "topics", "entities", "safety_flags", "sentiment", "meme_template")}
+    analysis["meta"] = {**(row.get("meta") or {}), "dedup": how, "dedup_of": row.get("image_id")}
+    return analysis
+
+
+def _apply_template_hint(analysis, row):
+    """Fill meme_template / add topics from a near-duplicate's analysis; the vision fields stay ours."""
+    if not analysis.get("meme_template") and row.get("meme_template"):
+        analysis["meme_template"] = row["meme_template"]
+    topics = list(analysis.get("topics") or [])
+    topics += [t for t in (row.get("topics") or []) if t not in topics]
+    analysis["topics"] = topics
+    analysis.setdefault("meta", {})["template_of"] = row.get("image_id")
+    return analysis
+
+
+def _reuse_existing_analyses(todo):
+    """
+    Split `todo` into (reused [{image_id, analysis}], still_todo) by looking up analyses of
+    the same image under another image_id: first by URL fingerprint (sa_images.sha256, as
+    computed by ingest.sha256_of_url), then optionally by content hash (VISION_DEDUPE_CONTENT_HASH).
+    With VISION_DEDUPE_PHASH, images left over are looked up in the near-duplicate index and
+    keep the closest match as `_template_hint` (see _apply_template_hint); they still get vision.
+    """
+    if not VISION_DEDUPE:
+        return [], todo
+    for i in todo:
+        i["_fp"] = i.get("sha256") or sha256_of_url(_image_url(i))
+    own_ids = {i["id"] for i in todo}
+    try:
+        by_fp = _analyses_for_fingerprints({i["_fp"] for i in todo}, own_ids)
+    except Exception:
+        logger.exception("analysis dedupe lookup failed")
+        by_fp = {}
+
+    reused, rest = [], []
+    for i in todo:
+        row = by_fp.get(i["_fp"])
+        if row:
+            reused.append({"image_id": i["id"], "analysis": _copy_analysis(row, "url")})
+        else:
+            rest.append(i)
+    metrics.incr("vision.dedupe.url_hit", len(reused))
+
+    if VISION_DEDUPE_CONTENT_HASH and rest:
+        for i in rest:
+            i["_content_sha256"] = content_sha256(_image_url(i))
+        try:
+            by_hash = _analyses_for_content_hashes({i["_content_sha256"] for i in rest if i.get("_content_sha256")})
+        except Exception:
+            logger.exception("analysis content-hash lookup failed")
+            by_hash = {}
+        still = []
+        for i in rest:
+            row = by_hash.get(i.get("_content_sha256"))
+            if row:
+                reused.append({"image_id": i["id"], "analysis": _copy_analysis(row, "content")})
+                metrics.incr("vision.dedupe.content_hit")
+            else:
+                still.append(i)
+        rest = still
+
+    if VISION_DEDUPE_PHASH and rest:
+        # download + hash + lookup per image, concurrently (the vision calls haven't started yet)
+        futures = [_VISION_POOL.submit(tracing.bind(_analysis_for_near_duplicate), i) for i in rest]
+        for i, fut in zip(rest, futures):
+            i["_phash"], i["_template_hint"] = fut.result()
+            if i["_template_hint"]:
+                metrics.incr("vision.dedupe.phash_hint")
+
+    metrics.incr("vision.dedupe.miss", len(rest))
+    hits = sum(metrics.counter(f"vision.dedupe.{k}_hit") for k in ("url", "content"))
+    total = hits + metrics.counter("vision.dedupe.miss")
+    logger.info(
+        "analysis dedupe | reused=%s | to_analyze=%s | hit_rate=%.2f",
+        len(reused),
+        len(rest),
+        hits / total if total else 0.0,
+    )
+    return reused, rest
+
+
+def _analyze_group(oai_client, group, model):
+    """Analyze a list of images (one request if >1). Returns [(img, analysis)]."""
+    urls = [_image_url(i) for i in group]
+    if len(group) == 1:
+        return [(group[0], analyze_image_with_oai_structured(oai_client, urls[0], model=model))]
+    analyses = analyze_images_with_oai_structured(oai_client, urls, model=model)
+    if len(analyses) != len(group):
+        # model didn't return one object per image; fall back to one call each
+        logger.warning("multi-image analysis mismatch | expected=%s | got=%s", len(group), len(analyses))
+        return [(i, analyze_image_with_oai_structured(oai_client, u, model=model)) for i, u in zip(group, urls)]
+    return list(zip(group, analyses))
+
+
 def analyze_and_persist_images_for_thread(
     oai_client: "OpenAI",
     thread_id: str,
@@ -169,20 +386,59 @@ def analyze_and_persist_images_for_thread(
     ids = [i["id"] for i in imgs if "id" in i]
     already = _get_existing_analyses(ids)
     todo = [i for i in imgs if i["id"] not in already]
+    return analyze_and_persist_images(oai_client, todo, model=model)
 
-    out = []
-    for i in todo:
-        url = i.get("storage_path") or i.get("source_url") or i.get("url")
-        if not url:
-            continue
-        analysis = analyze_image_with_oai_structured(oai_client, url, model=model)
+
+def analyze_and_persist_images(oai_client: "OpenAI", imgs, model: str = "gpt-4o-mini"):
+    """
+    Analyze the given sa_images rows (assumed to lack analysis) and upsert results.
+    Dedupe hits are reused first; the remaining vision calls run concurrently
+    (VISION_CONCURRENCY); small images can share one multi-image request
+    (VISION_MULTI_IMAGE); results land in a single bulk upsert.
+    Returns list of {image_id, analysis} (reused ones carry meta.dedup).
+    """
+    todo = [i for i in imgs if _image_url(i)]
+    if not todo:
+        return []
+
+    # Reuse analyses of the same image posted elsewhere before paying for vision
+    reused, todo = _reuse_existing_analyses(todo)
+
+    groups = []
+    if VISION_MULTI_IMAGE:
+        small = [i for i in todo if _is_small_image(i)]
+        todo = [i for i in todo if not _is_small_image(i)]
+        for k in range(0, len(small), VISION_MULTI_MAX):
+            groups.append(small[k : k + VISION_MULTI_MAX])
+    groups.extend([i] for i in todo)
+
+    futures = [_VISION_POOL.submit(tracing.bind(_analyze_group), oai_client, g, model) for g in groups]
+    pairs = []
+    for g, fut in zip(groups, futures):
+        try:
+            pairs.extend(fut.result())
+        except Exception:
+            logger.exception("vision analysis failed | image_ids=%s", [i["id"] for i in g])
+
+    out = list(reused)
+    for i, analysis in pairs:
         # enrich meta
         meta = analysis.get("meta") or {}
-        meta.update({"model": model, "image_url": url})
+        meta.update({"model": model, "image_url": _image_url(i)})
+        if i.get("_content_sha256"):
+            meta["content_sha256"] = i["_content_sha256"]
         analysis["meta"] = meta
-
-        upsert_image_analysis(i["id"], analysis)
+        if i.get("_template_hint"):
+            _apply_template_hint(analysis, i["_template_hint"])
         out.append({"image_id": i["id"], "analysis": analysis})
+
+    upsert_image_analyses([(o["image_id"], o["analysis"]) for o in out])
+
+    # index hashes only now that these ids have analysis rows a later near-duplicate can reuse
+    analyzed = {o["image_id"] for o in out}
+    for i in imgs:
+        if i.get("_phash") is not None and i["id"] in analyzed:
+            phash_index.get_index().add(i["id"], i["_phash"])
     return out
 
 
@@ -219,10 +475,10 @@ def get_media_json_for_thread(thread_id):
     # fetch all analyses in one go
     analyses = {}
     if ids:
-        res = supabase.table("sa_image_analysis") \
-            .select("image_id, caption, ocr_text, topics, entities, safety_flags, sentiment, meme_template, meta") \
-            .in_("image_id", ids).execute()
-        for r in (res.data or []):
+        res = repo.select("sa_image_analysis",
+                          "image_id, caption, ocr_text, topics, entities, safety_flags, sentiment, meme_template, meta",
+                          in_={"image_id": ids})
+        for r in res.data:
             analyses[r["image_id"]] = r
 
     media = []
@@ -249,6 +505,7 @@ def get_media_json_for_thread(thread_id):
     return media
 
 
+@tracing.traced("analyze_post")
 def ensure_analysis_and_media_for_post(oai_client: "OpenAI", url_or_id: str):
     """
     Extract post_id, run analysis for any missing images, and return:
@@ -301,8 +558,8 @@ def ensure_analysis_and_media_for_post(oai_client: "OpenAI", url_or_id: str):
         "media": get_media_json_for_thread(post_id)
     }
 
-def upsert_image_analysis(image_id, analysis):
-    row = {
+def _analysis_row(image_id, analysis):
+    return {
         "image_id": image_id,
         "caption": analysis.get("caption"),
         "ocr_text": analysis.get("ocr_text"),
@@ -315,10 +572,20 @@ def upsert_image_analysis(image_id, analysis):
             **(analysis.get("meta") or {}),
         },
     }
+
+def upsert_image_analysis(image_id, analysis):
     # upsert on PK image_id
-    supabase.table("sa_image_analysis").upsert(row, on_conflict="image_id").execute()
+    repo.upsert("sa_image_analysis", _analysis_row(image_id, analysis), on_conflict="image_id")
+
+def upsert_image_analyses(pairs):
+    """Multi-row upsert of [(image_id, analysis), ...] in one round trip."""
+    rows = [_analysis_row(image_id, analysis) for image_id, analysis in pairs]
+    if not rows:
+        return 0
+    return repo.upsert("sa_image_analysis", rows, on_conflict="image_id")
 
 
+@tracing.traced("openai.vision")
 def analyze_image_with_oai_structured(
     oai_client: "OpenAI",
     image_url,
@@ -361,18 +628,10 @@ def analyze_image_with_oai_structured(
         ],
     )
     raw = resp.choices[0].message.content or "{}"
+    return _parse_json_object(raw) or _empty_analysis()
 
-    # Try strict JSON parse; if the model added prose, trim to outermost braces
-    try:
-        return json.loads(raw)
-    except Exception:
-        start = raw.find("{")
-        end = raw.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            try:
-                return json.loads(raw[start : end + 1])
-            except Exception:
-                pass
+
+def _empty_analysis():
     # Fallback minimal object
     return {
         "caption": None,
@@ -385,6 +644,63 @@ def analyze_image_with_oai_structured(
         "meta": {},
     }
 
+
+def _parse_json_object(raw):
+    # Try strict JSON parse; if the model added prose, trim to outermost braces
+    try:
+        return json.loads(raw)
+    except Exception:
+        start = raw.find("{")
+        end = raw.rfind("}")
+        if start != -1 and end != -1 and end > start:
+            try:
+                return json.loads(raw[start : end + 1])
+            except Exception:
+                pass
+    return None
+
+
+@tracing.traced("openai.vision")
+def analyze_images_with_oai_structured(
+    oai_client: "OpenAI",
+    image_urls,
+    model = "gpt-4o-mini",
+    max_tokens_per_image = 300,
+    temperature = 0.0,
+):
+    """
+    Same output shape as analyze_image_with_oai_structured, but for several images in
+    one request. Returns a list with one analysis per URL, in order ([] if unparseable).
+    """
+    sys = (
+        "You are a vision analyzer. You will receive several images, numbered in order. "
+        "Return a SINGLE JSON object {\"images\": [...]} with exactly one entry per image, in the same order. "
+        "Each entry has keys: caption, ocr_text, topics (array of short keywords), "
+        "entities (JSON), safety_flags (array), sentiment (one of: bullish, bearish, neutral, positive, negative, mixed, unknown), "
+        "meme_template (string or null). "
+        "Be concise. If a field is unknown, use null (or [] for arrays, {} for objects)."
+    )
+    user_payload = [{"type": "text", "text": f"Analyze these {len(image_urls)} images and output ONLY the JSON object."}]
+    for n, url in enumerate(image_urls, start=1):
+        user_payload.append({"type": "text", "text": f"Image {n}:"})
+        user_payload.append({"type": "image_url", "image_url": {"url": url}})
+
+    resp = oai_client.chat.completions.create(
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens_per_image * len(image_urls),
+        messages=[
+            {"role": "system", "content": sys},
+            {"role": "user", "content": user_payload},
+        ],
+    )
+    parsed = _parse_json_object(resp.choices[0].message.content or "{}") or {}
+    items = parsed.get("images") if isinstance(parsed, dict) else None
+    if not isinstance(items, list):
+        return []
+    return [it if isinstance(it, dict) else _empty_analysis() for it in items]
+
+@tracing.traced("openai.vision")
 def analyze_image_with_oai(oai_client: "OpenAI", image_url, max_tokens = 150):
     """
     Lightweight vision pass: describe subject, vibe, any visible on-image text.
@@ -409,30 +725,18 @@ def analyze_image_with_oai(oai_client: "OpenAI", image_url, max_tokens = 150):
     except Exception as e:
         return {"ok": False, "error": str(e)}
 def clean_html(raw_html):
-    if raw_html is None:
-        return ""
-    """
-    Removes HTML tags from the input string and returns a clean, readable string.
+    """Tags removed (no separator), whitespace collapsed; entities left as-is."""
+    return html_to_text(raw_html, sep="", unescape=False)
 
-    Args:
-        raw_html (str): The raw HTML string to clean.
 
-    Returns:
-        str: The cleaned string without HTML tags.
-    """
-    # Remove HTML tags
-    clean_text = re.sub(r'<[^>]+>', '', raw_html)
-    # Replace unnecessary whitespace and newlines
-    clean_text = re.sub(r'\s+', ' ', clean_text).strip()
-    return clean_text
 def clean_text(s):
-    s = re.sub(r"<[^>]+>", " ", s or "")
-    s = re.sub(r"https?://\S+", "", s)
-    s = re.sub(r"\s+", " ", s)
-    return s.strip()
+    """Tags and links removed, whitespace collapsed; entities left as-is."""
+    return html_to_text(s, unescape=False, drop_urls=True)
 
+
+@tracing.traced("arena.follow")
 def follow(userID):
-    url = "https://api.starsarena.com/follow/follow"
+    url = f"{ARENA_API_BASE}/follow/follow"
     headers = {
         "Accept": "application/json, text/plain, */*",
         "Accept-Encoding": "gzip, deflate, br, zstd",
@@ -458,8 +762,9 @@ def follow(userID):
 
 
 
+@tracing.traced("arena.notifications")
 def getNotifications(page=1, pageSize= 50):
-    url = f"https://api.starsarena.com/notifications?page={1}&pageSize={pageSize}"
+    url = f"{ARENA_API_BASE}/notifications?page={1}&pageSize={pageSize}"
     headers = {
         "Authorization": f"Bearer {JWT}",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:133.0) Gecko/20100101 Firefox/133.0",
@@ -475,8 +780,9 @@ def getNotifications(page=1, pageSize= 50):
         return {"error": str(e)}
     
 
+@tracing.traced("arena.user_search")
 def searchUser(username):
-    url = f"https://api.starsarena.com/user/search?searchString={username}"
+    url = f"{ARENA_API_BASE}/user/search?searchString={username}"
     headers = {
         "Authorization": f"Bearer {JWT}",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:133.0) Gecko/20100101 Firefox/133.0",
@@ -492,8 +798,9 @@ def searchUser(username):
         return {"error": str(e)}
 
 
+@tracing.traced("arena.user_posts")
 def getUserPosts(userID, page=1, pageSize= 50):
-    url = f"https://api.starsarena.com/threads/feed/user?userId={userID}&page={page}&pageSize={pageSize}"
+    url = f"{ARENA_API_BASE}/threads/feed/user?userId={userID}&page={page}&pageSize={pageSize}"
     headers = {
         "Authorization": f"Bearer {JWT}",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:133.0) Gecko/20100101 Firefox/133.0",
@@ -523,8 +830,9 @@ def extract_post_id_from_url(url_or_id):
         pass
     # Last fallback: return original, let API fail loudly
     return s
+@tracing.traced("arena.get_thread")
 def getSinglePost(postID):
-    url = f"https://api.starsarena.com/threads?threadId={postID}"
+    url = f"{ARENA_API_BASE}/threads?threadId={postID}"
     headers = {
         "Authorization": f"Bearer {JWT}",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:133.0) Gecko/20100101 Firefox/133.0",
@@ -559,8 +867,9 @@ def getSinglePost(postID):
 
 
 
+@tracing.traced("arena.reply")
 def replyToPost(postID, userID, content, imageURL = None):
-    url = "https://api.starsarena.com/threads/answer"
+    url = f"{ARENA_API_BASE}/threads/answer"
     payload = {"content":content,"threadId":postID,"files":[],
                "userId": userID
                }
@@ -610,53 +919,57 @@ def _normalize_api_images(images):
     return out
 
 
-def _existing_image_source_urls(thread_id):
-    res = supabase.table("sa_images") \
-        .select("source_url") \
-        .eq("thread_id", thread_id) \
-        .execute()
-    return {r["source_url"] for r in (res.data or []) if r.get("source_url")}
+def _existing_image_source_urls(thread_ids):
+    """{(thread_id, source_url)} already in sa_images for these threads (one query)."""
+    thread_ids = list({t for t in thread_ids if t})
+    if not thread_ids:
+        return set()
+    res = repo.select("sa_images", "thread_id, source_url", in_={"thread_id": thread_ids})
+    return {(r["thread_id"], r["source_url"]) for r in res.data if r.get("source_url")}
 
 
-def _upsert_images_for_thread(thread_id, images_payload):
+def _upsert_images_for_threads(images_by_thread):
     """
-    Insert any missing images for a thread into sa_images (no analysis here).
-    Dedup by (thread_id, source_url).
+    Insert any missing images for several threads into sa_images (no analysis here).
+    `images_by_thread` maps thread_id -> raw API images payload. Dedup by (thread_id, source_url).
     """
-    imgs = _normalize_api_images(images_payload)
-    if not imgs:
+    normalized = {tid: _normalize_api_images(p) for tid, p in images_by_thread.items() if tid}
+    normalized = {tid: imgs for tid, imgs in normalized.items() if imgs}
+    if not normalized:
         return 0
 
-    existing = _existing_image_source_urls(thread_id)
+    existing = _existing_image_source_urls(normalized.keys())
     rows = []
-    for im in imgs:
-        src = im.get("source_url")
-        if not src or src in existing:
-            continue
-        rows.append({
-            # id is identity; omit it so the DB assigns one
-            "thread_id": thread_id,
-            "source_url": src,
-            "storage_path": None,               # fill later if you mirror to GCS
-            "mime": im.get("mime"),
-            "width": im.get("width"),
-            "height": im.get("height"),
-            "is_gif": im.get("is_gif", False),
-        })
+    for thread_id, imgs in normalized.items():
+        for im in imgs:
+            src = im.get("source_url")
+            if not src or (thread_id, src) in existing:
+                continue
+            existing.add((thread_id, src))  # same URL twice in one payload
+            rows.append({
+                # id is identity; omit it so the DB assigns one
+                "thread_id": thread_id,
+                "source_url": src,
+                "storage_path": None,               # fill later if you mirror to GCS
+                "mime": im.get("mime"),
+                "width": im.get("width"),
+                "height": im.get("height"),
+                "is_gif": im.get("is_gif", False),
+                "sha256": sha256_of_url(src),       # URL fingerprint (not bytes), same as ingest
+            })
 
     if not rows:
-        logger.info("no new images to insert | thread_id=%s", thread_id)
+        logger.info("no new images to insert | threads=%s", len(normalized))
         return 0
 
-    resp = supabase.table("sa_images").insert(rows).execute()
-    # optional debug
-    inserted = len(rows) if getattr(resp, "data", None) is not None else 0
+    inserted = repo.insert("sa_images", rows)
     if inserted:
-        logger.info("inserted images | count=%s | thread_id=%s", inserted, thread_id)
+        logger.info("inserted images | count=%s | threads=%s", inserted, len(normalized))
     return inserted
 
+@tracing.traced("arena.trending_feed")
 def getTrendingFeed():
-    url = "https://api.starsarena.com/threads/feed/trendingPosts?page=1&pageSize=20"
+    url = f"{ARENA_API_BASE}/threads/feed/trendingPosts?page=1&pageSize=20"
     headers = {
         "Authorization": f"Bearer {JWT}",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:133.0) Gecko/20100101 Firefox/133.0",
@@ -672,8 +985,9 @@ def getTrendingFeed():
         return {"error": str(e)}
     
 
+@tracing.traced("arena.following_feed")
 def getFollowingFeed():
-    url = "https://api.starsarena.com/threads/feed/my?page=1&pageSize=20"
+    url = f"{ARENA_API_BASE}/threads/feed/my?page=1&pageSize=20"
     headers = {
         "Authorization": f"Bearer {JWT}",
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:133.0) Gecko/20100101 Firefox/133.0",
@@ -693,44 +1007,52 @@ def getFollowingFeed():
 
 
 def _max_created_at_for_user(user_id):
-    res = supabase.table("sa_threads") \
-        .select("created_at", count="exact") \
-        .eq("user_id", user_id) \
-        .order("created_at", desc=True) \
-        .limit(1).execute()
-    rows = (res.data or []) if hasattr(res, "data") else []
+    res = repo.select("sa_threads", "created_at", eq={"user_id": user_id}, order="created_at", desc=True,
+                      limit=1, count=True)
+    rows = res.data
     ts = rows[0]["created_at"] if rows else None
     count = res.count or 0
     return ts, count
 
 def _upsert_threads_from_api_payload(user_id, payload):
-    threads = payload.get("threads") or []
+    """
+    Write one page of API threads: parents (deduped) -> threads -> missing images.
+    A constant number of round trips per page regardless of how many threads it holds.
+    """
+    threads = [t for t in (payload.get("threads") or []) if t and t.get("id")]
     logger.info("upsert threads payload | user_id=%s | threads=%s", user_id, len(threads))
-    rows = []
+    if not threads:
+        return 0
+
+    # Make sure FK parents exist (the same author/community repeats on every thread of a page)
+    # StarsArena feed shape typically has these fields:
+    users, communities = {}, {}
     for t in threads:
-        tid = t.get("id")
-        if not tid:
-            continue
-
-        # Make sure FK parents exist
-        # StarsArena feed shape typically has these fields:
-        user_handle = (t.get("userHandle") or "").lstrip("@")
-        user_name   = (t.get("user") or {}).get("name")
-        user_pic    = (t.get("user") or {}).get("profileImage") or (t.get("user") or {}).get("picture")
-        user_addr   = (t.get("user") or {}).get("address")
-        _ensure_user_row(user_id, handle=user_handle, name=user_name, picture=user_pic, address=user_addr)
-
-        comm_id   = t.get("communityId")
-        comm_name = t.get("communityName")
+        u = t.get("user") or {}
+        row = users.setdefault(user_id, {"id": user_id})
+        handle = (t.get("userHandle") or "").lstrip("@")
+        if handle:
+            row["handle"] = handle
+        for key, val in (("name", u.get("name")),
+                         ("picture", u.get("profileImage") or u.get("picture")),
+                         ("address", u.get("address"))):
+            if val is not None:
+                row[key] = val
+        comm_id = t.get("communityId")
         if comm_id:
-            _ensure_community_row(comm_id, name=comm_name)
-
+            crow = communities.setdefault(comm_id, {"id": comm_id})
+            if t.get("communityName") is not None:
+                crow["name"] = t.get("communityName")
+    if user_id:
+        _bulk_upsert("sa_users", list(users.values()))
+    _bulk_upsert("sa_communities", list(communities.values()))
 
-        
+    rows = []
+    for t in threads:
         rows.append({
-            "id": tid,
+            "id": t.get("id"),
             "user_id": user_id,
-            "community_id": comm_id,
+            "community_id": t.get("communityId"),
             "content_html": t.get("content") or None,
             "content_text": clean_text(t.get("content") or ""),
             "thread_type": t.get("threadType"),
@@ -755,36 +1077,35 @@ def _upsert_threads_from_api_payload(user_id, payload):
             "tip_count": t.get("tipCount"),
         })
 
-    if not rows:
-        return 0
+    written = repo.upsert("sa_threads", rows, on_conflict="id")
 
-    resp = supabase.table("sa_threads").upsert(rows, on_conflict="id").execute()
+    rollups.refresh_for_threads(r["id"] for r in rows)
 
+    try:
+        _upsert_images_for_threads({
+            t["id"]: t.get("images") or t.get("image") or t.get("media") or [] for t in threads
+        })
+    except Exception:
+        logger.exception("image upsert failed | user_id=%s | threads=%s", user_id, len(threads))
 
+    logger.info("upserted thread rows | count=%s", written)
+    return written
 
 
-    for t in threads:
-        tid = t.get("id")
-        images_payload = t.get("images") or t.get("image") or t.get("media") or []
-        try:
-            _upsert_images_for_thread(tid, images_payload)
-        except Exception as e:
-            logger.exception("image upsert failed | thread_id=%s", tid)
-    
-    # Debug surface: some clients don’t raise on error; print data back
-    if hasattr(resp, "error") and resp.error:
-        logger.error("upsert sa_threads error | %s", resp.error)
-    else:
-        # Optionally print how many we tried
-        logger.info("upserted thread rows | count=%s", len(rows))
-    return len(rows)
+def _parse_api_ts(s):
+    return datetime.fromisoformat(s.replace("Z", "")).replace(tzinfo=timezone.utc)
+
 
 def ensure_threads_for_user(user_id, freshness_minutes = 10, max_fetch = 200):
+    """
+    Sync a user's recent threads into sa_threads. The next page is fetched while the current
+    one is written, and only when it can still contain rows we want.
+    """
     max_ts, count = _max_created_at_for_user(user_id)
     needs_refresh = True
     if max_ts:
         if isinstance(max_ts, str):
-            max_ts = datetime.fromisoformat(max_ts.replace("Z","")).replace(tzinfo=timezone.utc)
+            max_ts = _parse_api_ts(max_ts)
         age = datetime.now(timezone.utc) - max_ts
         needs_refresh = age.total_seconds()/60.0 > freshness_minutes
 
@@ -793,149 +1114,108 @@ def ensure_threads_for_user(user_id, freshness_minutes = 10, max_fetch = 200):
     #     return 0
 
     page, pageSize, inserted = 1, 50, 0
-    while inserted < max_fetch:
-        logger.info(
-            "fetching user posts | user_id=%s | page=%s | max_ts=%s | inserted=%s",
-            user_id,
-            page,
-            max_ts,
-            inserted,
-        )
-        payload = getUserPosts(userID=user_id, page=page, pageSize=pageSize)
-        threads = (payload or {}).get("threads") or []
-        if not threads:
-            break
-
-        if max_ts:
-            newer = [t for t in threads if t.get("createdAt") and
-                     datetime.fromisoformat(t["createdAt"].replace("Z","")).replace(tzinfo=timezone.utc) > max_ts]
-            if not newer and page > 1:
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(getUserPosts, userID=user_id, page=page, pageSize=pageSize)
+        while pending is not None:
+            logger.info(
+                "fetching user posts | user_id=%s | page=%s | max_ts=%s | inserted=%s",
+                user_id,
+                page,
+                max_ts,
+                inserted,
+            )
+            payload = pending.result()
+            pending = None
+            threads = (payload or {}).get("threads") or []
+            if not threads:
                 break
-            count_added = _upsert_threads_from_api_payload(user_id, {"threads": newer or threads})
-        else:
-            count_added = _upsert_threads_from_api_payload(user_id, {"threads": threads})
 
-        inserted += count_added
-        if len(threads) < pageSize:
-            break
-        page += 1
+            newer = threads
+            if max_ts:
+                newer = [t for t in threads if t.get("createdAt") and _parse_api_ts(t["createdAt"]) > max_ts]
+                if not newer and page > 1:
+                    break
+
+            # Older pages can only hold older posts: prefetch only while this page was all new.
+            more = (
+                len(threads) == pageSize
+                and len(newer) == len(threads)
+                and inserted + len(newer) < max_fetch
+            )
+            if more:
+                pending = pool.submit(getUserPosts, userID=user_id, page=page + 1, pageSize=pageSize)
+
+            inserted += _upsert_threads_from_api_payload(user_id, {"threads": newer or threads})
+            page += 1
+    metrics.observe("sync.user_threads", time.perf_counter() - t0)
 
     # Verify rows exist:
-    check = supabase.table("sa_threads").select("id", count="exact").eq("user_id", user_id).limit(1).execute()
-    total = getattr(check, "count", None) or 0
+    check = repo.select("sa_threads", "id", eq={"user_id": user_id}, limit=1, count=True)
+    total = check.count or 0
     if total == 0:
         logger.warning("no rows in sa_threads after sync | user_id=%s", user_id)
     else:
-        logger.info("sa_threads rows | user_id=%s | count=%s", user_id, total)
+        logger.info("sa_threads rows | user_id=%s | count=%s | pages=%s", user_id, total, page - 1)
     return inserted
 
-def _ensure_user_row(user_id, handle = None, name = None, picture = None, address = None):
-    if not user_id:
-        return
-    row = {"id": user_id}
-    if handle:
-        row["handle"] = handle.lstrip("@")
-    if name is not None:
-        row["name"] = name
-    if picture is not None:
-        row["picture"] = picture
-    if address is not None:
-        row["address"] = address
-    supabase.table("sa_users").upsert(row, on_conflict="id").execute()
-
-def _ensure_community_row(comm_id, name = None):
-    if not comm_id:
-        return
-    supabase.table("sa_communities").upsert(
-        {"id": comm_id, "name": name},
-        on_conflict="id"
-    ).execute()
+
+def _bulk_upsert(table, rows):
+    """Upsert rows by id. PostgREST wants uniform keys per request, so rows are grouped by key set."""
+    groups = {}
+    for r in rows:
+        if r.get("id"):
+            groups.setdefault(tuple(sorted(r)), []).append(r)
+    for group in groups.values():
+        repo.upsert(table, group, on_conflict="id")
 
 
 def uploadImage(imageFileDirectory):
+    """Upload an image file from disk. Thin wrapper over uploadImageBytes."""
     try:
-        file_name = imageFileDirectory.split("/")[-1]
-        file_type = "image/png"
-        encoded_file_type = urllib.parse.quote(file_type, safe='')
-        encoded_file_name = urllib.parse.quote(file_name, safe='')
-
-        headers = {
-            "Authorization": f"Bearer {JWT}",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:133.0) Gecko/20100101 Firefox/133.0",
-            "Referrer": "https://arena.social",
-            "Content-Type": "application/json",
-        }
-
-        url = f"https://api.starsarena.com/uploads/getUploadPolicy?fileType={encoded_file_type}&fileName={encoded_file_name}"
-        response = requests.get(url, headers=headers)
-
-        if response.status_code != 200:
-            return {"error": f"Failed to fetch upload policy: {response.status_code}"}
-        upload_policy = response.json()["uploadPolicy"]
-
+        with open(imageFileDirectory, "rb") as file:
+            data = file.read()
+    except OSError as e:
+        logger.exception("uploadImage read failed | path=%s", imageFileDirectory)
+        return {"success": False, "error": str(e), "url": None}
+    return uploadImageBytes(data, os.path.basename(imageFileDirectory))
 
-        upload_url = "https://storage.googleapis.com/starsarena-s3-01/"
 
-        headers2 = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:133.0) Gecko/20100101 Firefox/133.0",
-            "Referrer": "https://arena.social",
-        }
-
-        # Open the file once and reuse it
-        with open(imageFileDirectory, "rb") as file:
-            files = {"file": file}
-            upload_policy["Content-Type"] = file_type
-            #remove enctype from the policy
-            upload_policy.pop("enctype")
-            upload_policy.pop("url")
-        
-            upload_response = requests.post(upload_url, files=files, data=upload_policy, headers=headers2)
-
-        if upload_response.status_code == 204:
-            return {
-                "success": True,
-                "url": f"https://static.starsarena.com/{upload_policy['key']}",
-                "error": None
-            }
-        else:
-            return {
-                "success": False,
-                "error": f"Failed to upload image: {upload_response.status_code}",
-                'url': None,
-                "response": upload_response.text
-            }
-    except requests.exceptions.RequestException as e:
-        logger.exception("uploadImage failed")
-        return {
-            "success": False,
-            "error": str(e),
-            'url': None
-        }
+def uploadImageBytes(data, file_name, file_type = "image/png"):
+    """
+    Upload in-memory image bytes (no temp file needed).
+    Returns {"success": bool, "url": str|None, "error": str|None, "seconds": float}.
+    See uploader.py for pooling, policy reuse/prefetch and retries.
+    """
+    return upload_bytes(data, file_name, file_type=file_type)
     
 
 
+@tracing.traced("arena.user_stats")
 def getStatsOfArena_structured(username,
                                sync_posts=True,
                                freshness_minutes= 10,
                                min_rows = 40,
                                max_fetch = 100):
     """
-    Fetch profile + share stats from StarsArena for `username` and (optionally) ensure
-    their posts are synced into sa_threads so later tools can read from DB.
+    Fetch profile + share stats from StarsArena for `username` and (optionally) ask the
+    background scheduler to keep their posts in sa_threads fresh (see sync_scheduler).
+    `freshness_minutes`/`min_rows`/`max_fetch` are kept for compatibility; the scheduler's
+    SYNC_* settings apply.
 
     Returns:
       {
         "success": True,
         "profile": {..., "user_id": "...", "handle": "...", "display": "@handle"},
         "shares": {...},
-        "sync": {"attempted": True/False, "inserted": int}   # only when sync_posts=True
+        "sync": {"attempted": False, "inserted": 0, "queued": True, ...}  # scheduler status when sync_posts=True
       }
     """
     try:
         handle = (username or "").lstrip("@").strip()
 
         # --- Profile ---
-        userInfoURL = f"https://api.starsarena.com/user/handle?handle={handle}"
+        userInfoURL = f"{ARENA_API_BASE}/user/handle?handle={handle}"
         headers = {
             "Authorization": f"Bearer {JWT}",
             "User-Agent": "Mozilla/5.0",
@@ -966,7 +1246,7 @@ def getStatsOfArena_structured(username,
             profile["display"] = f"@{profile['handle']}"
 
         # --- Shares / trading stats ---
-        statURL = f"https://api.starsarena.com/shares/stats?userId={profile['user_id']}"
+        statURL = f"{ARENA_API_BASE}/shares/stats?userId={profile['user_id']}"
         s = requests.get(statURL, headers=headers, timeout=15)
         s.raise_for_status()
         sj = s.json()
@@ -981,21 +1261,12 @@ def getStatsOfArena_structured(username,
             "referrals_earned_avax": round(f((sj.get("stats") or {}).get("referralsEarned")) / 1e18, 3),
         }
 
-        # --- Optional: incremental sync of posts into sa_threads ---
+        # --- Optional: background sync of posts into sa_threads (never inline) ---
         sync_info = {"attempted": False, "inserted": 0}
         if sync_posts:
-            sync_info["attempted"] = True
-            try:
-                # You already have ensure_threads_for_user(...) from earlier step
-                inserted = ensure_threads_for_user(
-                    user_id=profile["user_id"],
-                    freshness_minutes=freshness_minutes,
-                    max_fetch=max_fetch
-                )
-                sync_info["inserted"] = int(inserted or 0)
-            except Exception:
-                # Don't fail stats if sync hiccups; the caller can still use existing DB rows
-                pass
+            sync_scheduler.request_sync(profile["user_id"])
+            sync_info = {"attempted": False, "inserted": 0, "queued": True,
+                         **sync_scheduler.status(profile["user_id"])}
 
         return {
             "success": True,
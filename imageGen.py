@@ -1,72 +1,306 @@
 # imageGen.py
-import os, io, tempfile, pathlib, time
-from typing import List, Optional, Dict, Any
+import os, io, time, threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Optional, Dict, Any, Tuple
 from PIL import Image
 from google import genai
 from google.genai import types
 from google.genai import errors as genai_errors
+from ratelimit import TokenBucket, KeyedSemaphore, parse_limits
+import tracing
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
 
 _API_KEY = os.getenv("GENAI_API_KEY") or os.getenv("GOOGLE_API_KEY") or os.getenv("GOOGLE_GENAI_API_KEY")
 if not _API_KEY:
     raise RuntimeError("Set GENAI_API_KEY (or GOOGLE_API_KEY) in environment.")
 
-_CLIENT = genai.Client(api_key=_API_KEY)
+# GENAI_BASE_URL points the client at another endpoint (e.g. benchmarks/mock_services.py)
+_BASE_URL = os.getenv("GENAI_BASE_URL")
+_CLIENT = genai.Client(
+    api_key=_API_KEY,
+    http_options=types.HttpOptions(base_url=_BASE_URL) if _BASE_URL else None,
+)
 
 # Primary and fallback models (tweak via env if you want)
 _MODEL_PRIMARY  = os.getenv("GENAI_IMAGE_MODEL", "gemini-2.5-flash-image")
 _MODEL_FALLBACK = os.getenv("GENAI_IMAGE_MODEL_FALLBACK", "gemini-2.0-flash-exp")  # safe-ish fallback
-_MAX_ATTEMPTS   = int(os.getenv("GENAI_RETRY_ATTEMPTS", "3"))
 _BASE_SLEEP     = float(os.getenv("GENAI_RETRY_BASE_SLEEP", "1.5"))
 
-_TEMP_DIR = pathlib.Path(os.getenv("TEMP_IMG_DIR", "./temp_images"))
-_TEMP_DIR.mkdir(parents=True, exist_ok=True)
+# One retry budget for the whole job (all models, all attempts), plus a wall-clock cap
+_RETRY_BUDGET   = int(os.getenv("GENAI_RETRY_BUDGET", os.getenv("GENAI_RETRY_ATTEMPTS", "4")))
+_DEADLINE_S     = float(os.getenv("GENAI_DEADLINE_SECONDS", "120"))
+
+# Hedging: if the primary hasn't answered after ~its p95 latency, race the fallback
+_HEDGE_ENABLED       = os.getenv("GENAI_HEDGE", "1").lower() not in ("0", "false", "no")
+_HEDGE_DEFAULT_DELAY = float(os.getenv("GENAI_HEDGE_DEFAULT_DELAY", "25"))
+_HEDGE_MIN_SAMPLES   = 5
+
+# Circuit breaker: skip a model for a cooldown after N consecutive 5xx errors
+_BREAKER_THRESHOLD = int(os.getenv("GENAI_BREAKER_THRESHOLD", "3"))
+_BREAKER_COOLDOWN  = float(os.getenv("GENAI_BREAKER_COOLDOWN", "60"))
+
+# Concurrency cap per model (shared by all image workers) + Gemini quota bucket
+_MODEL_CONCURRENCY = int(os.getenv("GENAI_MODEL_CONCURRENCY", "2"))
+_MODEL_CONCURRENCY_MAP = parse_limits(os.getenv("GENAI_MODEL_CONCURRENCY_MAP", ""))  # "model=N,model2=M"
+_RPM   = float(os.getenv("GENAI_RPM", "30"))    # <= 0 disables rate limiting
+_BURST = float(os.getenv("GENAI_BURST", "5"))
+
+_MODEL_SLOTS = KeyedSemaphore(_MODEL_CONCURRENCY, _MODEL_CONCURRENCY_MAP)
+_RATE = TokenBucket.per_minute(_RPM, burst=_BURST)
+
+# Reference images: downscaled to the model's effective input size and encoded
+# once, then reused across jobs (the GLADIUS anchor is prepared at import).
+_REF_MAX_SIDE   = int(os.getenv("GENAI_REF_MAX_SIDE", "1024"))
+_REF_QUALITY    = int(os.getenv("GENAI_REF_JPEG_QUALITY", "90"))
+_REF_CACHE_SIZE = int(os.getenv("GENAI_REF_CACHE_SIZE", "64"))
+_GLADIUS_PATH   = os.getenv("GLADIUS_IMAGE_PATH", "GLADIUS.jpg")
+
+_ref_cache: "OrderedDict[Tuple[str, int, int], types.Part]" = OrderedDict()
+_ref_lock = threading.Lock()
 
 def _load_image_as_pil(path: str) -> Image.Image:
     img = Image.open(path).convert("RGB")  # normalize
     img.load()
     return img
 
-def _save_inline_image(data: bytes) -> str:
-    b = io.BytesIO(data)
-    img = Image.open(b).convert("RGB")
+def _prepare_reference(path: str) -> types.Part:
+    """Decode, downscale (longest side <= _REF_MAX_SIDE) and JPEG-encode a reference image."""
+    img = _load_image_as_pil(path)
+    if max(img.size) > _REF_MAX_SIDE:
+        img.thumbnail((_REF_MAX_SIDE, _REF_MAX_SIDE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=_REF_QUALITY)
+    return types.Part.from_bytes(data=buf.getvalue(), mime_type="image/jpeg")
+
+def _reference_part(path: str) -> types.Part:
+    """Prepared reference for `path`, cached by (path, mtime, size) so edits invalidate it."""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    if key[0] == _GLADIUS_ABS and _GLADIUS_REF is not None:
+        return _GLADIUS_REF
+    with _ref_lock:
+        part = _ref_cache.get(key)
+        if part is not None:
+            _ref_cache.move_to_end(key)
+            return part
+    part = _prepare_reference(path)
+    with _ref_lock:
+        _ref_cache[key] = part
+        while len(_ref_cache) > _REF_CACHE_SIZE:
+            _ref_cache.popitem(last=False)
+    return part
+
+_GLADIUS_ABS = os.path.abspath(_GLADIUS_PATH)
+_GLADIUS_REF: Optional[types.Part] = None
+try:
+    _GLADIUS_REF = _prepare_reference(_GLADIUS_PATH)
+except FileNotFoundError:
+    pass
+
+_PASSTHROUGH_MIMES = {"image/png", "image/jpeg", "image/webp"}
+
+def _inline_image(data: bytes, mime: Optional[str]) -> Dict[str, Any]:
+    """
+    Keep the model's bytes as-is when they're already an uploadable format;
+    only re-encode (to PNG) when the mime type is missing or unusual.
+    """
+    mime = (mime or "").lower()
+    if mime in _PASSTHROUGH_MIMES:
+        return {"data": data, "mime": mime}
+    img = Image.open(io.BytesIO(data)).convert("RGB")
     img.load()
-    out_path = _TEMP_DIR / f"genai_{os.urandom(4).hex()}.png"
-    img.save(out_path, format="PNG")
-    return str(out_path.resolve())
-
-def _gen_once(model: str, contents: list) -> Dict[str, Any]:
-    resp = _CLIENT.models.generate_content(
-        model=model,
-        contents=contents,
-        config=types.GenerateContentConfig(max_output_tokens=2048),
-    )
-    # Extract any returned image parts; save as PNG
-    files: List[str] = []
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    return {"data": out.getvalue(), "mime": "image/png"}
+
+def _gen_once(model: str, contents: list, timing: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """One generate_content call; the caller has already taken a _RATE token. `timing["seconds"]`
+    gets the call alone (not the wait for a model slot) so latency stats reflect the model."""
+    with _MODEL_SLOTS.limit(model):
+        t0 = time.perf_counter()
+        resp = _CLIENT.models.generate_content(
+            model=model,
+            contents=contents,
+            config=types.GenerateContentConfig(max_output_tokens=2048),
+        )
+        if timing is not None:
+            timing["seconds"] = time.perf_counter() - t0
+    # Extract any returned image parts (kept in memory; no temp files)
+    images: List[Dict[str, Any]] = []
     text_parts: List[str] = []
     cand = (resp.candidates or [None])[0]
     if not cand:
-        return {"files": [], "text": "no candidates"}
+        return {"images": [], "text": "no candidates"}
     for part in cand.content.parts:
         if getattr(part, "inline_data", None) and part.inline_data.data:
             try:
-                path = _save_inline_image(part.inline_data.data)
-                files.append(path)
+                images.append(_inline_image(part.inline_data.data, part.inline_data.mime_type))
             except Exception:
                 # ignore malformed
                 pass
         elif getattr(part, "text", None):
             text_parts.append(part.text)
-    return {"files": files, "text": "\n".join(text_parts) if text_parts else ""}
+    return {"images": images, "text": "\n".join(text_parts) if text_parts else ""}
+
+# -------------------------
+# Latency-aware model selection
+# -------------------------
+class RetryBudget:
+    """Attempts + deadline shared by every generation call made for one job."""
+
+    def __init__(self, attempts: int = _RETRY_BUDGET, deadline_s: float = _DEADLINE_S):
+        self.attempts_left = max(1, int(attempts))
+        self.deadline = time.monotonic() + deadline_s
+        self._lock = threading.Lock()
+
+    def time_left(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def take(self) -> bool:
+        with self._lock:
+            if self.attempts_left <= 0 or self.time_left() <= 0:
+                return False
+            self.attempts_left -= 1
+            return True
+
+    def exhausted(self) -> bool:
+        return self.attempts_left <= 0 or self.time_left() <= 0
+
+
+class _CircuitBreaker:
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        # after the cooldown we let traffic through again (half-open); one more 5xx re-opens it
+        return time.monotonic() >= self.open_until
+
+    def record(self, server_error: bool) -> None:
+        with self._lock:
+            if not server_error:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= _BREAKER_THRESHOLD:
+                self.open_until = time.monotonic() + _BREAKER_COOLDOWN
+                self.failures = _BREAKER_THRESHOLD - 1  # half-open: a single failure re-trips
+
+
+_BREAKERS: Dict[str, _CircuitBreaker] = {}
+_LATENCIES: Dict[str, deque] = {}
+_stats_lock = threading.Lock()
+_HEDGE_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("GENAI_HEDGE_THREADS", "8")),
+                                 thread_name_prefix="genai-call")
+
+def _breaker(model: str) -> _CircuitBreaker:
+    with _stats_lock:
+        return _BREAKERS.setdefault(model, _CircuitBreaker())
+
+def _record_latency(model: str, seconds: float) -> None:
+    with _stats_lock:
+        _LATENCIES.setdefault(model, deque(maxlen=200)).append(seconds)
+
+def _hedge_delay(model: str) -> float:
+    with _stats_lock:
+        vals = sorted(_LATENCIES.get(model) or ())
+    if len(vals) < _HEDGE_MIN_SAMPLES:
+        return _HEDGE_DEFAULT_DELAY
+    return vals[int(0.95 * (len(vals) - 1))]
+
+def _attempt(model: str, contents: list) -> Dict[str, Any]:
+    """One generation call. Never raises; classifies the outcome for the retry loop."""
+    with tracing.span("gemini.generate", model=model) as sp:
+        out = _attempt_once(model, contents)
+        sp.set(outcome=_outcome(out))
+    return out
+
+def _attempt_once(model: str, contents: list) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    timing: Dict[str, float] = {}
+    out: Dict[str, Any] = {"model": model, "result": None, "error": None, "retryable": False}
+    try:
+        result = _gen_once(model, contents, timing)
+        if result.get("images") or result.get("text"):
+            out["result"] = result
+        else:
+            out["error"] = RuntimeError("Empty response (no images, no text)")
+            out["retryable"] = True
+        _breaker(model).record(server_error=False)
+    except genai_errors.ServerError as e:
+        out["error"], out["retryable"] = e, True
+        _breaker(model).record(server_error=True)
+    except Exception as e:
+        # Non-server errors (validation, etc.)—not worth repeating on this model
+        out["error"] = e
+    out["seconds"] = time.perf_counter() - t0
+    if out["result"] is not None and "seconds" in timing:
+        _record_latency(model, timing["seconds"])
+    return out
+
+def _outcome(a: Dict[str, Any]) -> str:
+    if a["result"] is not None:
+        return "ok"
+    return type(a["error"]).__name__
+
+def _run(models: List[str], contents: list, budget: RetryBudget, attempts: List[Dict[str, Any]]):
+    """
+    Run models[0]; if a second model is given and models[0] is still running after its
+    p95 latency, start the hedge and take whichever succeeds first.
+
+    Quota tokens are taken here, before a call is handed to _HEDGE_POOL, so a job waiting on
+    the Gemini RPM holds neither a pool thread nor a model slot, and the hedge timer only
+    starts once the primary can actually run. The hedge goes out only if a token is free now.
+    """
+    primary = models[0]
+    t0 = time.perf_counter()
+    if not _RATE.acquire(timeout=budget.time_left()):
+        err = TimeoutError("deadline passed waiting for a Gemini rate-limit token")
+        a = {"model": primary, "result": None, "error": err, "retryable": False,
+             "seconds": time.perf_counter() - t0}
+        attempts.append({"model": primary, "seconds": round(a["seconds"], 3), "outcome": _outcome(a)})
+        return None, [a]
+    fut = _HEDGE_POOL.submit(tracing.bind(_attempt), primary, contents)
+    pending = {fut}
+    hedge_model = models[1] if len(models) > 1 else None
+    if hedge_model:
+        done, pending = wait(pending, timeout=min(_hedge_delay(primary), budget.time_left()))
+        if not done and not budget.exhausted() and _RATE.try_acquire() and budget.take():
+            logger.info("hedging image generation | primary=%s | fallback=%s", primary, hedge_model)
+            pending.add(_HEDGE_POOL.submit(tracing.bind(_attempt), hedge_model, contents))
+        pending |= done
+
+    results: List[Dict[str, Any]] = []
+    while pending:
+        done, pending = wait(pending, timeout=budget.time_left() or 0.001, return_when=FIRST_COMPLETED)
+        if not done:
+            break  # deadline hit; stragglers finish in the background and are ignored
+        for f in done:
+            a = f.result()
+            attempts.append({"model": a["model"], "seconds": round(a["seconds"], 3), "outcome": _outcome(a)})
+            results.append(a)
+            if a["result"] is not None:
+                return a, results
+    return None, results
 
 def createImage(
     prompt: str,
     input_paths: Optional[List[str]] = None,
     gladius_path: Optional[str] = None,
     max_images: int = 1,
+    budget: Optional[RetryBudget] = None,
 ) -> Dict[str, Any]:
     """
-    Returns: {"files": [<absolute_path_to_png>, ...]}  (or {"files": [], "text": "..."} on text-only)
-    Retries transient 5xx errors and falls back to a secondary model if needed.
+    Returns: {"images": [{"data": <bytes>, "mime": "image/png"}, ...], "model": str,
+              "attempts": [{"model", "seconds", "outcome"}, ...]}
+             (or {"images": [], "text": "..."} on text-only / failure)
+    Spends one RetryBudget across primary + fallback: skips the primary while its circuit
+    breaker is open, hedges with the fallback after the primary's p95 latency, and backs
+    off between rounds on transient 5xx errors.
     """
     if not prompt or not isinstance(prompt, str):
         return {"error": "empty prompt"}
@@ -82,49 +316,59 @@ def createImage(
             if p and os.path.exists(p):
                 paths.append(p)
 
-    # Load up to 3 refs
+    # Load up to 3 refs (prepared + cached)
     for p in paths[:3]:
         try:
-            contents.append(_load_image_as_pil(p))
+            contents.append(_reference_part(p))
         except Exception:
             pass
 
-    # Try primary with retries
+    budget = budget or RetryBudget()
+    attempts: List[Dict[str, Any]] = []
     last_err = None
-    model_used = _MODEL_PRIMARY
-    for attempt in range(1, _MAX_ATTEMPTS + 1):
-        try:
-            result = _gen_once(model_used, contents)
-            if result.get("files"):
+    primary_usable = True
+    has_fallback = bool(_MODEL_FALLBACK and _MODEL_FALLBACK != _MODEL_PRIMARY)
+    tried = set()
+    round_no = 0
+    while budget.take():
+        round_no += 1
+        if primary_usable and _breaker(_MODEL_PRIMARY).allow():
+            models = [_MODEL_PRIMARY]
+            if has_fallback and _HEDGE_ENABLED and _breaker(_MODEL_FALLBACK).allow():
+                models.append(_MODEL_FALLBACK)
+        elif has_fallback:
+            models = [_MODEL_FALLBACK]
+        else:
+            models = [_MODEL_PRIMARY]
+
+        winner, results = _run(models, contents, budget, attempts)
+        if winner is not None:
+            result = winner["result"]
+            if result.get("images"):
                 # cap #images
-                result["files"] = result["files"][:max_images]
-                return result
+                result["images"] = result["images"][:max_images]
             # If no image but text, return as-is (policy block or harmless text-only)
-            if result.get("text"):
-                return result
-            # else treat as retryable empty
-            raise RuntimeError("Empty response (no files, no text)")
-        except genai_errors.ServerError as e:
-            # Retry only on 5xx
-            last_err = e
-            sleep_s = min(_BASE_SLEEP * (2 ** (attempt - 1)), 10.0)
-            time.sleep(sleep_s)
-        except Exception as e:
-            # Non-server errors (validation, etc.)—don't spin forever
-            last_err = e
+            result["model"] = winner["model"]
+            result["attempts"] = attempts
+            return result
+
+        for a in results:
+            tried.add(a["model"])
+            last_err = a["error"]
+            if a["model"] == _MODEL_PRIMARY and not a["retryable"]:
+                primary_usable = False  # validation-type error: don't repeat it on the primary
+        if not results or budget.exhausted():
             break
+        if not any(a["retryable"] for a in results):
+            # nothing worth repeating; only go on if the fallback hasn't been tried yet
+            if has_fallback and _MODEL_FALLBACK not in tried:
+                continue
+            break
+        sleep_s = min(_BASE_SLEEP * (2 ** (round_no - 1)), 10.0, budget.time_left())
+        time.sleep(sleep_s)
 
-    # Fallback model once if primary failed
-    if _MODEL_FALLBACK and _MODEL_FALLBACK != model_used:
-        model_used = _MODEL_FALLBACK
-        try:
-            result = _gen_once(model_used, contents)
-            if result.get("files"):
-                result["files"] = result["files"][:max_images]
-                return result
-            if result.get("text"):
-                return result
-        except Exception as e:
-            last_err = e
-
-    return {"files": [], "text": f"gen error: {type(last_err).__name__}: {last_err}"}
+    return {
+        "images": [],
+        "text": f"gen error: {type(last_err).__name__}: {last_err}",
+        "attempts": attempts,
+    }
@@ -0,0 +1,109 @@
+# image_embeddings.py
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, List
+from db import repo
+from ingest import embed_texts
+import metrics
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+# Embeds (post text + caption + OCR) for every analyzed image into sa_embeddings,
+# walking sa_image_analysis by (analyzed_at, image_id) from a stored watermark.
+# analyzed_at is stamped at transaction start, so the walk stays SETTLE_SECONDS behind now()
+# to let slower concurrent upserts commit before the watermark passes their timestamp.
+POLL_SECONDS   = int(os.getenv("IMAGE_EMBED_POLL_SECONDS", "60"))
+BATCH_SIZE     = int(os.getenv("IMAGE_EMBED_BATCH", "64"))
+SETTLE_SECONDS = int(os.getenv("IMAGE_EMBED_SETTLE_SECONDS", "30"))
+WATERMARK_NAME = "image_embeddings"
+
+
+def get_watermark(name: str = WATERMARK_NAME) -> Dict[str, Any]:
+    rows = repo.select("pipeline_watermarks", "value", eq={"name": name}, limit=1).data
+    return rows[0]["value"] if rows else {}
+
+
+def set_watermark(value: Dict[str, Any], name: str = WATERMARK_NAME) -> None:
+    repo.upsert(
+        "pipeline_watermarks",
+        {"name": name, "value": value, "updated_at": datetime.now(timezone.utc).isoformat()},
+        on_conflict="name",
+    )
+
+
+def _analyses_after(wm: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
+    return repo.rpc("image_analyses_after", {
+        "p_analyzed_at": wm.get("analyzed_at"),
+        "p_image_id": int(wm.get("image_id") or 0),
+        "p_limit": limit,
+        "p_settle_seconds": SETTLE_SECONDS,
+    }) or []
+
+
+def build_blob(post_text: str, caption: str, ocr_text: str) -> str:
+    return " ".join(p for p in [post_text, caption, ocr_text] if p).strip()
+
+
+def run_once() -> int:
+    """Embed one batch past the watermark. Returns number of analyses scanned (0 = caught up)."""
+    wm = get_watermark()
+    rows = _analyses_after(wm, BATCH_SIZE)
+    if not rows:
+        return 0
+
+    image_ids = [r["image_id"] for r in rows]
+    imgs = repo.select("sa_images", "id, thread_id", in_={"id": image_ids}).data
+    thread_by_image = {i["id"]: i["thread_id"] for i in imgs if i.get("thread_id")}
+    tids = list(set(thread_by_image.values()))
+    threads = repo.select("sa_threads", "id, content_text", in_={"id": tids}).data if tids else []
+    text_by_thread = {t["id"]: t.get("content_text") or "" for t in threads}
+
+    items = []
+    for r in rows:
+        tid = thread_by_image.get(r["image_id"])
+        if not tid:
+            continue  # orphan image; nothing to key the embedding on
+        blob = build_blob(text_by_thread.get(tid, ""), r.get("caption") or "", r.get("ocr_text") or "")
+        if blob:
+            items.append((tid, r["image_id"], blob))
+
+    written = 0
+    if items:
+        t0 = time.perf_counter()
+        vecs = embed_texts([b for _, _, b in items])
+        payload = [{"thread_id": tid, "image_id": iid, "embedding": v} for (tid, iid, _), v in zip(items, vecs)]
+        n = repo.rpc("upsert_image_embeddings", {"p_rows": payload})
+        written = int(n or 0) if isinstance(n, (int, float)) else len(payload)
+        metrics.observe("image_embed.batch", time.perf_counter() - t0)
+        metrics.incr("image_embed.written", written)
+
+    last = rows[-1]
+    set_watermark({"analyzed_at": last["analyzed_at"], "image_id": last["image_id"]})
+    logger.info(
+        "image embeddings | scanned=%s | embedded=%s | watermark=%s/%s",
+        len(rows),
+        written,
+        last["analyzed_at"],
+        last["image_id"],
+    )
+    return len(rows)
+
+
+def main():
+    backoff = POLL_SECONDS
+    while True:
+        try:
+            scanned = run_once()
+            backoff = POLL_SECONDS
+            if scanned:
+                continue  # drain backlog before sleeping
+        except Exception:
+            logger.exception("image embedding stage error")
+            backoff = min(max(backoff * 2, POLL_SECONDS), 600)
+        time.sleep(backoff)
+
+
+if __name__ == "__main__":
+    main()
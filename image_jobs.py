@@ -3,15 +3,18 @@ import os
 import uuid
 import threading
 import queue
-import shutil
-import pathlib
-import requests
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import NamedTuple, Optional, List
 import time
-from db import supabase
-from imageGen import createImage
+import metrics
+import tracing
+import audit_log
+from imageGen import createImage, RetryBudget
+from ref_image_cache import fetch_many as fetch_reference_images, release as release_reference_images
+from uploader import start_prefetch as start_upload_prefetch
 from function import (
-    uploadImage,
+    uploadImageBytes,
     replyToPost,
 )
 from logging_utils import get_logger
@@ -21,11 +24,11 @@ logger = get_logger(__name__)
 # -------------------------
 # Config / directories
 # -------------------------
+# Local archive of generated images (written off the reply path; set IMG_ARCHIVE=0 to skip)
 SAVE_DIR = os.getenv("AI_IMG_DIR", "./generated_images")
-os.makedirs(SAVE_DIR, exist_ok=True)
-
-TEMP_IMG_DIR = os.getenv("TEMP_IMG_DIR", "./temp_images")
-pathlib.Path(TEMP_IMG_DIR).mkdir(parents=True, exist_ok=True)
+ARCHIVE_ENABLED = os.getenv("IMG_ARCHIVE", "1").lower() not in ("0", "false", "no")
+if ARCHIVE_ENABLED:
+    os.makedirs(SAVE_DIR, exist_ok=True)
 
 # Optional: path to your GLADIUS base image for identity/style anchoring
 GLADIUS_PATH = os.getenv("GLADIUS_IMAGE_PATH", "GLADIUS.jpg")
@@ -33,6 +36,10 @@ GLADIUS_PATH = os.getenv("GLADIUS_IMAGE_PATH", "GLADIUS.jpg")
 # Optional: bound the queue to avoid runaway memory under burst load
 _Q_MAX = int(os.getenv("IMG_QUEUE_MAX", "200"))
 
+# Number of worker threads draining the queue. Per-model concurrency and the
+# Gemini rate limit are enforced inside imageGen, so this can exceed them safely.
+_WORKERS = max(1, int(os.getenv("IMG_WORKERS", "3")))
+
 # -------------------------
 # Job structure / queue
 # -------------------------
@@ -43,46 +50,83 @@ class ImageJob(NamedTuple):
     reply_to_user_id: str
     caption: Optional[str] = None
     context_image_urls: Optional[List[str]] = None
+    enqueued_at: float = 0.0
+    trace_parent: Optional[tracing.SpanContext] = None  # span that queued the job (ask / mention)
+
+
+class _FairQueue:
+    """
+    Bounded job queue with one FIFO lane per requesting user. Lanes are served
+    round-robin so a user spamming image requests can't starve everyone else.
+    Mirrors the queue.Queue put/get/task_done/join surface the worker relies on.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self._lanes: "OrderedDict[str, deque]" = OrderedDict()
+        self._size = 0
+        self._unfinished = 0
+        self._cv = threading.Condition()
+
+    def put(self, key: str, item, block: bool = True, timeout=None):
+        with self._cv:
+            if self.maxsize > 0 and self._size >= self.maxsize:
+                if not block:
+                    raise queue.Full
+                if not self._cv.wait_for(lambda: self._size < self.maxsize, timeout):
+                    raise queue.Full
+            self._lanes.setdefault(key or "", deque()).append(item)
+            self._size += 1
+            self._unfinished += 1
+            self._cv.notify_all()
+
+    def get(self):
+        with self._cv:
+            self._cv.wait_for(lambda: self._size > 0)
+            key, lane = next(iter(self._lanes.items()))
+            item = lane.popleft()
+            if lane:
+                self._lanes.move_to_end(key)  # next request from this user goes to the back
+            else:
+                del self._lanes[key]
+            self._size -= 1
+            self._cv.notify_all()
+            return item
+
+    def task_done(self):
+        with self._cv:
+            if self._unfinished <= 0:
+                raise ValueError("task_done() called too many times")
+            self._unfinished -= 1
+            if self._unfinished == 0:
+                self._cv.notify_all()
 
-_q: "queue.Queue[ImageJob]" = queue.Queue(maxsize=_Q_MAX)
+    def join(self, timeout=None) -> bool:
+        with self._cv:
+            return self._cv.wait_for(lambda: self._unfinished == 0, timeout)
+
+    def qsize(self) -> int:
+        with self._cv:
+            return self._size
+
+
+_q = _FairQueue(maxsize=_Q_MAX)
 _started = False
 _lock = threading.Lock()
+_archive_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-archive")
 
 # -------------------------
 # Helpers
 # -------------------------
-def _safe_ext_from_content_type(ct: str) -> str:
-    ct = (ct or "").lower()
-    if "jpeg" in ct or "jpg" in ct:
-        return ".jpg"
-    if "png" in ct:
-        return ".png"
-    if "webp" in ct:
-        return ".webp"
-    return ".png"  # default
-
-def _download_to_temp(url):
-    """
-    Download a remote image URL into TEMP_IMG_DIR and return its absolute path.
-    Returns None on failure (kept quiet so the pipeline keeps flowing).
-    """
+_EXT_BY_MIME = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp"}
+
+def _archive_image(job_id: str, data: bytes, mime: str) -> None:
+    path = os.path.join(SAVE_DIR, f"{job_id}{_EXT_BY_MIME.get(mime, '.png')}")
     try:
-        r = requests.get(url, timeout=25)
-        r.raise_for_status()
-        ext = _safe_ext_from_content_type(r.headers.get("Content-Type", ""))
-        p = pathlib.Path(TEMP_IMG_DIR) / f"ctx_{os.urandom(3).hex()}{ext}"
-        with open(p, "wb") as f:
-            f.write(r.content)
-        # basic sanity check
-        if p.stat().st_size < 500:  # likely bad/empty
-            try:
-                p.unlink(missing_ok=True)
-            except Exception:
-                pass
-            return None
-        return str(p.resolve())
+        with open(path, "wb") as f:
+            f.write(data)
     except Exception:
-        return None
+        logger.exception("archiving image failed | job_id=%s", job_id)
 
 # -------------------------
 # Worker
@@ -91,129 +135,117 @@ def _wants_gladius(prompt: str) -> bool:
     t = (prompt or "").lower()
     return ("gladius" in t) or ("@arenagladius" in t)
 
-def _worker():
-    def _safe_unlink(p, temp_root):
+def _run_job(job: ImageJob, queue_wait: float) -> None:
+    try:
+        # 1) Context images → cached local files (downloaded concurrently)
+        context_paths: List[str] = []
+        if job.context_image_urls:
+            urls = []
+            for u in job.context_image_urls[:3]:
+                # skip Arena profile/page URLs (HTML, not images)
+                if isinstance(u, str) and "arena.social/ArenaGladius" in u:
+                    logger.info("skipping profile page url; using GLADIUS_PATH")
+                    continue
+                urls.append(u)
+            with tracing.span("image.refs", urls=len(urls)):
+                context_paths = fetch_reference_images(urls, pin=True)
+
+        # 2) Create image. imageGen owns the single retry budget (attempts + deadline)
+        #    across primary/fallback, so there is no second retry loop here.
+        result, last_err = None, None
+        gen_t0 = time.perf_counter()
         try:
-            if not p:
-                return
-            rp = str(pathlib.Path(p).resolve())
-            if rp.startswith(temp_root) and os.path.isfile(rp):
-                os.remove(rp)
-        except Exception:
-            pass
+            use_gladius = os.path.exists(GLADIUS_PATH) and _wants_gladius(job.prompt)
+            with tracing.span("image.generate"):
+                result = createImage(
+                    prompt=job.prompt,
+                    input_paths=context_paths or None,
+                    gladius_path=GLADIUS_PATH if use_gladius else None,
+                    max_images=1,
+                    budget=RetryBudget(),
+                )
+        except Exception as e:
+            last_err = e
+        finally:
+            release_reference_images(context_paths)  # read by now; eviction may take them again
+        gen_secs = time.perf_counter() - gen_t0
+        metrics.observe("image.generate", gen_secs)
+        for a in (result or {}).get("attempts") or []:
+            metrics.observe(f"image.attempt.{a['model']}", a["seconds"])
+        logger.info(
+            "image generated | job_id=%s | user_id=%s | queue_wait=%.2fs | gen=%.2fs | model=%s | attempts=%s",
+            job.id,
+            job.reply_to_user_id,
+            queue_wait,
+            gen_secs,
+            (result or {}).get("model"),
+            (result or {}).get("attempts"),
+        )
 
-    temp_root = str(pathlib.Path(TEMP_IMG_DIR).resolve())
+        if result is None:
+            metrics.incr("image.failed")
+            replyToPost(job.reply_to_post_id, job.reply_to_user_id,
+                        job.caption or f"Image forge stalled: {type(last_err).__name__}")
+            return
 
-    while True:
-        job = _q.get()
-        to_delete: List[str] = []  # ctx downloads + generated temp files
+        images = (result or {}).get("images") or []
+        if not images:
+            msg = (result or {}).get("text") or (job.caption or "Image attempt failed.")
+            replyToPost(job.reply_to_post_id, job.reply_to_user_id, msg)
+            return
+
+        # 3) Archive a local copy in the background (never blocks the reply)
+        image = images[0]
+        if ARCHIVE_ENABLED:
+            _archive_pool.submit(_archive_image, job.id, image["data"], image["mime"])
+
+        # 4) Upload straight from memory + reply
+        logger.info("uploading image | job_id=%s | bytes=%s", job.id, len(image["data"]))
+        ext = _EXT_BY_MIME.get(image["mime"], ".png")
+        up = uploadImageBytes(image["data"], f"{job.id}{ext}", file_type=image["mime"])
+        logger.info("upload done | job_id=%s | ok=%s | upload=%.2fs", job.id, up.get("success"), up.get("seconds") or 0.0)
+        if not up.get("success"):
+            resp = replyToPost(
+                job.reply_to_post_id,
+                job.reply_to_user_id,
+                f"{job.caption or 'Cooked an image'} but upload failed: {up.get('error') or 'unknown error'}",
+            )
+        else:
+            resp = replyToPost(
+                job.reply_to_post_id,
+                job.reply_to_user_id,
+                job.caption or "Visual served.",
+                imageURL=up["url"],
+            )
+
+        # 5) Minimal DB log (write-behind, see audit_log)
         try:
-            # 1) Context images → temp files
-            context_paths: List[str] = []
-            if job.context_image_urls:
-                for u in job.context_image_urls[:3]:
-                    # skip Arena profile/page URLs (HTML, not images)
-                    if isinstance(u, str) and "arena.social/ArenaGladius" in u:
-                        logger.info("skipping profile page url; using GLADIUS_PATH")
-                        continue
-                    p = _download_to_temp(u)
-                    if p:
-                        context_paths.append(p)
-                        to_delete.append(p)
-
-            # 2) Create image (retry on transient failure)
-            max_attempts = int(os.getenv("IMG_CREATE_RETRY_ATTEMPTS", "2"))
-            attempt, result, last_err = 0, None, None
-            while attempt < max_attempts:
-                attempt += 1
-                try:
-                    use_gladius = os.path.exists(GLADIUS_PATH) and _wants_gladius(job.prompt)
-                    result = createImage(
-                        prompt=job.prompt,
-                        input_paths=context_paths or None,
-                        gladius_path=GLADIUS_PATH if use_gladius else None,
-                        max_images=1,
-                    )
-                    break
-                except Exception as e:
-                    last_err = e
-                    time.sleep(min(2 ** attempt, 8))
-
-            if result is None:
-                replyToPost(job.reply_to_post_id, job.reply_to_user_id,
-                            job.caption or f"Image forge stalled: {type(last_err).__name__}")
-                # cleanup ctx temps
-                for p in set(to_delete):
-                    _safe_unlink(p, temp_root)
-                _q.task_done()
-                continue
-
-            files = (result or {}).get("files") or []
-            # mark generated temp files for cleanup
-            for f in files:
-                to_delete.append(f)
-
-            if not files:
-                msg = (result or {}).get("text") or (job.caption or "Image attempt failed.")
-                replyToPost(job.reply_to_post_id, job.reply_to_user_id, msg)
-                # cleanup temps
-                for p in set(to_delete):
-                    _safe_unlink(p, temp_root)
-                _q.task_done()
-                continue
-
-            # 3) Persist a copy in SAVE_DIR
-            src_path = files[0]
-            ext = ".png"
-            local_path = os.path.join(SAVE_DIR, f"{job.id}{ext}")
-            try:
-                shutil.copyfile(src_path, local_path)  # keep temp; we'll delete it below
-            except Exception:
-                try:
-                    shutil.move(src_path, local_path)   # move removes temp; drop it from cleanup
-                    if src_path in to_delete:
-                        to_delete.remove(src_path)
-                except Exception:
-                    local_path = src_path  # lives in temp; we'll still clean after upload
-
-            # 4) Upload + reply
-            logger.info("uploading image")
-            up = uploadImage(local_path)
-            if not up.get("success"):
-                resp = replyToPost(
-                    job.reply_to_post_id,
-                    job.reply_to_user_id,
-                    f"{job.caption or 'Cooked an image'} but upload failed: {up.get('error') or 'unknown error'}",
-                )
-            else:
-                resp = replyToPost(
-                    job.reply_to_post_id,
-                    job.reply_to_user_id,
-                    job.caption or "Visual served.",
-                    imageURL=up["url"],
-                )
+            files_payload = resp.get("files")
+            if not files_payload and up.get("url"):
+                files_payload = [{"url": up["url"], "fileType": "image"}]
+            audit_log.log("image_creations", {
+                "thread_id": resp.get("threadId") or job.reply_to_post_id,
+                "user_id":   resp.get("userId")   or job.reply_to_user_id,
+                "content":   resp.get("content")  or (job.caption or job.prompt),
+                "files":     files_payload or [],
+            })
+        except Exception as _e:
+            logger.exception("logging image creation failed")
 
-            # 5) Minimal DB log
-            try:
-                files_payload = resp.get("files")
-                if not files_payload and up.get("url"):
-                    files_payload = [{"url": up["url"], "fileType": "image"}]
-                supabase.table("image_creations").insert({
-                    "thread_id": resp.get("threadId") or job.reply_to_post_id,
-                    "user_id":   resp.get("userId")   or job.reply_to_user_id,
-                    "content":   resp.get("content")  or (job.caption or job.prompt),
-                    "files":     files_payload or [],
-                }).execute()
-            except Exception as _e:
-                logger.exception("logging image creation failed")
+    except Exception as e:
+        logger.exception("image job failed")
+        replyToPost(job.reply_to_post_id, job.reply_to_user_id, f"Image job blew up: {e}")
 
-        except Exception as e:
-            logger.exception("image job failed")
-            replyToPost(job.reply_to_post_id, job.reply_to_user_id, f"Image job blew up: {e}")
+
+def _worker():
+    while True:
+        job = _q.get()
+        queue_wait = time.time() - job.enqueued_at if job.enqueued_at else 0.0
+        metrics.observe("image.queue_wait", queue_wait)
+        try:
+            with tracing.span("image.job", parent=job.trace_parent, job_id=job.id, queue_wait_s=round(queue_wait, 3)):
+                _run_job(job, queue_wait)
         finally:
-            # 6) cleanup temp files (ctx + generated)
-            for p in set(to_delete):
-                _safe_unlink(p, temp_root)
             _q.task_done()
 
 # -------------------------
@@ -224,9 +256,12 @@ def start_worker():
     with _lock:
         if _started:
             return
-        t = threading.Thread(target=_worker, daemon=True)
-        t.start()
+        for i in range(_WORKERS):
+            t = threading.Thread(target=_worker, name=f"image-worker-{i}", daemon=True)
+            t.start()
         _started = True
+        start_upload_prefetch()  # no-op unless UPLOAD_POLICY_PREFETCH > 0
+        logger.info("image workers started | count=%s", _WORKERS)
 
 def enqueue(
     prompt: str,
@@ -237,11 +272,12 @@ def enqueue(
 ) -> str:
     """
     Queue an image generation job.
-    Returns a job_id (used for local file naming and debugging).
+    Returns a job_id (used for archive/upload file naming and debugging).
     """
     start_worker()
     job_id = str(uuid.uuid4())
     _q.put(
+        reply_to_user_id,
         ImageJob(
             job_id,
             prompt,
@@ -249,11 +285,13 @@ def enqueue(
             reply_to_user_id,
             caption,
             context_image_urls or [],
-        )
+            time.time(),
+            tracing.current_context(),
+        ),
     )
     return job_id
 
 
-def join_queue(timeout):
+def join_queue(timeout=None):
     # blocks until all queued tasks call task_done()
-    _q.join()
+    _q.join(timeout)
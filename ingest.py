@@ -1,30 +1,34 @@
 # ingest_arena.py
-import os, re, json, hashlib
+import os, re, json, hashlib, threading
+from collections import OrderedDict
 from datetime import datetime
-from html import unescape
 from typing import Dict, Any, List, Optional
 
-from db import supabase  # your working client
+from db import repo
 from openai import OpenAI
 from logging_utils import get_logger
+from textclean import html_to_text
+import phash_index
+import ann_index
+import metrics
+import tracing
+import rollups
 
 logger = get_logger(__name__)
 
+# Perceptual-hash each new image into the local near-duplicate index (one fetch per image)
+PHASH_ON_INGEST = os.getenv("PHASH_ON_INGEST", "0").lower() in ("1", "true", "yes")
+ANN_DUP_ON_INGEST = os.getenv("ANN_DUP_ON_INGEST", "1").lower() in ("1", "true", "yes")  # no-op unless ANN_ENABLED
+
 OPENAI_API_KEY = os.getenv("OPEN_AI_KEY")
 assert OPENAI_API_KEY, "Set OPENAI_API_KEY"
 oai = OpenAI(api_key=OPENAI_API_KEY)
 
 # -------- helpers --------
 
-TAG_RE = re.compile(r"<[^>]+>")
-
 def strip_html_to_text(html: str) -> str:
-    if not html:
-        return ""
-    # remove tags
-    txt = TAG_RE.sub("", html)
-    # unescape html entities
-    return unescape(txt).strip()
+    # stored as sa_threads.content_text: tags dropped, entities decoded, newlines kept
+    return html_to_text(html, sep="", collapse=False)
 
 def is_gif(url: str) -> bool:
     return bool(re.search(r"\.gif($|\?)", url, re.I) or re.search(r"(tenor|giphy)", url, re.I))
@@ -37,12 +41,46 @@ def embed_text(text: str) -> List[float]:
     if not text:
         # Return a zero vector to avoid failing inserts; pgvector accepts it.
         return [0.0] * 1536
-    resp = oai.embeddings.create(
-        model="text-embedding-3-small",
-        input=text[:8000]  # guard
-    )
+    with tracing.span("openai.embeddings", inputs=1):
+        resp = oai.embeddings.create(
+            model="text-embedding-3-small",
+            input=text[:8000]  # guard
+        )
     return resp.data[0].embedding
 
+# Small LRU for query-time embeddings (agent tools embed the same phrases repeatedly)
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "512"))
+_embed_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+_embed_cache_lock = threading.Lock()
+
+def embed_query(text: str) -> List[float]:
+    """embed_text with an in-process LRU keyed by whitespace/case-normalized text."""
+    key = " ".join((text or "").split()).lower()
+    with _embed_cache_lock:
+        vec = _embed_cache.get(key)
+        if vec is not None:
+            _embed_cache.move_to_end(key)
+            metrics.incr("embed_cache.hit")
+            return vec
+    metrics.incr("embed_cache.miss")
+    vec = embed_text(key)
+    with _embed_cache_lock:
+        _embed_cache[key] = vec
+        while len(_embed_cache) > EMBED_CACHE_SIZE:
+            _embed_cache.popitem(last=False)
+    return vec
+
+def embed_texts(texts: List[str], batch_size: int = 96) -> List[List[float]]:
+    """Batch version of embed_text: one embeddings request per `batch_size` inputs, order preserved."""
+    out: List[List[float]] = []
+    for k in range(0, len(texts), batch_size):
+        chunk = [(t or " ")[:8000] for t in texts[k : k + batch_size]]
+        with tracing.span("openai.embeddings", inputs=len(chunk)):
+            resp = oai.embeddings.create(model="text-embedding-3-small", input=chunk)
+        out.extend(d.embedding for d in sorted(resp.data, key=lambda d: d.index))
+    return out
+
+@tracing.traced("openai.vision")
 def analyze_image_url(image_url: str, hint_text: str = "", animated: bool = False) -> Dict[str, Any]:
     """
     Calls a vision model on a public image URL and returns structured JSON.
@@ -91,26 +129,26 @@ def analyze_image_url(image_url: str, hint_text: str = "", animated: bool = Fals
 
 # -------- upserts --------
 
-def upsert_user(u: Dict[str, Any]):
-    supabase.table("sa_users").upsert({
+def _user_row(u: Dict[str, Any]) -> Dict[str, Any]:
+    return {
         "id": u["id"],
         "handle": u.get("twitterHandle") or u.get("userHandle"),
         "name": u.get("twitterName") or u.get("userName"),
         "picture": u.get("twitterPicture"),
         "address": u.get("address"),
-    }).execute()
+    }
 
-def upsert_community(c: Dict[str, Any]):
-    supabase.table("sa_communities").upsert({
+def _community_row(c: Dict[str, Any]) -> Dict[str, Any]:
+    return {
         "id": c["id"],
         "contract_address": c.get("contractAddress"),
         "name": c.get("name"),
         "kind": c.get("type"),
         "photo_url": c.get("photoURL"),
-    }).execute()
+    }
 
-def upsert_thread(t: Dict[str, Any], content_text: str):
-    supabase.table("sa_threads").upsert({
+def _thread_row(t: Dict[str, Any], content_text: str) -> Dict[str, Any]:
+    return {
         "id": t["id"],
         "user_id": t["user"]["id"],
         "community_id": t.get("community", {}).get("id") if t.get("community") else None,
@@ -141,11 +179,20 @@ def upsert_thread(t: Dict[str, Any], content_text: str):
         "currency_decimals": t.get("currencyDecimals"),
         "tip_amount": t.get("tipAmount"),
         "tip_count": t.get("tipCount"),
-    }).execute()
+    }
+
+def upsert_user(u: Dict[str, Any]):
+    repo.upsert("sa_users", _user_row(u))
+
+def upsert_community(c: Dict[str, Any]):
+    repo.upsert("sa_communities", _community_row(c))
+
+def upsert_thread(t: Dict[str, Any], content_text: str):
+    repo.upsert("sa_threads", _thread_row(t, content_text))
 
 def upsert_image(thread_id: str, img: Dict[str, Any]):
     url = img["url"]
-    supabase.table("sa_images").upsert({
+    repo.upsert("sa_images", {
         "id": img["id"],
         "thread_id": thread_id,
         "source_url": url,
@@ -155,10 +202,12 @@ def upsert_image(thread_id: str, img: Dict[str, Any]):
         "width": None,
         "height": None,
         "sha256": sha256_of_url(url),  # URL fingerprint (not bytes)
-    }).execute()
+    })
+    if PHASH_ON_INGEST:
+        phash_index.index_image(img["id"], url)
 
 def upsert_image_analysis(image_id: int, analysis: Dict[str, Any]):
-    supabase.table("sa_image_analysis").upsert({
+    repo.upsert("sa_image_analysis", {
         "image_id": image_id,
         "ocr_text": analysis.get("ocr_text"),
         "caption": analysis.get("caption"),
@@ -168,42 +217,62 @@ def upsert_image_analysis(image_id: int, analysis: Dict[str, Any]):
         "sentiment": analysis.get("sentiment"),
         "meme_template": analysis.get("meme_template"),
         "meta": analysis.get("meta"),
-    }).execute()
+    })
 
 def upsert_thread_embedding(thread_id: str, vec: List[float]):
-    supabase.table("sa_embeddings").upsert({
+    repo.upsert("sa_embeddings", {
         "thread_id": thread_id,
         "image_id": None,
         "embedding": vec
-    }).execute()
+    })
 
 def upsert_image_embedding(thread_id: str, image_id: int, vec: List[float]):
-    supabase.table("sa_embeddings").upsert({
+    repo.upsert("sa_embeddings", {
         "thread_id": thread_id,
         "image_id": image_id,
         "embedding": vec
-    }).execute()
+    })
 
 # -------- main entry --------
 
+@tracing.traced("ingest")
 def ingest_payload(payload: Dict[str, Any]):
     threads: List[Dict[str, Any]] = payload.get("threads", [])
+    tracing.annotate(threads=len(threads))
+
+    # 1) + 2) users, communities, threads: one multi-row upsert per table (parents first).
+    # Deduped by id, since one statement can't upsert the same row twice.
+    users: Dict[str, Dict[str, Any]] = {}
+    communities: Dict[str, Dict[str, Any]] = {}
+    thread_rows: Dict[str, Dict[str, Any]] = {}
+    texts: Dict[str, str] = {}
     for t in threads:
-        # 1) users & communities
-        upsert_user(t["user"])
+        users[t["user"]["id"]] = _user_row(t["user"])
         if t.get("community"):
-            upsert_community(t["community"])
+            communities[t["community"]["id"]] = _community_row(t["community"])
+        texts[t["id"]] = strip_html_to_text(t.get("content") or "")
+        logger.debug("thread content | %s", texts[t["id"]])
+        thread_rows[t["id"]] = _thread_row(t, texts[t["id"]])
+    repo.upsert("sa_users", list(users.values()))
+    repo.upsert("sa_communities", list(communities.values()))
+    repo.upsert("sa_threads", list(thread_rows.values()))
 
-        # 2) thread
-        content_text = strip_html_to_text(t.get("content") or "")
-        logger.debug("thread content | %s", content_text)
-        upsert_thread(t, content_text)
+    for t in threads:
+        content_text = texts[t["id"]]
 
         # 3) thread text embedding (once)
         if content_text:
             try:
                 t_vec = embed_text(content_text)
                 upsert_thread_embedding(t["id"], t_vec)
+                if ANN_DUP_ON_INGEST:
+                    dup = ann_index.find_duplicate(t_vec, thread_id=t["id"])
+                    if dup:
+                        metrics.incr("ingest.duplicate_post")
+                        logger.info(
+                            "duplicate post | thread_id=%s | dup_of=%s | similarity=%.3f",
+                            t["id"], dup["thread_id"], dup["similarity"],
+                        )
             except Exception as e:
                 logger.exception("embed thread error | thread_id=%s", t.get("id"))
 
@@ -233,6 +302,8 @@ def ingest_payload(payload: Dict[str, Any]):
                     img.get("id"),
                 )
 
+    rollups.refresh_for_threads(t.get("id") for t in threads)
+
 
 # If you want a quick run hook:
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Dict
+
+# In-process counters + latency samples. Cheap enough to call on every job;
+# read them via snapshot() (e.g. from a debug log line or a REPL).
+
+_SAMPLES = 2048
+
+_lock = threading.Lock()
+_counters: Dict[str, int] = defaultdict(int)
+_timings: Dict[str, deque] = defaultdict(lambda: deque(maxlen=_SAMPLES))
+
+
+def incr(name: str, n: int = 1) -> None:
+    with _lock:
+        _counters[name] += n
+
+
+def observe(name: str, seconds: float) -> None:
+    with _lock:
+        _timings[name].append(float(seconds))
+
+
+@contextmanager
+def timer(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0)
+
+
+def _pct(sorted_vals, q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, max(0, int(round(q * (len(sorted_vals) - 1)))))
+    return sorted_vals[idx]
+
+
+def summary(name: str) -> Dict[str, float]:
+    with _lock:
+        vals = sorted(_timings.get(name) or ())
+    return {
+        "count": len(vals),
+        "p50": _pct(vals, 0.50),
+        "p95": _pct(vals, 0.95),
+        "p99": _pct(vals, 0.99),
+        "max": vals[-1] if vals else 0.0,
+    }
+
+
+def counter(name: str) -> int:
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot() -> Dict[str, Any]:
+    with _lock:
+        counters = dict(_counters)
+        names = list(_timings.keys())
+    return {"counters": counters, "timings": {n: summary(n) for n in names}}
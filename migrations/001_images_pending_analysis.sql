@@ -0,0 +1,35 @@
+-- Images that still lack sa_image_analysis, most valuable first.
+-- priority = engagement / (age_hours + 2)^1.5  (recent + popular posts float to the top)
+-- Used by vision_backfill.py; the anti-join makes the backfill naturally resumable.
+
+create or replace function public.images_pending_analysis(
+  p_limit integer default 50,
+  p_max_age_days integer default 30
+)
+returns table (
+  id bigint,
+  thread_id uuid,
+  source_url text,
+  storage_path text,
+  mime text,
+  width integer,
+  height integer,
+  is_gif boolean,
+  sha256 text,
+  priority double precision
+)
+language sql
+stable
+as $$
+  select
+    i.id, i.thread_id, i.source_url, i.storage_path, i.mime, i.width, i.height, i.is_gif, i.sha256,
+    (1 + coalesce(t.like_count, 0) + 2 * coalesce(t.repost_count, 0) + coalesce(t.answer_count, 0))::double precision
+      / power(greatest(extract(epoch from (now() - t.created_at)) / 3600.0, 0) + 2, 1.5) as priority
+  from public.sa_images i
+  join public.sa_threads t on t.id = i.thread_id
+  left join public.sa_image_analysis a on a.image_id = i.id
+  where a.image_id is null
+    and t.created_at >= now() - make_interval(days => p_max_age_days)
+  order by priority desc
+  limit greatest(1, least(p_limit, 500));
+$$;
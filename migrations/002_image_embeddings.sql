@@ -0,0 +1,53 @@
+-- Incremental image-embedding stage (image_embeddings.py).
+
+-- 1) When was an analysis written/rewritten? Drives the embedding watermark.
+alter table public.sa_image_analysis
+  add column if not exists analyzed_at timestamp with time zone not null default now();
+
+create index IF not exists sa_image_analysis_analyzed_at_idx
+  on public.sa_image_analysis using btree (analyzed_at, image_id) TABLESPACE pg_default;
+
+create or replace function public.sa_image_analysis_touch()
+returns trigger
+language plpgsql
+as $$
+begin
+  new.analyzed_at := now();
+  return new;
+end;
+$$;
+
+drop trigger if exists sa_image_analysis_touch on public.sa_image_analysis;
+create trigger sa_image_analysis_touch BEFORE update on public.sa_image_analysis
+for EACH row
+execute FUNCTION sa_image_analysis_touch ();
+
+
+-- 2) Named watermarks for incremental pipeline stages.
+create table if not exists public.pipeline_watermarks (
+  name text not null,
+  value jsonb not null default '{}'::jsonb,
+  updated_at timestamp with time zone not null default now(),
+  constraint pipeline_watermarks_pkey primary key (name)
+) TABLESPACE pg_default;
+
+
+-- 3) Bulk upsert keyed on image_id. PostgREST can't target the partial unique index
+--    sa_embeddings_image_unique with on_conflict, so this goes through an RPC.
+--    p_rows: [{"thread_id": uuid, "image_id": bigint, "embedding": [float, ...]}, ...]
+create or replace function public.upsert_image_embeddings(p_rows jsonb)
+returns integer
+language plpgsql
+as $$
+declare
+  n integer;
+begin
+  insert into public.sa_embeddings (thread_id, image_id, embedding)
+  select (r->>'thread_id')::uuid, (r->>'image_id')::bigint, (r->'embedding')::text::vector
+  from jsonb_array_elements(p_rows) r
+  on conflict (image_id) where image_id is not null
+  do update set embedding = excluded.embedding, thread_id = excluded.thread_id;
+  get diagnostics n = row_count;
+  return n;
+end;
+$$;
@@ -0,0 +1,122 @@
+-- k-NN and hybrid (tsvector + cosine) search over thread embeddings, for the
+-- semantic_search agent tool. Filters are optional (null = no filter).
+-- p_community accepts a community UUID or a contract address (with/without 0x).
+
+create or replace function public.match_threads(
+  query_embedding vector,
+  match_count integer default 10,
+  p_start timestamp with time zone default null,
+  p_end timestamp with time zone default null,
+  p_community text default null,
+  p_user uuid default null
+)
+returns table (
+  id uuid,
+  user_id uuid,
+  handle text,
+  community_id uuid,
+  content_text text,
+  created_at timestamp with time zone,
+  like_count integer,
+  repost_count integer,
+  similarity double precision
+)
+language sql
+stable
+set ivfflat.probes = 10
+as $$
+  select t.id, t.user_id, u.handle, t.community_id, t.content_text, t.created_at,
+         t.like_count, t.repost_count,
+         1 - (e.embedding <=> query_embedding) as similarity
+  from public.sa_embeddings e
+  join public.sa_threads t on t.id = e.thread_id
+  left join public.sa_users u on u.id = t.user_id
+  left join public.sa_communities c on c.id = t.community_id
+  where e.image_id is null
+    and (p_start is null or t.created_at >= p_start)
+    and (p_end is null or t.created_at < p_end)
+    and (p_user is null or t.user_id = p_user)
+    and (
+      p_community is null
+      or t.community_id::text = p_community
+      or regexp_replace(lower(coalesce(c.contract_address, '')), '^0x', '')
+         = regexp_replace(lower(p_community), '^0x', '')
+    )
+  order by e.embedding <=> query_embedding
+  limit greatest(1, least(match_count, 100));
+$$;
+
+
+-- Hybrid: union of the vector top-N and the full-text top-N, scored as
+--   p_semantic_weight * cosine_similarity + (1 - p_semantic_weight) * (ts_rank / max ts_rank)
+create or replace function public.hybrid_search_threads(
+  p_query text,
+  query_embedding vector,
+  match_count integer default 10,
+  p_start timestamp with time zone default null,
+  p_end timestamp with time zone default null,
+  p_community text default null,
+  p_user uuid default null,
+  p_semantic_weight double precision default 0.6
+)
+returns table (
+  id uuid,
+  user_id uuid,
+  handle text,
+  community_id uuid,
+  content_text text,
+  created_at timestamp with time zone,
+  like_count integer,
+  repost_count integer,
+  similarity double precision,
+  text_rank double precision,
+  score double precision
+)
+language sql
+stable
+set ivfflat.probes = 10
+as $$
+  with sem as (
+    select m.id, m.similarity
+    from public.match_threads(query_embedding, match_count * 4, p_start, p_end, p_community, p_user) m
+  ),
+  kw as (
+    select t.id, ts_rank(t.content_tsv, websearch_to_tsquery(p_query))::double precision as text_rank
+    from public.sa_threads t
+    left join public.sa_communities c on c.id = t.community_id
+    where t.content_tsv @@ websearch_to_tsquery(p_query)
+      and (p_start is null or t.created_at >= p_start)
+      and (p_end is null or t.created_at < p_end)
+      and (p_user is null or t.user_id = p_user)
+      and (
+        p_community is null
+        or t.community_id::text = p_community
+        or regexp_replace(lower(coalesce(c.contract_address, '')), '^0x', '')
+           = regexp_replace(lower(p_community), '^0x', '')
+      )
+    order by text_rank desc
+    limit greatest(1, least(match_count, 100)) * 4
+  ),
+  cand as (
+    select coalesce(s.id, k.id) as id,
+           s.similarity,
+           k.text_rank
+    from sem s
+    full outer join kw k on k.id = s.id
+  ),
+  norm as (
+    select cand.*, nullif(max(cand.text_rank) over (), 0) as max_rank
+    from cand
+  )
+  select t.id, t.user_id, u.handle, t.community_id, t.content_text, t.created_at,
+         t.like_count, t.repost_count,
+         n.similarity,
+         n.text_rank,
+         p_semantic_weight * coalesce(n.similarity, 0)
+           + (1 - p_semantic_weight) * coalesce(n.text_rank / n.max_rank, 0) as score
+  from norm n
+  join public.sa_threads t on t.id = n.id
+  left join public.sa_users u on u.id = t.user_id
+  order by score desc
+  limit greatest(1, least(match_count, 100));
+$$;
@@ -0,0 +1,69 @@
+-- Engagement-counter refresh (engagement_refresh.py).
+-- Counters are re-fetched on a decaying schedule: the refresh interval is a quarter of the
+-- post's age, clamped to [10 minutes, 7 days], and posts older than p_max_age_days are left alone.
+--   age 1h -> every 15m, age 1d -> every 6h, age 7d -> every 42h, age 28d+ -> weekly
+
+alter table public.sa_threads
+  add column if not exists counters_refreshed_at timestamp with time zone null;
+
+
+-- Most overdue first (elapsed / interval). Never-refreshed threads count from created_at.
+create or replace function public.threads_due_for_counter_refresh(
+  p_limit integer default 100,
+  p_max_age_days integer default 30
+)
+returns table (
+  id uuid,
+  created_at timestamp with time zone,
+  counters_refreshed_at timestamp with time zone,
+  overdue double precision
+)
+language sql
+stable
+as $$
+  with s as (
+    select
+      t.id, t.created_at, t.counters_refreshed_at,
+      extract(epoch from now() - coalesce(t.counters_refreshed_at, t.created_at)) as elapsed,
+      least(greatest(extract(epoch from now() - t.created_at) / 4.0, 600), 604800) as interval_s
+    from public.sa_threads t
+    where t.created_at >= now() - make_interval(days => p_max_age_days)
+      and not coalesce(t.is_deleted, false)
+  )
+  select s.id, s.created_at, s.counters_refreshed_at, s.elapsed / s.interval_s as overdue
+  from s
+  where s.elapsed >= s.interval_s
+  order by overdue desc
+  limit greatest(1, least(p_limit, 1000));
+$$;
+
+
+-- One batched update per refresh cycle. Null counters keep their stored value (fetch failed),
+-- but counters_refreshed_at always advances so a failing thread waits one interval.
+--   p_rows: [{"id": uuid, "like_count": int, "repost_count": int, "answer_count": int,
+--             "bookmark_count": int, "tip_amount": numeric, "tip_count": int, "is_deleted": bool}, ...]
+create or replace function public.update_thread_counters(p_rows jsonb)
+returns integer
+language plpgsql
+as $$
+declare
+  n integer;
+begin
+  update public.sa_threads t set
+    like_count     = coalesce(r.like_count, t.like_count),
+    repost_count   = coalesce(r.repost_count, t.repost_count),
+    answer_count   = coalesce(r.answer_count, t.answer_count),
+    bookmark_count = coalesce(r.bookmark_count, t.bookmark_count),
+    tip_amount     = coalesce(r.tip_amount, t.tip_amount),
+    tip_count      = coalesce(r.tip_count, t.tip_count),
+    is_deleted     = coalesce(r.is_deleted, t.is_deleted),
+    counters_refreshed_at = now()
+  from jsonb_to_recordset(p_rows) as r(
+    id uuid, like_count integer, repost_count integer, answer_count integer,
+    bookmark_count integer, tip_amount numeric, tip_count integer, is_deleted boolean
+  )
+  where t.id = r.id;
+  get diagnostics n = row_count;
+  return n;
+end;
+$$;
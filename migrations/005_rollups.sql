@@ -0,0 +1,353 @@
+-- Pre-aggregated activity rollups for the leaderboard/timeseries tools.
+--
+-- Thread rollups are keyed by (community|user, bucket) and hold posts, likes, reposts, answers
+-- and tips. Buckets are recomputed from sa_threads (so they are idempotent and pick up counter
+-- refreshes) by refresh_rollups_for_threads(), which writers call with the ids they just touched
+-- (see rollups.py). Hourly rows are kept for 40 days; daily rows forever.
+-- Bot replies roll up by IST hour (the tool windows are IST days) via an insert trigger.
+-- Backfill once with:  select public.rebuild_rollups(now() - interval '400 days');
+
+
+-- 1) Tables
+create table if not exists public.rollup_community_hourly (
+  community_id uuid not null,
+  bucket timestamp with time zone not null,
+  posts integer not null default 0,
+  likes bigint not null default 0,
+  reposts bigint not null default 0,
+  answers bigint not null default 0,
+  tips numeric not null default 0,
+  active_users integer not null default 0,
+  constraint rollup_community_hourly_pkey primary key (community_id, bucket)
+) TABLESPACE pg_default;
+
+create table if not exists public.rollup_community_daily (
+  community_id uuid not null,
+  day date not null,
+  posts integer not null default 0,
+  likes bigint not null default 0,
+  reposts bigint not null default 0,
+  answers bigint not null default 0,
+  tips numeric not null default 0,
+  active_users integer not null default 0,
+  constraint rollup_community_daily_pkey primary key (community_id, day)
+) TABLESPACE pg_default;
+
+create table if not exists public.rollup_user_hourly (
+  user_id uuid not null,
+  bucket timestamp with time zone not null,
+  posts integer not null default 0,
+  likes bigint not null default 0,
+  reposts bigint not null default 0,
+  answers bigint not null default 0,
+  tips numeric not null default 0,
+  constraint rollup_user_hourly_pkey primary key (user_id, bucket)
+) TABLESPACE pg_default;
+
+create table if not exists public.rollup_user_daily (
+  user_id uuid not null,
+  day date not null,
+  posts integer not null default 0,
+  likes bigint not null default 0,
+  reposts bigint not null default 0,
+  answers bigint not null default 0,
+  tips numeric not null default 0,
+  constraint rollup_user_daily_pkey primary key (user_id, day)
+) TABLESPACE pg_default;
+
+create table if not exists public.rollup_bot_replies_hourly (
+  parent_user_handle text not null,
+  bucket timestamp with time zone not null,  -- start of the IST hour
+  replies integer not null default 0,
+  last_reply_at timestamp with time zone null,
+  constraint rollup_bot_replies_hourly_pkey primary key (parent_user_handle, bucket)
+) TABLESPACE pg_default;
+
+create index IF not exists rollup_community_hourly_bucket_idx on public.rollup_community_hourly using btree (bucket) TABLESPACE pg_default;
+create index IF not exists rollup_community_daily_day_idx on public.rollup_community_daily using btree (day) TABLESPACE pg_default;
+create index IF not exists rollup_user_hourly_bucket_idx on public.rollup_user_hourly using btree (bucket) TABLESPACE pg_default;
+create index IF not exists rollup_user_daily_day_idx on public.rollup_user_daily using btree (day) TABLESPACE pg_default;
+create index IF not exists rollup_bot_replies_hourly_bucket_idx on public.rollup_bot_replies_hourly using btree (bucket) TABLESPACE pg_default;
+
+
+-- 2) Incremental maintenance: recompute every bucket the given threads fall into.
+create or replace function public.refresh_rollups_for_threads(p_thread_ids uuid[])
+returns integer
+language plpgsql
+as $$
+declare
+  n integer;
+  lk record;
+begin
+  create temporary table if not exists _rollup_keys (kind text, key uuid, hour timestamptz) on commit drop;
+  truncate _rollup_keys;
+
+  insert into _rollup_keys
+  select distinct 'c', t.community_id, date_trunc('hour', t.created_at)
+  from public.sa_threads t
+  where t.id = any(p_thread_ids) and t.community_id is not null and t.created_at is not null
+  union
+  select distinct 'u', t.user_id, date_trunc('hour', t.created_at)
+  from public.sa_threads t
+  where t.id = any(p_thread_ids) and t.user_id is not null and t.created_at is not null;
+  get diagnostics n = row_count;
+
+  -- Writers (cron ingest, user sync, counter refresh) refresh overlapping buckets concurrently.
+  -- Serialize per community/user for the rest of the transaction, so two delete + re-insert
+  -- passes can't interleave (unique violations, or a stale aggregate from an older snapshot):
+  -- a waiter recomputes from a snapshot taken after the holder committed. Sorted, so no deadlocks.
+  for lk in select distinct kind, key from _rollup_keys order by kind, key loop
+    perform pg_advisory_xact_lock(hashtextextended('rollup:' || lk.kind || ':' || lk.key::text, 0));
+  end loop;
+
+  -- community hourly
+  delete from public.rollup_community_hourly r
+  using _rollup_keys k where k.kind = 'c' and r.community_id = k.key and r.bucket = k.hour;
+  insert into public.rollup_community_hourly (community_id, bucket, posts, likes, reposts, answers, tips, active_users)
+  select t.community_id, date_trunc('hour', t.created_at), count(*),
+         sum(coalesce(t.like_count, 0)), sum(coalesce(t.repost_count, 0)), sum(coalesce(t.answer_count, 0)),
+         sum(coalesce(t.tip_amount, 0)), count(distinct t.user_id)
+  from public.sa_threads t
+  join (select distinct key, hour from _rollup_keys where kind = 'c') k
+    on t.community_id = k.key and t.created_at >= k.hour and t.created_at < k.hour + interval '1 hour'
+  where not coalesce(t.is_deleted, false)
+  group by 1, 2;
+
+  -- community daily
+  delete from public.rollup_community_daily r
+  using (select distinct key, (hour at time zone 'UTC')::date as day from _rollup_keys where kind = 'c') k
+  where r.community_id = k.key and r.day = k.day;
+  insert into public.rollup_community_daily (community_id, day, posts, likes, reposts, answers, tips, active_users)
+  select t.community_id, (t.created_at at time zone 'UTC')::date, count(*),
+         sum(coalesce(t.like_count, 0)), sum(coalesce(t.repost_count, 0)), sum(coalesce(t.answer_count, 0)),
+         sum(coalesce(t.tip_amount, 0)), count(distinct t.user_id)
+  from public.sa_threads t
+  join (select distinct key, (hour at time zone 'UTC')::date as day from _rollup_keys where kind = 'c') k
+    on t.community_id = k.key
+   and t.created_at >= (k.day::timestamp at time zone 'UTC')
+   and t.created_at < ((k.day + 1)::timestamp at time zone 'UTC')
+  where not coalesce(t.is_deleted, false)
+  group by 1, 2;
+
+  -- user hourly
+  delete from public.rollup_user_hourly r
+  using _rollup_keys k where k.kind = 'u' and r.user_id = k.key and r.bucket = k.hour;
+  insert into public.rollup_user_hourly (user_id, bucket, posts, likes, reposts, answers, tips)
+  select t.user_id, date_trunc('hour', t.created_at), count(*),
+         sum(coalesce(t.like_count, 0)), sum(coalesce(t.repost_count, 0)), sum(coalesce(t.answer_count, 0)),
+         sum(coalesce(t.tip_amount, 0))
+  from public.sa_threads t
+  join (select distinct key, hour from _rollup_keys where kind = 'u') k
+    on t.user_id = k.key and t.created_at >= k.hour and t.created_at < k.hour + interval '1 hour'
+  where not coalesce(t.is_deleted, false)
+  group by 1, 2;
+
+  -- user daily
+  delete from public.rollup_user_daily r
+  using (select distinct key, (hour at time zone 'UTC')::date as day from _rollup_keys where kind = 'u') k
+  where r.user_id = k.key and r.day = k.day;
+  insert into public.rollup_user_daily (user_id, day, posts, likes, reposts, answers, tips)
+  select t.user_id, (t.created_at at time zone 'UTC')::date, count(*),
+         sum(coalesce(t.like_count, 0)), sum(coalesce(t.repost_count, 0)), sum(coalesce(t.answer_count, 0)),
+         sum(coalesce(t.tip_amount, 0))
+  from public.sa_threads t
+  join (select distinct key, (hour at time zone 'UTC')::date as day from _rollup_keys where kind = 'u') k
+    on t.user_id = k.key
+   and t.created_at >= (k.day::timestamp at time zone 'UTC')
+   and t.created_at < ((k.day + 1)::timestamp at time zone 'UTC')
+  where not coalesce(t.is_deleted, false)
+  group by 1, 2;
+
+  -- retention for hourly rows (the readers need them for a window's first day, so terminalAI
+  -- sends windows of ROLLUP_HOURLY_RETENTION_DAYS or more to the raw RPCs)
+  delete from public.rollup_community_hourly where bucket < now() - interval '40 days';
+  delete from public.rollup_user_hourly where bucket < now() - interval '40 days';
+
+  return n;
+end;
+$$;
+
+
+-- Full rebuild (initial backfill / repair) of thread rollups since p_since.
+create or replace function public.rebuild_rollups(p_since timestamp with time zone)
+returns integer
+language plpgsql
+as $$
+declare
+  ids uuid[];
+  b timestamp with time zone := date_trunc('hour', p_since at time zone 'Asia/Kolkata') at time zone 'Asia/Kolkata';
+begin
+  delete from public.rollup_bot_replies_hourly where bucket >= b;
+  insert into public.rollup_bot_replies_hourly (parent_user_handle, bucket, replies, last_reply_at)
+  select lower(parent_user_handle),
+         date_trunc('hour', created_at at time zone 'Asia/Kolkata') at time zone 'Asia/Kolkata',
+         count(*), max(created_at)
+  from public.bot_replies
+  where created_at >= b and parent_user_handle is not null
+  group by 1, 2;
+
+  select array_agg(id) into ids from public.sa_threads where created_at >= p_since;
+  if ids is null then
+    return 0;
+  end if;
+  return public.refresh_rollups_for_threads(ids);
+end;
+$$;
+
+
+-- Bot replies are insert-only and low volume: count them as they land.
+create or replace function public.rollup_bot_replies_on_insert()
+returns trigger
+language plpgsql
+as $$
+begin
+  if new.parent_user_handle is not null then
+    insert into public.rollup_bot_replies_hourly (parent_user_handle, bucket, replies, last_reply_at)
+    values (
+      lower(new.parent_user_handle),
+      date_trunc('hour', new.created_at at time zone 'Asia/Kolkata') at time zone 'Asia/Kolkata',
+      1,
+      new.created_at
+    )
+    on conflict (parent_user_handle, bucket) do update
+      set replies = rollup_bot_replies_hourly.replies + 1,
+          last_reply_at = greatest(rollup_bot_replies_hourly.last_reply_at, excluded.last_reply_at);
+  end if;
+  return new;
+end;
+$$;
+
+drop trigger if exists rollup_bot_replies_on_insert on public.bot_replies;
+create trigger rollup_bot_replies_on_insert AFTER INSERT on public.bot_replies
+for EACH row
+execute FUNCTION rollup_bot_replies_on_insert ();
+
+
+-- 3) Readers. Windows are exact to the hour: hourly rows cover the partial first day,
+--    daily rows every day after it. Days are UTC dates (as stored in the daily tables),
+--    whatever the session TimeZone.
+create or replace function public.rollup_top_communities(since_interval interval, limit_n integer default 10)
+returns table (
+  id uuid,
+  name text,
+  contract_address text,
+  posts bigint,
+  likes bigint,
+  reposts bigint,
+  answers bigint,
+  tips numeric,
+  score bigint
+)
+language sql
+stable
+as $$
+  with w as (select now() - since_interval as s),
+  parts as (
+    select r.community_id, r.posts, r.likes, r.reposts, r.answers, r.tips
+    from public.rollup_community_hourly r, w
+    where r.bucket >= date_trunc('hour', w.s) and r.bucket < ((w.s at time zone 'UTC')::date + 1)::timestamp at time zone 'UTC'
+    union all
+    select r.community_id, r.posts, r.likes, r.reposts, r.answers, r.tips
+    from public.rollup_community_daily r, w
+    where r.day > (w.s at time zone 'UTC')::date
+  ),
+  agg as (
+    select community_id, sum(posts)::bigint as posts, sum(likes)::bigint as likes,
+           sum(reposts)::bigint as reposts, sum(answers)::bigint as answers, sum(tips) as tips
+    from parts group by community_id
+  )
+  select a.community_id, c.name, c.contract_address, a.posts, a.likes, a.reposts, a.answers, a.tips,
+         a.posts + a.likes + 2 * a.reposts + a.answers as score
+  from agg a
+  left join public.sa_communities c on c.id = a.community_id
+  order by score desc
+  limit greatest(1, least(limit_n, 100));
+$$;
+
+
+create or replace function public.rollup_top_users(since_interval interval, limit_n integer default 12)
+returns table (
+  id uuid,
+  handle text,
+  name text,
+  posts bigint,
+  likes bigint,
+  reposts bigint,
+  answers bigint,
+  tips numeric,
+  score bigint
+)
+language sql
+stable
+as $$
+  with w as (select now() - since_interval as s),
+  parts as (
+    select r.user_id, r.posts, r.likes, r.reposts, r.answers, r.tips
+    from public.rollup_user_hourly r, w
+    where r.bucket >= date_trunc('hour', w.s) and r.bucket < ((w.s at time zone 'UTC')::date + 1)::timestamp at time zone 'UTC'
+    union all
+    select r.user_id, r.posts, r.likes, r.reposts, r.answers, r.tips
+    from public.rollup_user_daily r, w
+    where r.day > (w.s at time zone 'UTC')::date
+  ),
+  agg as (
+    select user_id, sum(posts)::bigint as posts, sum(likes)::bigint as likes,
+           sum(reposts)::bigint as reposts, sum(answers)::bigint as answers, sum(tips) as tips
+    from parts group by user_id
+  )
+  select a.user_id, u.handle, u.name, a.posts, a.likes, a.reposts, a.answers, a.tips,
+         a.posts + a.likes + 2 * a.reposts + a.answers as score
+  from agg a
+  left join public.sa_users u on u.id = a.user_id
+  order by score desc
+  limit greatest(1, least(limit_n, 100));
+$$;
+
+
+-- p_community: UUID or contract address (with/without 0x), like the raw timeseries RPC.
+create or replace function public.rollup_community_timeseries(p_community text, days_back integer default 14)
+returns table (
+  day date,
+  posts integer,
+  likes bigint,
+  reposts bigint,
+  answers bigint,
+  tips numeric,
+  active_users integer
+)
+language sql
+stable
+as $$
+  select r.day, r.posts, r.likes, r.reposts, r.answers, r.tips, r.active_users
+  from public.rollup_community_daily r
+  where r.community_id in (
+      select c.id from public.sa_communities c
+      where c.id::text = p_community
+         or regexp_replace(lower(coalesce(c.contract_address, '')), '^0x', '')
+            = regexp_replace(lower(p_community), '^0x', '')
+    )
+    and r.day >= (now() at time zone 'UTC')::date - greatest(1, least(days_back, 30))
+  order by r.day;
+$$;
+
+
+create or replace function public.rollup_top_friends(
+  p_start timestamp with time zone,
+  p_end timestamp with time zone,
+  p_limit integer default 20
+)
+returns table (
+  parent_user_handle text,
+  replies bigint,
+  last_reply_at timestamp with time zone
+)
+language sql
+stable
+as $$
+  select r.parent_user_handle, sum(r.replies)::bigint as replies, max(r.last_reply_at)
+  from public.rollup_bot_replies_hourly r
+  where r.bucket >= p_start and r.bucket < p_end
+  group by r.parent_user_handle
+  order by replies desc
+  limit greatest(1, least(p_limit, 100));
+$$;
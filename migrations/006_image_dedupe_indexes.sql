@@ -0,0 +1,11 @@
+-- Indexes for the vision-analysis dedupe lookups in function.py (_reuse_existing_analyses).
+-- Both run on every analyze_post; without these they are sequential scans.
+
+-- URL fingerprint (ingest.sha256_of_url) -> other images with the same source.
+create index IF not exists sa_images_sha256_idx
+  on public.sa_images using btree (sha256) TABLESPACE pg_default;
+
+-- Content hash recorded in analysis meta (VISION_DEDUPE_CONTENT_HASH). Partial: most rows have none.
+create index IF not exists sa_image_analysis_content_sha256_idx
+  on public.sa_image_analysis using btree ((meta->>'content_sha256')) TABLESPACE pg_default
+  where (meta->>'content_sha256') is not null;
@@ -0,0 +1,67 @@
+-- Vision backfill failure tracking (vision_backfill.py).
+-- Images whose analysis keeps failing back off (next_attempt_at) and are dropped from
+-- images_pending_analysis after p_max_failures tries, inside the query, so they can never
+-- crowd real work out of a batch.
+
+alter table public.sa_images
+  add column if not exists analysis_failures integer not null default 0;
+
+alter table public.sa_images
+  add column if not exists analysis_next_attempt_at timestamp with time zone null;
+
+
+-- The signature changes (p_max_failures), so drop the 001 version rather than add an overload.
+drop function if exists public.images_pending_analysis(integer, integer);
+
+create or replace function public.images_pending_analysis(
+  p_limit integer default 50,
+  p_max_age_days integer default 30,
+  p_max_failures integer default 3
+)
+returns table (
+  id bigint,
+  thread_id uuid,
+  source_url text,
+  storage_path text,
+  mime text,
+  width integer,
+  height integer,
+  is_gif boolean,
+  sha256 text,
+  priority double precision
+)
+language sql
+stable
+as $$
+  select
+    i.id, i.thread_id, i.source_url, i.storage_path, i.mime, i.width, i.height, i.is_gif, i.sha256,
+    (1 + coalesce(t.like_count, 0) + 2 * coalesce(t.repost_count, 0) + coalesce(t.answer_count, 0))::double precision
+      / power(greatest(extract(epoch from (now() - t.created_at)) / 3600.0, 0) + 2, 1.5) as priority
+  from public.sa_images i
+  join public.sa_threads t on t.id = i.thread_id
+  left join public.sa_image_analysis a on a.image_id = i.id
+  where a.image_id is null
+    and i.analysis_failures < p_max_failures
+    and (i.analysis_next_attempt_at is null or i.analysis_next_attempt_at <= now())
+    and t.created_at >= now() - make_interval(days => p_max_age_days)
+  order by priority desc
+  limit greatest(1, least(p_limit, 500));
+$$;
+
+
+-- Count one failed attempt per id; retry after 10m, 40m, 160m, ... (capped at a day).
+create or replace function public.record_image_analysis_failures(p_ids bigint[])
+returns integer
+language plpgsql
+as $$
+declare
+  n integer;
+begin
+  update public.sa_images i set
+    analysis_failures = i.analysis_failures + 1,
+    analysis_next_attempt_at = now() + least(interval '10 minutes' * power(4, i.analysis_failures), interval '1 day')
+  where i.id = any(p_ids);
+  get diagnostics n = row_count;
+  return n;
+end;
+$$;
@@ -0,0 +1,81 @@
+-- Keyset readers for the background pipelines, so they go through the `repo` layer (plain
+-- filters + RPCs) instead of PostgREST-only query syntax (embedded joins, or_ filters, is null).
+
+
+-- ANN mirror (ann_index.py): thread embeddings past a watermark, with the fields it filters/shows.
+create or replace function public.ann_embeddings_after(
+  p_after bigint default 0,
+  p_limit integer default 500
+)
+returns table (
+  id bigint,
+  thread_id uuid,
+  embedding vector,
+  created_at timestamp with time zone,
+  user_id uuid,
+  community_id uuid,
+  content_text text,
+  like_count integer,
+  repost_count integer,
+  handle text
+)
+language sql
+stable
+as $$
+  select e.id, e.thread_id, e.embedding, t.created_at, t.user_id, t.community_id, t.content_text,
+         t.like_count, t.repost_count, u.handle
+  from public.sa_embeddings e
+  left join public.sa_threads t on t.id = e.thread_id
+  left join public.sa_users u on u.id = t.user_id
+  where e.image_id is null
+    and e.id > coalesce(p_after, 0)
+  order by e.id
+  limit greatest(1, least(p_limit, 5000));
+$$;
+
+
+-- Image-embedding stage (image_embeddings.py): analyses after the (analyzed_at, image_id)
+-- watermark, in that order (served by sa_image_analysis_analyzed_at_idx). Null = from the start.
+-- analyzed_at is the writing transaction's start time (touch trigger), so a slow upsert can
+-- commit behind a watermark that already passed its timestamp; rows younger than
+-- p_settle_seconds are left for the next poll so in-flight writes land before they're passed.
+drop function if exists public.image_analyses_after(timestamp with time zone, bigint, integer);
+
+create or replace function public.image_analyses_after(
+  p_analyzed_at timestamp with time zone default null,
+  p_image_id bigint default 0,
+  p_limit integer default 64,
+  p_settle_seconds integer default 30
+)
+returns table (
+  image_id bigint,
+  caption text,
+  ocr_text text,
+  analyzed_at timestamp with time zone
+)
+language plpgsql
+stable
+as $$
+declare
+  v_before timestamp with time zone := now() - make_interval(secs => greatest(p_settle_seconds, 0));
+  v_limit integer := greatest(1, least(p_limit, 1000));
+begin
+  -- two branches rather than "p_analyzed_at is null or (...)", so the row comparison stays sargable
+  if p_analyzed_at is null then
+    return query
+      select a.image_id, a.caption, a.ocr_text, a.analyzed_at
+      from public.sa_image_analysis a
+      where a.analyzed_at < v_before
+      order by a.analyzed_at, a.image_id
+      limit v_limit;
+  else
+    return query
+      select a.image_id, a.caption, a.ocr_text, a.analyzed_at
+      from public.sa_image_analysis a
+      where (a.analyzed_at, a.image_id) > (p_analyzed_at, coalesce(p_image_id, 0))
+        and a.analyzed_at < v_before
+      order by a.analyzed_at, a.image_id
+      limit v_limit;
+  end if;
+end;
+$$;
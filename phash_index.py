@@ -0,0 +1,187 @@
+# phash_index.py
+import io
+import os
+import struct
+import threading
+import requests
+from array import array
+from typing import Dict, List, Optional, Tuple
+from PIL import Image
+import ref_image_cache
+import metrics
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+# -------------------------
+# Config
+# -------------------------
+INDEX_PATH     = os.getenv("PHASH_INDEX_PATH", "./phash_index.bin")
+MAX_DISTANCE   = int(os.getenv("PHASH_MAX_DISTANCE", "6"))   # hamming bits; <= ~6 is "same meme"
+MAX_BYTES      = int(os.getenv("PHASH_MAX_BYTES", str(8 * 1024 * 1024)))
+
+_RECORD = struct.Struct("<Qq")  # (dhash, image_id) — the file is an append-only log of these
+
+# -------------------------
+# Hashing
+# -------------------------
+def dhash_bytes(data: bytes) -> int:
+    """64-bit difference hash: 9x8 grayscale, one bit per horizontal gradient sign."""
+    img = Image.open(io.BytesIO(data))
+    img.seek(0)  # first frame of GIFs
+    img = img.convert("L").resize((9, 8), Image.LANCZOS)
+    px = img.tobytes()
+    h = 0
+    for row in range(8):
+        base = row * 9
+        for col in range(8):
+            h = (h << 1) | (px[base + col] > px[base + col + 1])
+    return h
+
+
+def hash_url(url: str) -> Optional[int]:
+    """Fetch (streamed, capped at PHASH_MAX_BYTES) and hash an image URL. None on failure."""
+    try:
+        with requests.get(url, timeout=(5, 20), stream=True) as r:
+            r.raise_for_status()
+            buf = bytearray()
+            for chunk in r.iter_content(64 * 1024):
+                buf.extend(chunk)
+                if len(buf) > MAX_BYTES:
+                    return None
+        return dhash_bytes(bytes(buf))
+    except Exception:
+        logger.debug("phash fetch failed | url=%s", url)
+        return None
+
+
+def hash_cached(url: str) -> Optional[int]:
+    """hash_url through ref_image_cache: bytes already fetched for this URL (content hash, image jobs) are reused."""
+    path = ref_image_cache.fetch(url, pin=True)
+    if not path:
+        return None
+    try:
+        if os.path.getsize(path) > MAX_BYTES:
+            return None
+        with open(path, "rb") as f:
+            return dhash_bytes(f.read())
+    except Exception:
+        logger.debug("phash hash failed | url=%s", url)
+        return None
+    finally:
+        ref_image_cache.release([path])
+
+
+# -------------------------
+# Index (multi-index hashing over an array-backed store)
+# -------------------------
+class PHashIndex:
+    """
+    Hashes/ids live in two parallel arrays. The 64 bits are split into MAX_DISTANCE+1 bands;
+    by pigeonhole any hash within MAX_DISTANCE of the query matches it exactly on at least one
+    band, so lookups only verify the candidates sharing a band value.
+    """
+
+    def __init__(self, path: str = INDEX_PATH, max_distance: int = MAX_DISTANCE):
+        self.path = path
+        self.max_distance = max_distance
+        nb = max_distance + 1
+        widths = [64 // nb + (1 if i < 64 % nb else 0) for i in range(nb)]
+        self._bands: List[Tuple[int, int]] = []  # (shift, mask)
+        shift = 64
+        for w in widths:
+            shift -= w
+            self._bands.append((shift, (1 << w) - 1))
+        self.hashes = array("Q")
+        self.ids = array("q")
+        self._tables: List[Dict[int, List[int]]] = [dict() for _ in self._bands]
+        self._seen_ids = set()
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _insert_locked(self, h: int, image_id: int) -> None:
+        pos = len(self.ids)
+        self.hashes.append(h)
+        self.ids.append(image_id)
+        self._seen_ids.add(image_id)
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            table.setdefault((h >> shift) & mask, []).append(pos)
+
+    def _refresh_locked(self) -> None:
+        """Pick up records appended by other processes (e.g. the ingest cron)."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size <= self._offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read(size - self._offset)
+        usable = len(data) - len(data) % _RECORD.size
+        for h, image_id in _RECORD.iter_unpack(data[:usable]):
+            if image_id not in self._seen_ids:
+                self._insert_locked(h, image_id)
+        self._offset += usable
+
+    def add(self, image_id: int, h: int) -> None:
+        with self._lock:
+            self._refresh_locked()
+            if image_id in self._seen_ids:
+                return
+            with open(self.path, "ab") as f:
+                f.write(_RECORD.pack(h, image_id))
+            self._offset += _RECORD.size
+            self._insert_locked(h, image_id)
+
+    def query(self, h: int, max_distance: Optional[int] = None, limit: int = 20) -> List[Tuple[int, int]]:
+        """[(image_id, distance)] sorted by distance, within max_distance (<= index max)."""
+        d_max = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        with self._lock:
+            self._refresh_locked()
+            cand = set()
+            for table, (shift, mask) in zip(self._tables, self._bands):
+                cand.update(table.get((h >> shift) & mask, ()))
+            out = []
+            for pos in cand:
+                d = (self.hashes[pos] ^ h).bit_count()
+                if d <= d_max:
+                    out.append((self.ids[pos], d))
+        out.sort(key=lambda x: x[1])
+        return out[:limit]
+
+
+_index: Optional[PHashIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> PHashIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = PHashIndex()
+            with _index._lock:
+                _index._refresh_locked()
+            logger.info("phash index loaded | images=%s | path=%s", len(_index), INDEX_PATH)
+        return _index
+
+
+def index_image(image_id: int, url: str) -> Optional[int]:
+    """Hash `url` and add it under `image_id`. Returns the hash (or None if it couldn't be fetched)."""
+    h = hash_url(url)
+    if h is not None:
+        get_index().add(image_id, h)
+        metrics.incr("phash.indexed")
+    return h
+
+
+def find_near_duplicates(url: str, max_distance: Optional[int] = None, limit: int = 20,
+                         exclude_ids=()) -> List[Tuple[int, int]]:
+    """[(image_id, distance)] of indexed images that look like `url`."""
+    h = hash_url(url)
+    if h is None:
+        return []
+    return [(i, d) for i, d in get_index().query(h, max_distance, limit + len(exclude_ids)) if i not in exclude_ids][:limit]
@@ -0,0 +1,100 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    """
+    Token bucket: refills `rate` tokens per second, banks at most `capacity`.
+    A rate <= 0 disables limiting (acquire always succeeds immediately).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, self.rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, n: float, burst: Optional[float] = None) -> "TokenBucket":
+        return cls(float(n) / 60.0, burst if burst is not None else max(1.0, float(n) / 60.0))
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, n: float = 1.0) -> bool:
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            self._refill()
+            if self._tokens >= n:
+                self._tokens -= n
+                return True
+            return False
+
+    def acquire(self, n: float = 1.0, timeout: Optional[float] = None) -> bool:
+        """Block until `n` tokens are available. Returns False if `timeout` elapses first."""
+        if self.rate <= 0:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return True
+                wait = (n - self._tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+class KeyedSemaphore:
+    """
+    One bounded semaphore per key (e.g. per model/provider), created lazily.
+    `limits` overrides the default cap for specific keys.
+    """
+
+    def __init__(self, default_limit: int, limits: Optional[Dict[str, int]] = None):
+        self.default_limit = max(1, int(default_limit))
+        self.limits = dict(limits or {})
+        self._sems: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _sem(self, key: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            sem = self._sems.get(key)
+            if sem is None:
+                sem = threading.BoundedSemaphore(max(1, int(self.limits.get(key, self.default_limit))))
+                self._sems[key] = sem
+            return sem
+
+    @contextmanager
+    def limit(self, key: str):
+        sem = self._sem(key)
+        sem.acquire()
+        try:
+            yield
+        finally:
+            sem.release()
+
+
+def parse_limits(spec: str) -> Dict[str, int]:
+    """Parse "modelA=2,modelB=1" into {"modelA": 2, "modelB": 1}; bad entries are ignored."""
+    out: Dict[str, int] = {}
+    for part in (spec or "").split(","):
+        key, sep, val = part.partition("=")
+        if not sep:
+            continue
+        try:
+            out[key.strip()] = int(val)
+        except ValueError:
+            continue
+    return out
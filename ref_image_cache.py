@@ -0,0 +1,273 @@
+# ref_image_cache.py
+import os
+import json
+import time
+import hashlib
+import pathlib
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+import metrics
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+# -------------------------
+# Config
+# -------------------------
+CACHE_DIR = pathlib.Path(os.getenv("REF_IMG_CACHE_DIR", "./ref_image_cache"))
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+CACHE_MAX_BYTES    = int(os.getenv("REF_IMG_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+MAX_DOWNLOAD_BYTES = int(os.getenv("REF_IMG_MAX_BYTES", str(10 * 1024 * 1024)))
+REVALIDATE_SECONDS = int(os.getenv("REF_IMG_REVALIDATE_SECONDS", "3600"))
+DOWNLOAD_WORKERS   = int(os.getenv("REF_IMG_DOWNLOAD_WORKERS", "4"))
+_MIN_BYTES = 500  # smaller than this is almost always an error page / empty body
+_CHUNK = 64 * 1024
+
+_INDEX_PATH = CACHE_DIR / "index.json"
+
+# url -> {"sha256", "ext", "size", "etag", "last_modified", "checked_at", "used_at"}
+_index: Dict[str, Dict[str, Any]] = {}
+# blob file name -> number of callers holding its path (fetch(pin=True) until release()); never evicted
+_pins: Dict[str, int] = {}
+_lock = threading.Lock()
+
+_session = requests.Session()
+_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=DOWNLOAD_WORKERS * 2))
+_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=DOWNLOAD_WORKERS * 2))
+
+
+def _safe_ext_from_content_type(ct: str) -> str:
+    ct = (ct or "").lower()
+    if "jpeg" in ct or "jpg" in ct:
+        return ".jpg"
+    if "png" in ct:
+        return ".png"
+    if "webp" in ct:
+        return ".webp"
+    return ".png"  # default
+
+
+def _blob_path(sha: str, ext: str) -> pathlib.Path:
+    return CACHE_DIR / f"{sha}{ext}"
+
+
+def _load_index() -> None:
+    global _index
+    try:
+        with open(_INDEX_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        _index = {u: e for u, e in data.items() if _blob_path(e["sha256"], e["ext"]).exists()}
+    except FileNotFoundError:
+        _index = {}
+    except Exception:
+        logger.exception("ref image cache index unreadable; starting empty")
+        _index = {}
+
+
+def _save_index_locked() -> None:
+    tmp = _INDEX_PATH.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(_index, f)
+    os.replace(tmp, _INDEX_PATH)
+
+
+def _pin_locked(e: Dict[str, Any]) -> None:
+    key = e["sha256"] + e["ext"]
+    _pins[key] = _pins.get(key, 0) + 1
+
+
+def release(paths: List[str]) -> None:
+    """Unpin paths returned by fetch(pin=True) / fetch_many(pin=True) once the caller is done reading them."""
+    with _lock:
+        for p in paths or []:
+            key = pathlib.Path(p).name
+            n = _pins.get(key, 0) - 1
+            if n > 0:
+                _pins[key] = n
+            else:
+                _pins.pop(key, None)
+
+
+def _evict_locked() -> None:
+    """Drop least-recently-used URLs until unique blob bytes fit under CACHE_MAX_BYTES (pinned blobs stay)."""
+    blobs: Dict[str, int] = {}
+    for e in _index.values():
+        blobs[e["sha256"] + e["ext"]] = e["size"]
+    total = sum(blobs.values())
+    if total <= CACHE_MAX_BYTES:
+        return
+    for url, e in sorted(_index.items(), key=lambda kv: kv[1].get("used_at", 0)):
+        if total <= CACHE_MAX_BYTES:
+            break
+        key = e["sha256"] + e["ext"]
+        if key in _pins:
+            continue  # another worker is about to read it
+        del _index[url]
+        still_used = any(o["sha256"] + o["ext"] == key for o in _index.values())
+        if not still_used:
+            try:
+                _blob_path(e["sha256"], e["ext"]).unlink(missing_ok=True)
+            except Exception:
+                pass
+            total -= blobs.get(key, 0)
+            metrics.incr("ref_cache.evicted")
+
+
+def _stream_to_blob(resp: requests.Response) -> Optional[Dict[str, Any]]:
+    """
+    Stream a response body into a temp file, enforcing MAX_DOWNLOAD_BYTES. The returned
+    entry carries the temp path under "tmp"; _place_blob_locked moves it into the cache.
+    """
+    declared = resp.headers.get("Content-Length")
+    if declared and declared.isdigit() and int(declared) > MAX_DOWNLOAD_BYTES:
+        logger.warning("ref image too large | url=%s | bytes=%s", resp.url, declared)
+        return None
+
+    h = hashlib.sha256()
+    size = 0
+    tmp = CACHE_DIR / f"dl_{os.urandom(4).hex()}.part"
+    keep = False
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in resp.iter_content(_CHUNK):
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > MAX_DOWNLOAD_BYTES:
+                    logger.warning("ref image exceeded max bytes | url=%s", resp.url)
+                    return None
+                h.update(chunk)
+                f.write(chunk)
+        if size < _MIN_BYTES:
+            return None
+        ext = _safe_ext_from_content_type(resp.headers.get("Content-Type", ""))
+        keep = True
+        return {"sha256": h.hexdigest(), "ext": ext, "size": size, "tmp": str(tmp)}
+    finally:
+        if not keep and tmp.exists():
+            try:
+                tmp.unlink()
+            except Exception:
+                pass
+
+
+def _place_blob_locked(tmp: str, e: Dict[str, Any]) -> pathlib.Path:
+    """
+    Move a downloaded temp file to its content-addressed path. Runs under _lock together with
+    the index insert, so eviction can't unlink the blob between placing and indexing it.
+    """
+    dest = _blob_path(e["sha256"], e["ext"])
+    if dest.exists():
+        os.unlink(tmp)  # same bytes already cached under another URL
+    else:
+        os.replace(tmp, dest)
+    return dest
+
+
+def fetch(url: str, pin: bool = False) -> Optional[str]:
+    """
+    Return a local path for `url`, downloading or revalidating (ETag/Last-Modified) as needed.
+    Returns None on failure (kept quiet so the pipeline keeps flowing). With pin=True the blob
+    is kept out of eviction until release([path]), so the path stays valid while it is handed on.
+    """
+    now = time.time()
+    with _lock:
+        entry = dict(_index[url]) if url in _index else None
+        if entry and now - entry.get("checked_at", 0) < REVALIDATE_SECONDS:
+            path = _blob_path(entry["sha256"], entry["ext"])
+            if path.exists():
+                _index[url]["used_at"] = now
+                if pin:
+                    _pin_locked(entry)
+                metrics.incr("ref_cache.hit")
+                return str(path.resolve())
+            entry = None
+
+    headers = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    new_entry = None
+    for _ in range(2):
+        try:
+            with _session.get(url, headers=headers, timeout=(5, 25), stream=True) as r:
+                if r.status_code == 304 and entry:
+                    with _lock:
+                        path = _blob_path(entry["sha256"], entry["ext"])
+                        if path.exists():
+                            metrics.incr("ref_cache.revalidated")
+                            entry.update({"checked_at": now, "used_at": now})
+                            _index[url] = entry
+                            if pin:
+                                _pin_locked(entry)
+                            _save_index_locked()
+                            return str(path.resolve())
+                    # evicted while we were revalidating: download it again, unconditionally
+                    headers, entry = {}, None
+                    continue
+                r.raise_for_status()
+                blob = _stream_to_blob(r)
+                if not blob:
+                    return None
+                metrics.incr("ref_cache.miss")
+                new_entry = {
+                    **blob,
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "checked_at": now,
+                    "used_at": now,
+                }
+        except Exception:
+            logger.warning("ref image download failed | url=%s", url)
+            return None
+        break
+    if new_entry is None:
+        return None
+
+    tmp = new_entry.pop("tmp")
+    with _lock:
+        try:
+            path = _place_blob_locked(tmp, new_entry)
+        except OSError:
+            logger.warning("ref image cache write failed | url=%s", url)
+            pathlib.Path(tmp).unlink(missing_ok=True)
+            return None
+        _index[url] = new_entry
+        _evict_locked()
+        _save_index_locked()
+        if url not in _index or not path.exists():  # evicted immediately (larger than the whole cache)
+            return None
+        if pin:
+            _pin_locked(new_entry)
+        return str(path.resolve())
+
+
+def content_sha256(url: str) -> Optional[str]:
+    """sha256 of the bytes behind `url` (fetched through the cache), or None on failure."""
+    path = fetch(url)
+    if not path:
+        return None
+    return pathlib.Path(path).stem  # blobs are named by their content hash
+
+
+def fetch_many(urls: List[str], pin: bool = False) -> List[str]:
+    """Fetch several URLs concurrently; returns local paths for the successes, in input order."""
+    urls = [u for u in (urls or []) if isinstance(u, str) and u]
+    if not urls:
+        return []
+    if len(urls) == 1:
+        p = fetch(urls[0], pin)
+        return [p] if p else []
+    with metrics.timer("ref_cache.fetch_many"):
+        with ThreadPoolExecutor(max_workers=min(DOWNLOAD_WORKERS, len(urls))) as ex:
+            paths = list(ex.map(lambda u: fetch(u, pin), urls))
+    return [p for p in paths if p]
+
+
+_load_index()
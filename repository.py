@@ -0,0 +1,519 @@
+# repository.py
+import io
+import os
+import re
+import json
+import uuid
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, time as dtime
+from decimal import Decimal
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Union
+import metrics
+import tracing
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+# Data-access layer shared by ingest/function/terminalAI. Two backends with one surface:
+#
+#   PostgrestRepository  the supabase client (HTTP + JSON per call) - default
+#   PostgresRepository   pooled direct connections (psycopg2): execute_values / COPY for bulk
+#                        writes, server-side cursors for scans, one transaction per call
+#
+# db.py picks one (DB_BACKEND / DATABASE_URL) and exposes it as `repo`. Results always come
+# back in PostgREST's JSON shapes (uuids and timestamps as strings, numerics as numbers), so
+# callers don't care which backend answered.
+
+# -------------------------
+# Config
+# -------------------------
+PG_POOL_MIN          = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX          = int(os.getenv("PG_POOL_MAX", "8"))
+PG_COPY_MIN_ROWS     = int(os.getenv("PG_COPY_MIN_ROWS", "500"))    # bulk upserts at/above this use COPY
+PG_STATEMENT_TIMEOUT = int(os.getenv("PG_STATEMENT_TIMEOUT_MS", "30000"))
+
+Rows = Union[Dict[str, Any], Sequence[Dict[str, Any]]]
+
+
+class Result(NamedTuple):
+    data: List[Dict[str, Any]]
+    count: Optional[int] = None
+
+
+class Repository:
+    """
+    Interface. Filters are simple dicts: eq={"user_id": uid}, in_={"id": ids},
+    ilike={"handle": h}. Column names may use a JSON path ("meta->>content_sha256").
+    """
+
+    def select(self, table: str, columns: str = "*", *, eq: Optional[Dict[str, Any]] = None,
+               in_: Optional[Dict[str, Iterable[Any]]] = None, ilike: Optional[Dict[str, str]] = None,
+               order: Optional[str] = None, desc: bool = False, limit: Optional[int] = None,
+               count: bool = False) -> Result:
+        raise NotImplementedError
+
+    def insert(self, table: str, rows: Rows) -> int:
+        raise NotImplementedError
+
+    def upsert(self, table: str, rows: Rows, *, on_conflict: Optional[str] = None,
+               ignore_duplicates: bool = False) -> int:
+        """Insert or update on `on_conflict` (comma-separated columns; default: primary key)."""
+        raise NotImplementedError
+
+    def rpc(self, fn: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        """Call a public function by named arguments; rows for set/table functions, else the scalar."""
+        raise NotImplementedError
+
+    def scan(self, table: str, columns: str = "*", *, eq: Optional[Dict[str, Any]] = None,
+             key: str = "id", after: Any = None, batch: int = 1000) -> Iterator[Dict[str, Any]]:
+        """Every matching row ordered by `key` (> `after`), fetched `batch` rows at a time."""
+        raise NotImplementedError
+
+
+def _as_list(rows: Rows) -> List[Dict[str, Any]]:
+    return [rows] if isinstance(rows, dict) else list(rows)
+
+
+# -------------------------
+# PostgREST (supabase client)
+# -------------------------
+class PostgrestRepository(Repository):
+    name = "postgrest"
+
+    def __init__(self, client):
+        self.client = client
+
+    def _filtered(self, q, eq, in_, ilike):
+        for col, v in (eq or {}).items():
+            q = q.eq(col, v)
+        for col, vs in (in_ or {}).items():
+            q = q.in_(col, list(vs))
+        for col, v in (ilike or {}).items():
+            q = q.ilike(col, v)
+        return q
+
+    def select(self, table, columns="*", *, eq=None, in_=None, ilike=None, order=None, desc=False,
+               limit=None, count=False):
+        q = self.client.table(table).select(columns, count="exact" if count else None)
+        q = self._filtered(q, eq, in_, ilike)
+        if order:
+            q = q.order(order, desc=desc)
+        if limit is not None:
+            q = q.limit(limit)
+        res = q.execute()
+        return Result(res.data or [], getattr(res, "count", None))
+
+    def insert(self, table, rows):
+        rows = _as_list(rows)
+        if not rows:
+            return 0
+        self.client.table(table).insert(rows).execute()
+        return len(rows)
+
+    def upsert(self, table, rows, *, on_conflict=None, ignore_duplicates=False):
+        rows = _as_list(rows)
+        if not rows:
+            return 0
+        self.client.table(table).upsert(rows, on_conflict=on_conflict or "",
+                                        ignore_duplicates=ignore_duplicates).execute()
+        return len(rows)
+
+    def rpc(self, fn, params=None):
+        return self.client.rpc(fn, params or {}).execute().data
+
+    def scan(self, table, columns="*", *, eq=None, key="id", after=None, batch=1000):
+        while True:
+            q = self._filtered(self.client.table(table).select(columns), eq, None, None)
+            if after is not None:
+                q = q.gt(key, after)
+            rows = q.order(key).limit(batch).execute().data or []
+            yield from rows
+            if len(rows) < batch:
+                return
+            after = rows[-1][key]
+
+
+# -------------------------
+# Direct Postgres (psycopg2)
+# -------------------------
+_IDENT_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_JSON_PATH_RE = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)->(>?)([A-Za-z0-9_]+)$")
+
+
+def _ident(name: str) -> str:
+    if not _IDENT_RE.match(name):
+        raise ValueError(f"bad identifier: {name!r}")
+    return f'"{name}"'
+
+
+def _col(expr: str) -> str:
+    """Column reference; also accepts PostgREST-style JSON paths (meta->>key)."""
+    m = _JSON_PATH_RE.match(expr.strip())
+    if m:
+        return f"{_ident(m.group(1))}->{m.group(2)}'{m.group(3)}'"
+    return _ident(expr.strip())
+
+
+def _select_list(columns: str) -> str:
+    if columns.strip() == "*":
+        return "*"
+    return ", ".join(_col(c) for c in columns.split(",") if c.strip())
+
+
+def _jsonable(v: Any) -> Any:
+    # psycopg2 -> the shapes PostgREST would have returned
+    if isinstance(v, (datetime, date, dtime)):
+        return v.isoformat()
+    if isinstance(v, Decimal):
+        return int(v) if v == v.to_integral_value() else float(v)
+    if isinstance(v, uuid.UUID):
+        return str(v)
+    if isinstance(v, list):
+        return [_jsonable(x) for x in v]
+    return v
+
+
+def _row(r) -> Dict[str, Any]:
+    return {k: _jsonable(v) for k, v in r.items()}
+
+
+def _vector_literal(v: Any) -> Any:
+    if isinstance(v, (list, tuple)):
+        return "[" + ",".join(repr(float(x)) for x in v) + "]"
+    return v
+
+
+def _array_literal(items: Iterable[Any]) -> str:
+    out = []
+    for x in items:
+        if x is None:
+            out.append("NULL")
+        else:
+            s = str(x).replace("\\", "\\\\").replace('"', '\\"')
+            out.append(f'"{s}"')
+    return "{" + ",".join(out) + "}"
+
+
+def _copy_field(v: Any, typ: str) -> str:
+    """One CSV field for COPY: unquoted empty = NULL, everything else quoted."""
+    if v is None:
+        return ""
+    if typ in ("json", "jsonb"):
+        s = json.dumps(v, default=str)
+    elif typ == "vector":
+        s = _vector_literal(v)
+    elif typ.endswith("[]") and isinstance(v, (list, tuple)):
+        s = _array_literal(v)
+    elif isinstance(v, bool):
+        s = "t" if v else "f"
+    elif isinstance(v, (datetime, date)):
+        s = v.isoformat()
+    else:
+        s = str(v)
+    return '"' + s.replace('"', '""') + '"'
+
+
+class _Proc(NamedTuple):
+    arg_types: Dict[str, str]
+    returns_rows: bool   # table / composite / record results -> list of dicts
+    returns_set: bool    # setof <scalar> -> list of values; neither -> one value (None for void)
+    returns_void: bool
+
+
+class PostgresRepository(Repository):
+    """
+    Direct connections from a ThreadedConnectionPool. Each call runs in its own transaction on a
+    pooled connection; callers block (rather than fail) when all PG_POOL_MAX are busy. Keeping
+    sessions open also lets plpgsql functions reuse their cached plans across calls.
+    """
+    name = "postgres"
+
+    def __init__(self, dsn: str, minconn: int = PG_POOL_MIN, maxconn: int = PG_POOL_MAX):
+        import psycopg2
+        import psycopg2.extras
+        import psycopg2.pool
+
+        self._extras = psycopg2.extras
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn, dsn,
+            options=f"-c statement_timeout={PG_STATEMENT_TIMEOUT}",
+            application_name="gladius",
+        )
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._meta_lock = threading.Lock()
+        self._columns: Dict[str, Dict[str, str]] = {}
+        self._pkeys: Dict[str, List[str]] = {}
+        self._procs: Dict[str, List[_Proc]] = {}
+        logger.info("postgres repository ready | pool_max=%s", maxconn)
+
+    # ---- connections ----
+    @contextmanager
+    def _conn(self):
+        self._slots.acquire()
+        conn = self._pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:  # incl. GeneratorExit from an abandoned scan()
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self._pool.putconn(conn, close=bool(conn.closed))
+            self._slots.release()
+
+    @contextmanager
+    def _cursor(self):
+        with self._conn() as conn:
+            with conn.cursor(cursor_factory=self._extras.RealDictCursor) as cur:
+                yield cur
+
+    # ---- catalog (cached per process) ----
+    def _column_types(self, table: str) -> Dict[str, str]:
+        cols = self._columns.get(table)
+        if cols is None:
+            with self._cursor() as cur:
+                cur.execute(
+                    """
+                    select a.attname as name, format_type(a.atttypid, null) as typ
+                    from pg_attribute a
+                    where a.attrelid = ('public.' || quote_ident(%s))::regclass
+                      and a.attnum > 0 and not a.attisdropped
+                    """,
+                    (table,),
+                )
+                cols = {r["name"]: r["typ"] for r in cur.fetchall()}
+                cur.execute(
+                    """
+                    select a.attname as name
+                    from pg_index i
+                    join pg_attribute a on a.attrelid = i.indrelid and a.attnum = any(i.indkey)
+                    where i.indrelid = ('public.' || quote_ident(%s))::regclass and i.indisprimary
+                    """,
+                    (table,),
+                )
+                pkey = [r["name"] for r in cur.fetchall()]
+            with self._meta_lock:
+                self._columns[table] = cols
+                self._pkeys[table] = pkey
+        return cols
+
+    def _proc(self, fn: str, params: Dict[str, Any]) -> _Proc:
+        procs = self._procs.get(fn)
+        if procs is None:
+            with self._cursor() as cur:
+                cur.execute(
+                    """
+                    select p.proretset as returns_set, rt.typtype as ret_kind, rt.typname as ret_name,
+                           coalesce(array_agg(a.name order by a.ord)
+                                    filter (where a.mode in ('i', 'b', 'v')), '{}') as arg_names,
+                           coalesce(array_agg(format_type(a.typ, null) order by a.ord)
+                                    filter (where a.mode in ('i', 'b', 'v')), '{}') as arg_types
+                    from pg_proc p
+                    join pg_type rt on rt.oid = p.prorettype
+                    left join lateral unnest(
+                      coalesce(p.proallargtypes, p.proargtypes::oid[]),
+                      p.proargnames,
+                      coalesce(p.proargmodes, array_fill('i'::"char",
+                               array[cardinality(coalesce(p.proallargtypes, p.proargtypes::oid[]))]))
+                    ) with ordinality as a(typ, name, mode, ord) on true
+                    where p.pronamespace = 'public'::regnamespace and p.proname = %s
+                    group by p.oid, p.proretset, rt.typtype, rt.typname
+                    """,
+                    (fn,),
+                )
+                procs = [
+                    _Proc(
+                        dict(zip(r["arg_names"], r["arg_types"])),
+                        r["ret_kind"] == "c" or r["ret_name"] == "record",
+                        bool(r["returns_set"]),
+                        r["ret_name"] == "void",
+                    )
+                    for r in cur.fetchall()
+                ]
+            if not procs:
+                raise ValueError(f"unknown function: public.{fn}")
+            with self._meta_lock:
+                self._procs[fn] = procs
+        # overloads: the smallest signature that takes every given argument
+        fits = [p for p in procs if set(params) <= set(p.arg_types)]
+        if not fits:
+            raise ValueError(f"no public.{fn} overload takes {sorted(params)}")
+        return min(fits, key=lambda p: len(p.arg_types))
+
+    def _adapt(self, v: Any, typ: str) -> Any:
+        if v is None:
+            return None
+        if typ in ("json", "jsonb"):
+            return self._extras.Json(v, dumps=lambda o: json.dumps(o, default=str))
+        if typ == "vector":
+            return _vector_literal(v)
+        return v
+
+    # ---- reads ----
+    def _where(self, table, eq, in_, ilike):
+        types = self._column_types(table) if in_ else {}
+        parts, vals = [], []
+        for col, v in (eq or {}).items():
+            parts.append(f"{_col(col)} = %s")
+            vals.append(v)
+        for col, vs in (in_ or {}).items():
+            typ = types.get(col, "text")
+            parts.append(f"{_col(col)} = any(%s::{typ}[])")
+            vals.append(list(vs))
+        for col, v in (ilike or {}).items():
+            parts.append(f"{_col(col)} ilike %s")
+            vals.append(v)
+        return (" where " + " and ".join(parts)) if parts else "", vals
+
+    def select(self, table, columns="*", *, eq=None, in_=None, ilike=None, order=None, desc=False,
+               limit=None, count=False):
+        where, vals = self._where(table, eq, in_, ilike)
+        src = f"public.{_ident(table)}{where}"
+        sql = f"select {_select_list(columns)} from {src}"
+        if order:
+            sql += f" order by {_col(order)} {'desc' if desc else 'asc'}"
+        if limit is not None:
+            sql += f" limit {int(limit)}"
+        with metrics.timer("db.pg.select"), self._cursor() as cur:
+            cur.execute(sql, vals)
+            rows = [_row(r) for r in cur.fetchall()]
+            total = None
+            if count:
+                cur.execute(f"select count(*) as n from {src}", vals)
+                total = cur.fetchone()["n"]
+        return Result(rows, total)
+
+    def scan(self, table, columns="*", *, eq=None, key="id", after=None, batch=1000):
+        where, vals = self._where(table, eq, None, None)
+        if after is not None:
+            where += (" and " if where else " where ") + f"{_ident(key)} > %s"
+            vals.append(after)
+        sql = f"select {_select_list(columns)} from public.{_ident(table)}{where} order by {_ident(key)}"
+        with self._conn() as conn:
+            # named cursor = server-side: rows stream in `batch`-sized fetches, not all at once
+            with conn.cursor(name=f"scan_{uuid.uuid4().hex[:12]}",
+                             cursor_factory=self._extras.RealDictCursor) as cur:
+                cur.itersize = batch
+                cur.execute(sql, vals)
+                for r in cur:
+                    yield _row(r)
+
+    def rpc(self, fn, params=None):
+        params = params or {}
+        proc = self._proc(fn, params)
+        args = ", ".join(f"{_ident(k)} => %s::{proc.arg_types[k]}" for k in params)
+        vals = [self._adapt(v, proc.arg_types[k]) for k, v in params.items()]
+        with metrics.timer(f"db.pg.rpc.{fn}"), self._cursor() as cur:
+            cur.execute(f"select * from public.{_ident(fn)}({args})", vals)
+            rows = cur.fetchall()
+        if proc.returns_rows:
+            return [_row(r) for r in rows]
+        if proc.returns_void:
+            return None
+        if proc.returns_set:
+            return [_jsonable(r[fn]) for r in rows]
+        return _jsonable(rows[0][fn]) if rows else None
+
+    # ---- writes ----
+    def _prepare_rows(self, table, rows, conflict):
+        rows = _as_list(rows)
+        types = self._column_types(table)
+        cols = sorted({k for r in rows for k in r})
+        unknown = [c for c in cols if c not in types]
+        if unknown:
+            raise ValueError(f"unknown columns for {table}: {unknown}")
+        if conflict and all(c in cols for c in conflict):
+            # one statement can't touch the same row twice; last write wins, like sequential upserts
+            dedup = {tuple(r.get(c) for c in conflict): r for r in rows}
+            rows = list(dedup.values())
+        return rows, cols, types
+
+    def _conflict_cols(self, table, on_conflict):
+        if on_conflict:
+            return [c.strip() for c in on_conflict.split(",") if c.strip()]
+        self._column_types(table)
+        return list(self._pkeys.get(table) or [])
+
+    def _write(self, table, rows, conflict, ignore_duplicates):
+        rows, cols, types = self._prepare_rows(table, rows, conflict)
+        if not rows:
+            return 0
+        col_sql = ", ".join(_ident(c) for c in cols)
+        on_conflict = ""
+        if conflict:
+            updates = [c for c in cols if c not in conflict]
+            if ignore_duplicates or not updates:
+                action = "do nothing"
+            else:
+                action = "do update set " + ", ".join(f"{_ident(c)} = excluded.{_ident(c)}" for c in updates)
+            on_conflict = f" on conflict ({', '.join(_ident(c) for c in conflict)}) {action}"
+
+        with self._cursor() as cur:
+            if len(rows) >= PG_COPY_MIN_ROWS:
+                stage = f"_stage_{uuid.uuid4().hex[:12]}"
+                cur.execute(f"create temp table {stage} on commit drop as "
+                            f"select {col_sql} from public.{_ident(table)} with no data")
+                buf = io.StringIO()
+                for r in rows:
+                    buf.write(",".join(_copy_field(r.get(c), types[c]) for c in cols))
+                    buf.write("\n")
+                buf.seek(0)
+                cur.copy_expert(f"copy {stage} ({col_sql}) from stdin with (format csv)", buf)
+                cur.execute(f"insert into public.{_ident(table)} ({col_sql}) "
+                            f"select {col_sql} from {stage}{on_conflict}")
+                metrics.incr("db.pg.copy_rows", len(rows))
+            else:
+                template = "(" + ", ".join(f"%s::{types[c]}" for c in cols) + ")"
+                values = [tuple(self._adapt(r.get(c), types[c]) for c in cols) for r in rows]
+                self._extras.execute_values(
+                    cur, f"insert into public.{_ident(table)} ({col_sql}) values %s{on_conflict}",
+                    values, template=template, page_size=1000,
+                )
+        return len(rows)
+
+    def insert(self, table, rows):
+        with metrics.timer("db.pg.insert"):
+            return self._write(table, rows, [], False)
+
+    def upsert(self, table, rows, *, on_conflict=None, ignore_duplicates=False):
+        with metrics.timer("db.pg.upsert"):
+            return self._write(table, rows, self._conflict_cols(table, on_conflict), ignore_duplicates)
+
+
+# -------------------------
+# Tracing wrapper
+# -------------------------
+class TracedRepository(Repository):
+    """Puts a tracing span around every call of another repository (db.py wraps `repo` when tracing is on)."""
+
+    def __init__(self, inner: Repository):
+        self.inner = inner
+        self.name = inner.name
+
+    def select(self, table, columns="*", **kw):
+        with tracing.span("db.select", table=table, backend=self.name):
+            return self.inner.select(table, columns, **kw)
+
+    def insert(self, table, rows):
+        with tracing.span("db.insert", table=table, backend=self.name):
+            return self.inner.insert(table, rows)
+
+    def upsert(self, table, rows, **kw):
+        with tracing.span("db.upsert", table=table, backend=self.name):
+            return self.inner.upsert(table, rows, **kw)
+
+    def rpc(self, fn, params=None):
+        with tracing.span("db.rpc", fn=fn, backend=self.name):
+            return self.inner.rpc(fn, params)
+
+    def scan(self, table, columns="*", **kw):
+        # a scan is consumed lazily by the caller; the span covers the first batch only
+        with tracing.span("db.scan", table=table, backend=self.name):
+            it = iter(self.inner.scan(table, columns, **kw))
+            first = next(it, None)
+        if first is None:
+            return
+        yield first
+        yield from it
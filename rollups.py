@@ -0,0 +1,37 @@
+# rollups.py
+import os
+import time
+from typing import Iterable
+from db import repo
+import metrics
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+# Writers of sa_threads call refresh_for_threads() with the ids they touched so the
+# hourly/daily rollup buckets (migrations/005) stay current. Failures are logged, never raised:
+# a missed bucket is repaired the next time any thread in it is written, or by rebuild_rollups.
+ENABLED    = os.getenv("ROLLUPS_ENABLED", "1").lower() not in ("0", "false", "no")
+CHUNK_SIZE = int(os.getenv("ROLLUPS_CHUNK", "500"))
+
+
+def refresh_for_threads(thread_ids: Iterable[str]) -> int:
+    """Recompute the rollup buckets these threads fall into. Returns buckets touched."""
+    if not ENABLED:
+        return 0
+    ids = list(dict.fromkeys(t for t in thread_ids if t))
+    touched = 0
+    for k in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[k : k + CHUNK_SIZE]
+        t0 = time.perf_counter()
+        try:
+            n = repo.rpc("refresh_rollups_for_threads", {"p_thread_ids": chunk})
+            touched += int(n or 0) if isinstance(n, (int, float)) else 0
+        except Exception:
+            metrics.incr("rollups.refresh_failed")
+            logger.exception("rollup refresh failed | threads=%s", len(chunk))
+            continue
+        metrics.observe("rollups.refresh", time.perf_counter() - t0)
+    if ids:
+        logger.info("rollups refreshed | threads=%s | buckets=%s", len(ids), touched)
+    return touched
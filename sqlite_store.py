@@ -0,0 +1,693 @@
+# sqlite_store.py
+import os
+import re
+import json
+import uuid
+import atexit
+import shutil
+import pathlib
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from repository import Repository, Result, _as_list
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+# Local stand-in for the Supabase database: same Repository surface as repository.py, backed by
+# one SQLite file. For offline runs, load tests and single-node deployments (DB_BACKEND=sqlite).
+#
+# Tables come from migrations/init.sql + the numbered migrations, translated on open (column
+# types mapped, pg-only indexes skipped), so the two schemas can't drift. Values are stored so
+# that string comparison works: timestamps as UTC ISO text with microseconds, json/arrays as
+# JSON text, vectors as float32 blobs. Reads return PostgREST's shapes.
+#
+# The RPCs the tools and background workers call are reimplemented here (see _rpc_*). Rollup
+# readers answer from the base tables directly, so refresh_rollups_for_threads is a no-op.
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "./gladius.sqlite3")
+_MIGRATIONS_DIR = pathlib.Path(__file__).resolve().parent / "migrations"
+
+
+# -------------------------
+# Value encoding
+# -------------------------
+def _ts(v: Any) -> Any:
+    """Canonical UTC timestamp text (fixed width, so text order == time order)."""
+    if v is None:
+        return None
+    if isinstance(v, datetime):
+        d = v
+    else:
+        try:
+            d = datetime.fromisoformat(str(v).strip().replace("Z", "+00:00").replace(" ", "T", 1))
+        except ValueError:
+            return str(v)
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=timezone.utc)
+    return d.astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+
+def _vec(v: Any) -> np.ndarray:
+    if isinstance(v, (bytes, memoryview)):
+        return np.frombuffer(v, dtype=np.float32)
+    if isinstance(v, str):
+        v = json.loads(v)
+    return np.asarray(v, dtype=np.float32)
+
+
+def _encode(v: Any, typ: str) -> Any:
+    if v is None:
+        return None
+    if typ in ("jsonb", "text[]"):
+        return json.dumps(v, default=str)
+    if typ == "vector":
+        return _vec(v).tobytes()
+    if typ == "boolean":
+        return int(bool(v))
+    if typ == "timestamptz":
+        return _ts(v)
+    if typ == "uuid":
+        return str(v)
+    return v
+
+
+def _decode(v: Any, typ: str) -> Any:
+    if v is None:
+        return None
+    if typ in ("jsonb", "text[]"):
+        return json.loads(v)
+    if typ == "vector":
+        return "[" + ",".join(repr(float(x)) for x in _vec(v)) + "]"
+    if typ == "boolean":
+        return bool(v)
+    return v
+
+
+def _norm_contract(s: Optional[str]) -> str:
+    s = (s or "").lower()
+    return s[2:] if s.startswith("0x") else s
+
+
+def _since(interval: str) -> str:
+    """'7 days' / '12 hours' / '30 minutes' -> timestamp that long ago."""
+    m = re.match(r"^\s*(\d+(?:\.\d+)?)\s*(day|hour|minute|week)s?\s*$", str(interval or ""), re.I)
+    n, unit = (float(m.group(1)), m.group(2).lower()) if m else (7.0, "day")
+    delta = {"day": timedelta(days=n), "hour": timedelta(hours=n), "minute": timedelta(minutes=n),
+             "week": timedelta(weeks=n)}[unit]
+    return _ts(datetime.now(timezone.utc) - delta)
+
+
+def _clamp(n: Any, lo: int, hi: int, default: int) -> int:
+    try:
+        return max(lo, min(int(n), hi))
+    except (TypeError, ValueError):
+        return default
+
+
+# -------------------------
+# Schema (translated from the Postgres migrations)
+# -------------------------
+_TYPE_RULES = [  # matched at the start of a column definition (after the name)
+    (r"timestamp with time zone", "timestamptz", "TEXT"),
+    (r"bigint generated by default as identity", "integer", "INTEGER"),
+    (r"bigserial", "integer", "INTEGER"),
+    (r"double precision", "float", "REAL"),
+    (r"(?:public\.)?vector\b", "vector", "BLOB"),
+    (r"text\[\]", "text[]", "TEXT"),
+    (r"jsonb?\b", "jsonb", "TEXT"),
+    (r"uuid\b", "uuid", "TEXT"),
+    (r"tsvector\b", "text", "TEXT"),
+    (r"boolean\b", "boolean", "INTEGER"),
+    (r"(?:big|small)?int(?:eger)?\b", "integer", "INTEGER"),
+    (r"numeric\b", "numeric", "NUMERIC"),
+    (r"date\b", "date", "TEXT"),
+    (r"text\b", "text", "TEXT"),
+]
+
+
+def _statements(path: pathlib.Path) -> Iterator[str]:
+    sql = path.read_text(encoding="utf-8")
+    sql = re.sub(r"--[^\n]*", "", sql)
+    sql = re.sub(r"\$\$.*?\$\$", "''", sql, flags=re.S)            # function bodies
+    sql = re.sub(r"\btablespace\s+\w+", "", sql, flags=re.I)
+    sql = re.sub(r"\bwith\s*\(\s*lists\s*=\s*'\d+'\s*\)", "", sql, flags=re.I)
+    for stmt in sql.split(";"):
+        stmt = " ".join(stmt.split())
+        if stmt:
+            yield stmt
+
+
+def _split_top(body: str) -> List[str]:
+    parts, depth, cur = [], 0, []
+    for ch in body:
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0:
+            parts.append("".join(cur).strip())
+            cur = []
+        else:
+            cur.append(ch)
+    if "".join(cur).strip():
+        parts.append("".join(cur).strip())
+    return parts
+
+
+def _column(item: str, for_alter: bool = False) -> Tuple[str, str, str, bool]:
+    """'name type [not null] [default x]' -> (name, pg type, sqlite column sql, default_is_now)."""
+    name, rest = item.split(" ", 1)
+    for pat, typ, affinity in _TYPE_RULES:
+        if re.match(pat, rest, re.I):
+            break
+    else:
+        raise ValueError(f"unmapped column type: {item}")
+    sql = f'"{name}" {affinity}'
+    rest = re.sub(r"\bgenerated (?:by default|always) as identity\b", "", rest, flags=re.I)
+    not_null = re.search(r"\bnot null\b", rest, re.I) is not None
+    m = re.search(r"\bdefault (.+?)(?: not null| null|$)", rest, re.I)
+    default, is_now = None, False
+    if m:
+        d = re.sub(r"::[\w\[\]]+", "", m.group(1)).strip()
+        d = re.sub(r"\s+\(", "(", d)
+        is_now = d.lower() == "now()"
+        if d.lower() in ("true", "false"):
+            default = "1" if d.lower() == "true" else "0"
+        elif "(" in d:
+            default = None if for_alter else f"({d})"  # ALTER ... ADD COLUMN needs a constant
+        else:
+            default = d
+    if not_null and not (for_alter and default is None):
+        sql += " NOT NULL"
+    if default is not None:
+        sql += f" DEFAULT {default}"
+    return name, typ, sql, is_now
+
+
+# -------------------------
+# Repository
+# -------------------------
+class SqliteRepository(Repository):
+    name = "sqlite"
+
+    def __init__(self, path: str = SQLITE_PATH):
+        if path == ":memory:":
+            # a throwaway WAL file rather than a shared-cache memory DB: shared-cache table locks
+            # fail at once with SQLITE_LOCKED (busy timeout ignored) under per-thread connections
+            scratch = tempfile.mkdtemp(prefix="gladius-sqlite-")
+            atexit.register(shutil.rmtree, scratch, True)
+            path = os.path.join(scratch, "store.sqlite3")
+        self.path = path
+        self._local = threading.local()
+        self.types: Dict[str, Dict[str, str]] = {}       # table -> {column: pg type}
+        self._pkeys: Dict[str, List[str]] = {}
+        self._now_cols: Dict[str, List[str]] = {}        # columns defaulting to now()
+        self._conn()
+        self._build_schema()
+        logger.info("sqlite store ready | path=%s | tables=%s", path, len(self.types))
+
+    # ---- connections ----
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("pragma synchronous=normal")
+            conn.execute("pragma foreign_keys=on")
+            conn.create_function("gen_random_uuid", 0, lambda: str(uuid.uuid4()))
+            conn.create_function("now", 0, lambda: _ts(datetime.now(timezone.utc)))
+            conn.create_function("norm_contract", 1, _norm_contract, deterministic=True)
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _tx(self):
+        conn = self._conn()
+        conn.execute("begin immediate")
+        try:
+            yield conn
+            conn.execute("commit")
+        except BaseException:
+            conn.execute("rollback")
+            raise
+
+    def _query(self, sql: str, args: Any = ()) -> List[Dict[str, Any]]:
+        return [dict(r) for r in self._conn().execute(sql, args).fetchall()]
+
+    # ---- schema ----
+    def _build_schema(self) -> None:
+        files = [_MIGRATIONS_DIR / "init.sql"] + sorted(_MIGRATIONS_DIR.glob("[0-9]*.sql"))
+        conn = self._conn()
+        for path in files:
+            for stmt in _statements(path):
+                try:
+                    self._apply(conn, stmt)
+                except (sqlite3.Error, ValueError) as e:
+                    logger.debug("sqlite schema: skipped | file=%s | stmt=%.80s | err=%s", path.name, stmt, e)
+
+    def _apply(self, conn: sqlite3.Connection, stmt: str) -> None:
+        s = re.sub(r"\bpublic\.", "", stmt)
+        m = re.match(r"^create table (?:if not exists )?(\w+) \((.*)\)$", s, re.I)
+        if m:
+            table, items = m.group(1), _split_top(m.group(2))
+            if table in self.types:
+                return  # init.sql repeats some tables
+            cols, constraints, types, now_cols, pkey = [], [], {}, [], []
+            for item in items:
+                if re.match(r"^(constraint|primary key|foreign key|unique)\b", item, re.I):
+                    constraints.append(item)
+                    pk = re.search(r"primary key \(([^)]*)\)", item, re.I)
+                    if pk:
+                        pkey = [c.strip() for c in pk.group(1).split(",")]
+                    continue
+                name, typ, sql, is_now = _column(item)
+                cols.append(sql)
+                types[name] = typ
+                if is_now:
+                    now_cols.append(name)
+            conn.execute(f'create table if not exists "{table}" ({", ".join(cols + constraints)})')
+            self.types[table], self._pkeys[table], self._now_cols[table] = types, pkey, now_cols
+            return
+        m = re.match(r"^alter table (\w+) add column (?:if not exists )?(.*)$", s, re.I)
+        if m:
+            table = m.group(1)
+            name, typ, sql, is_now = _column(m.group(2), for_alter=True)
+            existing = {r["name"] for r in conn.execute(f'pragma table_info("{table}")')}
+            if name not in existing:
+                conn.execute(f'alter table "{table}" add column {sql}')
+            self.types.setdefault(table, {})[name] = typ
+            if is_now:
+                self._now_cols.setdefault(table, []).append(name)  # filled on write instead
+            return
+        m = re.match(r"^create (unique )?index (?:if not exists )?(\w+) on (\w+)(?: using (\w+))? (\(.*)$", s, re.I)
+        if m:
+            if (m.group(4) or "btree").lower() != "btree":
+                return  # gin / ivfflat have no sqlite equivalent
+            conn.execute(f'create {m.group(1) or ""}index if not exists "{m.group(2)}" on "{m.group(3)}" {m.group(5)}')
+
+    # ---- helpers ----
+    def _col(self, table: str, expr: str) -> Tuple[str, str]:
+        """(sql, pg type) for a column or a PostgREST JSON path (meta->>key)."""
+        expr = expr.strip()
+        m = re.match(r"^(\w+)->>?(\w+)$", expr)
+        if m:
+            return f"json_extract(\"{m.group(1)}\", '$.{m.group(2)}')", "text"
+        typ = self.types.get(table, {}).get(expr)
+        if typ is None:
+            raise ValueError(f"unknown column {table}.{expr}")
+        return f'"{expr}"', typ
+
+    def _where(self, table, eq, in_, ilike):
+        parts, args = [], []
+        for col, v in (eq or {}).items():
+            sql, typ = self._col(table, col)
+            parts.append(f"{sql} = ?")
+            args.append(_encode(v, typ))
+        for col, vs in (in_ or {}).items():
+            sql, typ = self._col(table, col)
+            vs = list(vs)
+            parts.append(f"{sql} in ({', '.join('?' * len(vs))})" if vs else "0")
+            args.extend(_encode(v, typ) for v in vs)
+        for col, v in (ilike or {}).items():
+            sql, _ = self._col(table, col)
+            parts.append(f"{sql} like ?")  # sqlite LIKE is case-insensitive for ASCII
+            args.append(str(v).replace("*", "%"))
+        return (" where " + " and ".join(parts)) if parts else "", args
+
+    def _rows(self, table: str, cur) -> List[Dict[str, Any]]:
+        types = self.types.get(table, {})
+        names = [d[0] for d in cur.description]
+        return [{n: _decode(v, types.get(n, "text")) for n, v in zip(names, r)} for r in cur.fetchall()]
+
+    # ---- Repository ----
+    def select(self, table, columns="*", *, eq=None, in_=None, ilike=None, order=None, desc=False,
+               limit=None, count=False):
+        cols = "*" if columns.strip() == "*" else ", ".join(self._col(table, c)[0] for c in columns.split(",") if c.strip())
+        where, args = self._where(table, eq, in_, ilike)
+        sql = f'select {cols} from "{table}"{where}'
+        if order:
+            sql += f" order by {self._col(table, order)[0]} {'desc' if desc else 'asc'}"
+        if limit is not None:
+            sql += f" limit {int(limit)}"
+        conn = self._conn()
+        rows = self._rows(table, conn.execute(sql, args))
+        total = conn.execute(f'select count(*) from "{table}"{where}', args).fetchone()[0] if count else None
+        return Result(rows, total)
+
+    def scan(self, table, columns="*", *, eq=None, key="id", after=None, batch=1000):
+        cols = "*" if columns.strip() == "*" else ", ".join(self._col(table, c)[0] for c in columns.split(",") if c.strip())
+        where, args = self._where(table, eq, None, None)
+        key_sql, key_typ = self._col(table, key)
+        if after is not None:
+            where += (" and " if where else " where ") + f"{key_sql} > ?"
+            args.append(_encode(after, key_typ))
+        types = self.types.get(table, {})
+        cur = self._conn().execute(f'select {cols} from "{table}"{where} order by {key_sql}', args)
+        names = [d[0] for d in cur.description]
+        while True:
+            chunk = cur.fetchmany(batch)
+            if not chunk:
+                return
+            for r in chunk:
+                yield {n: _decode(v, types.get(n, "text")) for n, v in zip(names, r)}
+
+    def _write(self, table, rows, conflict, ignore_duplicates):
+        rows = _as_list(rows)
+        if not rows:
+            return 0
+        types = self.types.get(table)
+        if types is None:
+            raise ValueError(f"unknown table: {table}")
+        now = _ts(datetime.now(timezone.utc))
+        cols = sorted({k for r in rows for k in r} | set(self._now_cols.get(table, [])))
+        unknown = [c for c in cols if c not in types]
+        if unknown:
+            raise ValueError(f"unknown columns for {table}: {unknown}")
+        if conflict and all(c in cols for c in conflict):
+            rows = list({tuple(r.get(c) for c in conflict): r for r in rows}.values())
+        col_sql = ", ".join(f'"{c}"' for c in cols)
+        sql = f'insert into "{table}" ({col_sql}) values ({", ".join("?" * len(cols))})'
+        if conflict:
+            updates = [c for c in cols if c not in conflict]
+            target = ", ".join(f'"{c}"' for c in conflict)
+            if ignore_duplicates or not updates:
+                sql += f" on conflict ({target}) do nothing"
+            else:
+                sql += f" on conflict ({target}) do update set " + \
+                       ", ".join(f'"{c}" = excluded."{c}"' for c in updates)
+        now_cols = set(self._now_cols.get(table, []))
+        values = [
+            tuple(_encode(r.get(c, now if c in now_cols else None), types[c]) for c in cols)
+            for r in rows
+        ]
+        with self._tx() as conn:
+            conn.executemany(sql, values)
+        return len(rows)
+
+    def insert(self, table, rows):
+        return self._write(table, rows, [], False)
+
+    def upsert(self, table, rows, *, on_conflict=None, ignore_duplicates=False):
+        conflict = [c.strip() for c in on_conflict.split(",")] if on_conflict else self._pkeys.get(table, [])
+        return self._write(table, rows, conflict, ignore_duplicates)
+
+    def rpc(self, fn, params=None):
+        impl = getattr(self, f"_rpc_{fn}", None)
+        if impl is None:
+            raise ValueError(f"rpc not available in the sqlite store: {fn}")
+        return impl(**(params or {}))
+
+    # -------------------------
+    # RPCs
+    # -------------------------
+    _THREAD_COLS = ("t.id, t.user_id, u.handle, t.community_id, t.content_text, t.created_at, "
+                    "t.like_count, t.repost_count, t.answer_count")
+    _COMMUNITY_MATCH = "(t.community_id = ? or norm_contract(c.contract_address) = norm_contract(?))"
+
+    def _thread_filters(self, p_start=None, p_end=None, p_community=None, p_user=None):
+        parts, args = ["not coalesce(t.is_deleted, 0)"], []
+        if p_start:
+            parts.append("t.created_at >= ?")
+            args.append(_ts(p_start))
+        if p_end:
+            parts.append("t.created_at < ?")
+            args.append(_ts(p_end))
+        if p_user:
+            parts.append("t.user_id = ?")
+            args.append(str(p_user))
+        if p_community:
+            parts.append(self._COMMUNITY_MATCH)
+            args += [p_community, p_community]
+        return " and ".join(parts), args
+
+    def _rpc_search_threads_by_keywords_timewindow(self, p_query, p_start=None, p_end=None, p_limit=50, p_mode="OR"):
+        terms = [w.lower() for w in (p_query or "").split() if w]
+        if not terms:
+            return []
+        where, args = self._thread_filters(p_start, p_end)
+        joiner = " and " if str(p_mode).upper() == "AND" else " or "
+        match = joiner.join("instr(lower(coalesce(t.content_text, '')), ?) > 0" for _ in terms)
+        return self._query(
+            f"select {self._THREAD_COLS} from sa_threads t left join sa_users u on u.id = t.user_id "
+            f"where {where} and ({match}) order by t.created_at desc limit ?",
+            args + terms + [_clamp(p_limit, 1, 100, 50)],
+        )
+
+    def _user_posts(self, p_user, limit_n, order, since=None):
+        where, args = self._thread_filters(p_start=since, p_user=p_user)
+        return self._query(
+            f"select t.id, t.content_text, t.created_at, t.like_count, t.repost_count, t.answer_count, "
+            f"t.thread_type, t.like_count + 2 * t.repost_count + t.answer_count as score "
+            f"from sa_threads t where {where} order by {order} limit ?",
+            args + [limit_n],
+        )
+
+    def _rpc_user_recent_posts(self, p_user, limit_n=8):
+        return self._user_posts(p_user, _clamp(limit_n, 1, 50, 8), "t.created_at desc")
+
+    def _rpc_user_recent_posts_simple(self, p_user, limit_n=20):
+        return self._user_posts(p_user, _clamp(limit_n, 1, 100, 20), "t.created_at desc")
+
+    def _rpc_user_top_posts(self, p_user, days_back=90, k=20):
+        since = datetime.now(timezone.utc) - timedelta(days=_clamp(days_back, 1, 3650, 90))
+        return self._user_posts(p_user, _clamp(k, 1, 100, 20), "score desc, t.created_at desc", since)
+
+    def _rpc_top_communities_by_activity(self, since_interval, limit_n=10):
+        return self._query(
+            "select t.community_id as id, c.name, c.contract_address, count(*) as posts, "
+            "sum(coalesce(t.like_count, 0)) as likes, sum(coalesce(t.repost_count, 0)) as reposts, "
+            "sum(coalesce(t.answer_count, 0)) as answers, sum(coalesce(t.tip_amount, 0)) as tips, "
+            "count(*) + sum(coalesce(t.like_count, 0)) + 2 * sum(coalesce(t.repost_count, 0)) "
+            "  + sum(coalesce(t.answer_count, 0)) as score "
+            "from sa_threads t left join sa_communities c on c.id = t.community_id "
+            "where t.community_id is not null and t.created_at >= ? "
+            "group by t.community_id order by score desc limit ?",
+            (_since(since_interval), _clamp(limit_n, 1, 100, 10)),
+        )
+
+    def _rpc_top_users_by_engagement(self, since_interval, limit_n=12):
+        return self._query(
+            "select t.user_id as id, u.handle, u.name, count(*) as posts, "
+            "sum(coalesce(t.like_count, 0)) as likes, sum(coalesce(t.repost_count, 0)) as reposts, "
+            "sum(coalesce(t.answer_count, 0)) as answers, sum(coalesce(t.tip_amount, 0)) as tips, "
+            "count(*) + sum(coalesce(t.like_count, 0)) + 2 * sum(coalesce(t.repost_count, 0)) "
+            "  + sum(coalesce(t.answer_count, 0)) as score "
+            "from sa_threads t left join sa_users u on u.id = t.user_id "
+            "where t.user_id is not null and t.created_at >= ? "
+            "group by t.user_id order by score desc limit ?",
+            (_since(since_interval), _clamp(limit_n, 1, 100, 12)),
+        )
+
+    def _rpc_community_activity_timeseries(self, p_community, days_back=14):
+        start = (datetime.now(timezone.utc).date() - timedelta(days=_clamp(days_back, 1, 30, 14))).isoformat()
+        return self._query(
+            "select substr(t.created_at, 1, 10) as day, count(*) as posts, "
+            "sum(coalesce(t.like_count, 0)) as likes, sum(coalesce(t.repost_count, 0)) as reposts, "
+            "sum(coalesce(t.answer_count, 0)) as answers, sum(coalesce(t.tip_amount, 0)) as tips, "
+            "count(distinct t.user_id) as active_users "
+            f"from sa_threads t left join sa_communities c on c.id = t.community_id "
+            f"where {self._COMMUNITY_MATCH} and t.created_at >= ? "
+            "group by day order by day",
+            (p_community, p_community, start),
+        )
+
+    def _rpc_tool_get_conversation_history(self, p_limit=20, p_handle=None):
+        where, args = "", []
+        if p_handle:
+            where = "where lower(parent_user_handle) = lower(?)"
+            args.append(str(p_handle).lstrip("@"))
+        return self._query(
+            "select created_at, parent_user_handle, parent_post_url, parent_post_content_text, "
+            f"reply_post_url, reply_content_html from bot_replies {where} order by created_at desc limit ?",
+            args + [_clamp(p_limit, 1, 100, 20)],
+        )
+
+    def _rpc_tool_top_friends(self, p_start, p_end, p_limit=20):
+        return self._query(
+            "select parent_user_handle, count(*) as replies, max(created_at) as last_reply_at "
+            "from bot_replies where parent_user_handle is not null and created_at >= ? and created_at < ? "
+            "group by parent_user_handle order by replies desc limit ?",
+            (_ts(p_start), _ts(p_end), _clamp(p_limit, 1, 100, 20)),
+        )
+
+    def _rpc_match_threads(self, query_embedding, match_count=10, p_start=None, p_end=None,
+                           p_community=None, p_user=None):
+        where, args = self._thread_filters(p_start, p_end, p_community, p_user)
+        cur = self._conn().execute(
+            f"select e.embedding as _vec, t.id, t.user_id, u.handle, t.community_id, t.content_text, "
+            f"t.created_at, t.like_count, t.repost_count "
+            f"from sa_embeddings e join sa_threads t on t.id = e.thread_id "
+            f"left join sa_users u on u.id = t.user_id left join sa_communities c on c.id = t.community_id "
+            f"where e.image_id is null and {where}",
+            args,
+        )
+        rows = [dict(r) for r in cur.fetchall()]
+        if not rows:
+            return []
+        q = _vec(query_embedding)
+        mat = np.stack([_vec(r.pop("_vec")) for r in rows])
+        sims = (mat @ q) / (np.linalg.norm(mat, axis=1) * (np.linalg.norm(q) or 1.0) + 1e-12)
+        k = _clamp(match_count, 1, 400, 10)
+        top = np.argsort(-sims)[:k]
+        out = []
+        for i in top:
+            rows[i]["similarity"] = float(sims[i])
+            out.append(rows[i])
+        return out
+
+    def _rpc_hybrid_search_threads(self, p_query, query_embedding, match_count=10, p_start=None, p_end=None,
+                                   p_community=None, p_user=None, p_semantic_weight=0.6):
+        k = _clamp(match_count, 1, 100, 10)
+        sem = {r["id"]: r for r in self._rpc_match_threads(query_embedding, k * 4, p_start, p_end, p_community, p_user)}
+        # text rank: fraction of query terms present (stand-in for ts_rank)
+        terms = [w.lower() for w in re.findall(r"\w+", p_query or "")]
+        kw: Dict[str, Dict[str, Any]] = {}
+        if terms:
+            where, args = self._thread_filters(p_start, p_end, p_community, p_user)
+            hits = " + ".join("(instr(lower(coalesce(t.content_text, '')), ?) > 0)" for _ in terms)
+            for r in self._query(
+                f"select {self._THREAD_COLS}, ({hits}) * 1.0 / {len(terms)} as text_rank "
+                f"from sa_threads t left join sa_users u on u.id = t.user_id "
+                f"left join sa_communities c on c.id = t.community_id "
+                f"where {where} and ({hits}) > 0 order by text_rank desc limit ?",
+                terms + args + terms + [k * 4],
+            ):
+                kw[r["id"]] = r
+        max_rank = max((r["text_rank"] for r in kw.values()), default=0) or None
+        out = []
+        for tid in set(sem) | set(kw):
+            r = dict(sem.get(tid) or kw[tid])
+            r.pop("answer_count", None)
+            r["similarity"] = sem[tid]["similarity"] if tid in sem else None
+            r["text_rank"] = kw[tid]["text_rank"] if tid in kw else None
+            r["score"] = p_semantic_weight * (r["similarity"] or 0.0) + \
+                (1 - p_semantic_weight) * ((r["text_rank"] or 0.0) / max_rank if max_rank else 0.0)
+            out.append(r)
+        out.sort(key=lambda r: r["score"], reverse=True)
+        return out[:k]
+
+    # Rollup readers: same answers, straight from the base tables.
+    def _rpc_rollup_top_communities(self, since_interval, limit_n=10):
+        return self._rpc_top_communities_by_activity(since_interval, limit_n)
+
+    def _rpc_rollup_top_users(self, since_interval, limit_n=12):
+        return self._rpc_top_users_by_engagement(since_interval, limit_n)
+
+    def _rpc_rollup_community_timeseries(self, p_community, days_back=14):
+        return self._rpc_community_activity_timeseries(p_community, days_back)
+
+    def _rpc_rollup_top_friends(self, p_start, p_end, p_limit=20):
+        return self._rpc_tool_top_friends(p_start, p_end, p_limit)
+
+    def _rpc_refresh_rollups_for_threads(self, p_thread_ids):
+        return 0
+
+    def _rpc_rebuild_rollups(self, p_since):
+        return 0
+
+    # Background workers (engagement_refresh, vision_backfill, image_embeddings, ann_index).
+    def _rpc_threads_due_for_counter_refresh(self, p_limit=100, p_max_age_days=30):
+        now = datetime.now(timezone.utc)
+        rows = self._query(
+            "select id, created_at, counters_refreshed_at from sa_threads "
+            "where created_at >= ? and not coalesce(is_deleted, 0)",
+            (_ts(now - timedelta(days=_clamp(p_max_age_days, 1, 3650, 30))),),
+        )
+        out = []
+        for r in rows:
+            created = datetime.fromisoformat(r["created_at"])
+            since = datetime.fromisoformat(r["counters_refreshed_at"] or r["created_at"])
+            interval_s = min(max((now - created).total_seconds() / 4.0, 600), 604800)
+            elapsed = (now - since).total_seconds()
+            if elapsed >= interval_s:
+                out.append({**r, "overdue": elapsed / interval_s})
+        out.sort(key=lambda r: r["overdue"], reverse=True)
+        return out[:_clamp(p_limit, 1, 1000, 100)]
+
+    def _rpc_update_thread_counters(self, p_rows):
+        cols = ("like_count", "repost_count", "answer_count", "bookmark_count", "tip_amount", "tip_count", "is_deleted")
+        sets = ", ".join(f'"{c}" = coalesce(?, "{c}")' for c in cols)
+        now = _ts(datetime.now(timezone.utc))
+        values = [
+            tuple(_encode(r.get(c), "boolean" if c == "is_deleted" else "numeric") for c in cols) + (now, str(r["id"]))
+            for r in p_rows or []
+        ]
+        with self._tx() as conn:
+            cur = conn.executemany(f"update sa_threads set {sets}, counters_refreshed_at = ? where id = ?", values)
+        return cur.rowcount
+
+    def _rpc_images_pending_analysis(self, p_limit=50, p_max_age_days=30, p_max_failures=3):
+        now = datetime.now(timezone.utc)
+        rows = self._query(
+            "select i.id, i.thread_id, i.source_url, i.storage_path, i.mime, i.width, i.height, i.is_gif, i.sha256, "
+            "t.created_at as _created_at, "
+            "1 + coalesce(t.like_count, 0) + 2 * coalesce(t.repost_count, 0) + coalesce(t.answer_count, 0) as _eng "
+            "from sa_images i join sa_threads t on t.id = i.thread_id "
+            "left join sa_image_analysis a on a.image_id = i.id "
+            "where a.image_id is null and i.analysis_failures < ? "
+            "and (i.analysis_next_attempt_at is null or i.analysis_next_attempt_at <= ?) and t.created_at >= ?",
+            (p_max_failures, _ts(now), _ts(now - timedelta(days=_clamp(p_max_age_days, 1, 3650, 30)))),
+        )
+        for r in rows:
+            age_h = max((now - datetime.fromisoformat(r.pop("_created_at"))).total_seconds() / 3600.0, 0)
+            r["priority"] = r.pop("_eng") / (age_h + 2) ** 1.5
+            r["is_gif"] = bool(r["is_gif"]) if r["is_gif"] is not None else None
+        rows.sort(key=lambda r: r["priority"], reverse=True)
+        return rows[:_clamp(p_limit, 1, 500, 50)]
+
+    def _rpc_record_image_analysis_failures(self, p_ids):
+        now = datetime.now(timezone.utc)
+        n = 0
+        with self._tx() as conn:
+            for iid in p_ids or []:
+                row = conn.execute("select analysis_failures from sa_images where id = ?", (iid,)).fetchone()
+                if row is None:
+                    continue
+                retry = now + min(timedelta(minutes=10) * 4 ** row[0], timedelta(days=1))
+                conn.execute("update sa_images set analysis_failures = analysis_failures + 1, "
+                             "analysis_next_attempt_at = ? where id = ?", (_ts(retry), iid))
+                n += 1
+        return n
+
+    def _rpc_ann_embeddings_after(self, p_after=0, p_limit=500):
+        rows = self._query(
+            "select e.id, e.thread_id, e.embedding, t.created_at, t.user_id, t.community_id, t.content_text, "
+            "t.like_count, t.repost_count, u.handle "
+            "from sa_embeddings e left join sa_threads t on t.id = e.thread_id "
+            "left join sa_users u on u.id = t.user_id "
+            "where e.image_id is null and e.id > ? order by e.id limit ?",
+            (int(p_after or 0), _clamp(p_limit, 1, 5000, 500)),
+        )
+        for r in rows:
+            r["embedding"] = _decode(r["embedding"], "vector")
+        return rows
+
+    def _rpc_image_analyses_after(self, p_analyzed_at=None, p_image_id=0, p_limit=64, p_settle_seconds=30):
+        where = "where analyzed_at < ?"
+        args = [_ts(datetime.now(timezone.utc) - timedelta(seconds=max(int(p_settle_seconds or 0), 0)))]
+        if p_analyzed_at:
+            ts = _ts(p_analyzed_at)
+            where += " and (analyzed_at > ? or (analyzed_at = ? and image_id > ?))"
+            args += [ts, ts, int(p_image_id or 0)]
+        return self._query(
+            f"select image_id, caption, ocr_text, analyzed_at from sa_image_analysis {where} "
+            "order by analyzed_at, image_id limit ?",
+            args + [_clamp(p_limit, 1, 1000, 64)],
+        )
+
+    def _rpc_upsert_image_embeddings(self, p_rows):
+        values = [(str(r["thread_id"]), int(r["image_id"]), _vec(r["embedding"]).tobytes()) for r in p_rows or []]
+        with self._tx() as conn:
+            conn.executemany(
+                "insert into sa_embeddings (thread_id, image_id, embedding) values (?, ?, ?) "
+                "on conflict (image_id) where image_id is not null "
+                "do update set embedding = excluded.embedding, thread_id = excluded.thread_id",
+                values,
+            )
+        return len(values)
@@ -0,0 +1,201 @@
+# sync_scheduler.py
+import os
+import time
+import heapq
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+import metrics
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+# Background sync of users' posts into sa_threads. Tool calls never sync inline; they call
+# request_sync(user_id), which records a mention and wakes the scheduler. The scheduler keeps
+# every user whose data is past its freshness SLA in a priority queue:
+#
+#   priority = mention_score * (1 + overdue / sla)
+#
+# where mention_score decays with SYNC_MENTION_HALFLIFE and overdue is how far past the SLA the
+# user is (measured from our last sync, or from their newest stored post before we've synced).
+# Frequently mentioned ("hot") users get the tighter SYNC_HOT_SLA_MINUTES. Once a user's decayed
+# score drops below SYNC_MIN_MENTIONS (one mention, ~4h ago at the default half-life) they are
+# untracked, so background load follows current mentions rather than everyone ever mentioned.
+
+# -------------------------
+# Config
+# -------------------------
+WORKERS           = max(1, int(os.getenv("SYNC_WORKERS", "2")))
+SLA_MINUTES       = float(os.getenv("SYNC_SLA_MINUTES", "10"))
+HOT_SLA_MINUTES   = float(os.getenv("SYNC_HOT_SLA_MINUTES", "3"))
+HOT_MENTIONS      = float(os.getenv("SYNC_HOT_MENTIONS", "3"))      # decayed mention score to count as hot
+MENTION_HALFLIFE  = float(os.getenv("SYNC_MENTION_HALFLIFE", "3600"))
+MIN_MENTIONS      = float(os.getenv("SYNC_MIN_MENTIONS", "0.05"))   # below this a user is untracked
+MAX_FETCH         = int(os.getenv("SYNC_MAX_FETCH", "100"))
+TICK_SECONDS      = float(os.getenv("SYNC_TICK_SECONDS", "15"))
+MAX_TRACKED       = int(os.getenv("SYNC_MAX_TRACKED", "5000"))
+_MAX_BACKOFF = 1800.0
+
+
+class _UserState:
+    __slots__ = ("score", "scored_at", "synced_at", "newest_post_at", "failures", "retry_at", "in_flight")
+
+    def __init__(self):
+        self.score = 0.0
+        self.scored_at = 0.0
+        self.synced_at: Optional[float] = None       # last successful background sync
+        self.newest_post_at: Optional[float] = None  # from _max_created_at_for_user, before our first sync
+        self.failures = 0
+        self.retry_at = 0.0
+        self.in_flight = False
+
+    def mentions(self, now: float) -> float:
+        return self.score * 0.5 ** ((now - self.scored_at) / MENTION_HALFLIFE)
+
+    def sla_seconds(self, now: float) -> float:
+        return 60 * (HOT_SLA_MINUTES if self.mentions(now) >= HOT_MENTIONS else SLA_MINUTES)
+
+    def overdue(self, now: float) -> float:
+        """Seconds past the SLA (<= 0 means fresh). Never-seen data counts as one SLA overdue."""
+        fresh_as_of = self.synced_at if self.synced_at is not None else self.newest_post_at
+        sla = self.sla_seconds(now)
+        if fresh_as_of is None:
+            return sla
+        return (now - fresh_as_of) - sla
+
+
+_users: Dict[str, _UserState] = {}
+_lock = threading.Lock()
+_wake = threading.Event()
+_pool: Optional[ThreadPoolExecutor] = None
+_started = False
+
+
+def _sync_user(user_id: str) -> None:
+    # imported lazily: function.py imports this module
+    from function import ensure_threads_for_user, _max_created_at_for_user
+
+    with _lock:
+        st = _users[user_id]
+        needs_probe = st.synced_at is None and st.newest_post_at is None
+    t0 = time.perf_counter()
+    try:
+        if needs_probe:
+            # First time we see this user: skip the API sync if the stored posts are already fresh.
+            ts, _ = _max_created_at_for_user(user_id)
+            if ts:
+                newest = datetime.fromisoformat(str(ts).replace("Z", "+00:00")).timestamp()
+                with _lock:
+                    st.newest_post_at = newest
+                    fresh = st.overdue(time.time()) <= 0
+                if fresh:
+                    return
+        inserted = ensure_threads_for_user(user_id, freshness_minutes=st.sla_seconds(time.time()) / 60,
+                                           max_fetch=MAX_FETCH)
+        with _lock:
+            st.synced_at = time.time()
+            st.failures = 0
+        metrics.incr("sync.users_synced")
+        logger.info("background sync | user_id=%s | inserted=%s | seconds=%.2f",
+                    user_id, inserted, time.perf_counter() - t0)
+    except Exception:
+        with _lock:
+            st.failures += 1
+            st.retry_at = time.time() + min(30.0 * 2 ** st.failures, _MAX_BACKOFF)
+        metrics.incr("sync.failures")
+        logger.exception("background sync failed | user_id=%s | failures=%s", user_id, st.failures)
+    finally:
+        with _lock:
+            st.in_flight = False
+        _wake.set()  # a slot freed up
+
+
+def _due_heap(now: float):
+    """Max-heap (as negated priorities) of users due for a sync; drops users gone cold. Caller holds _lock."""
+    heap, cold = [], []
+    for uid, st in _users.items():
+        if st.in_flight:
+            continue
+        mentions = st.mentions(now)
+        if mentions < MIN_MENTIONS:
+            cold.append(uid)
+            continue
+        if now < st.retry_at:
+            continue
+        over = st.overdue(now)
+        if over <= 0:
+            continue
+        sla = st.sla_seconds(now)
+        prio = mentions * (1 + over / sla)
+        heap.append((-prio, uid))
+    for uid in cold:
+        del _users[uid]
+    if cold:
+        metrics.incr("sync.untracked", len(cold))
+    heapq.heapify(heap)
+    return heap
+
+
+def _scheduler() -> None:
+    while True:
+        _wake.wait(TICK_SECONDS)
+        _wake.clear()
+        now = time.time()
+        with _lock:
+            free = WORKERS - sum(1 for st in _users.values() if st.in_flight)
+            heap = _due_heap(now) if free > 0 else []
+            picked = []
+            while heap and len(picked) < free:
+                neg_prio, uid = heapq.heappop(heap)
+                _users[uid].in_flight = True
+                picked.append((uid, -neg_prio))
+            metrics.observe("sync.queue_depth", len(heap))
+        for uid, prio in picked:
+            logger.debug("sync dispatch | user_id=%s | priority=%.3f", uid, prio)
+            _pool.submit(_sync_user, uid)
+
+
+def start() -> None:
+    global _started, _pool
+    with _lock:
+        if _started:
+            return
+        _pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="user-sync")
+        threading.Thread(target=_scheduler, name="user-sync-scheduler", daemon=True).start()
+        _started = True
+        logger.info("user sync scheduler started | workers=%s | sla_min=%s | hot_sla_min=%s",
+                    WORKERS, SLA_MINUTES, HOT_SLA_MINUTES)
+
+
+def request_sync(user_id: Optional[str], weight: float = 1.0) -> None:
+    """Record a mention of `user_id` and let the scheduler decide when to sync. Never blocks on I/O."""
+    if not user_id:
+        return
+    start()
+    now = time.time()
+    with _lock:
+        st = _users.get(user_id)
+        if st is None:
+            if len(_users) >= MAX_TRACKED:
+                coldest = min(_users, key=lambda u: (_users[u].in_flight, _users[u].mentions(now)))
+                del _users[coldest]
+            st = _users[user_id] = _UserState()
+        st.score = st.mentions(now) + weight
+        st.scored_at = now
+    _wake.set()
+
+
+def status(user_id: str) -> Dict[str, Any]:
+    """Freshness of a user's stored posts, as far as the scheduler knows."""
+    now = time.time()
+    with _lock:
+        st = _users.get(user_id)
+        if st is None:
+            return {"tracked": False}
+        return {
+            "tracked": True,
+            "synced_seconds_ago": round(now - st.synced_at) if st.synced_at else None,
+            "syncing": st.in_flight,
+            "due": st.overdue(now) > 0,
+        }
@@ -1,7 +1,8 @@
 import os, re, json
+from html import unescape
 from logging_utils import get_logger, compact_json
 from openai import OpenAI
-from db import supabase
+from db import repo
 import time
 from datetime import datetime, timedelta, timezone
 from image_jobs import join_queue
@@ -9,6 +10,13 @@ from zoneinfo import ZoneInfo
 from Arena import token_community_search
 from image_jobs import enqueue as enqueue_image_job, start_worker
 from Web import tool_search_web
+from ingest import embed_query
+import ann_index
+import sync_scheduler
+import tool_cache
+import metrics
+from textclean import html_to_text
+import tracing
 CURRENT_EVENT = None
 from function import (
     getStatsOfArena_structured,
@@ -18,6 +26,9 @@ from function import (
     analyze_and_persist_images_for_thread,  # keep if you use elsewhere
     get_media_json_for_thread,              # keep if you use elsewhere
     ensure_analysis_and_media_for_post,     # <-- NEW: one-shot helper
+    find_same_meme,
+    clean_text,
+    POST_UUID_RE,
 )
 OPENAI_KEY = os.getenv("OPEN_AI_KEY")
 oai = OpenAI(api_key=OPENAI_KEY)
@@ -25,6 +36,10 @@ IMG_VISION = True
 MAX_DOCS = int(os.getenv("MAX_DOCS", "12"))
 MAX_CHARS_PER_DOC = 500
 VERBOSE_TOOLS = True  # <- toggle this
+# Leaderboard/timeseries tools read the rollup tables (migrations/005); 0 = raw-scan RPCs
+USE_ROLLUPS = os.getenv("USE_ROLLUPS", "1").lower() not in ("0", "false", "no")
+# refresh_rollups_for_threads purges hourly rollups after 40 days; longer windows go raw
+ROLLUP_HOURLY_RETENTION_DAYS = int(os.getenv("ROLLUP_HOURLY_RETENTION_DAYS", "40"))
 
 logger = get_logger(__name__)
 
@@ -78,6 +93,8 @@ def _summarize_tool_result(name: str, result) -> str:
             f"followers={prof.get('followers')} "
             f"threads={prof.get('thread_count')}"
         )
+    if name == "semantic_search" and isinstance(result, dict):
+        return _summarize_rows(result.get("results") or [], keys=["display", "text", "score"])
     if name in {"search_keywords_timewindow", "tool_get_conversation_history", "tool_top_friends"}:
         if isinstance(result, list):
             return _summarize_rows(result)
@@ -88,11 +105,6 @@ def _summarize_tool_result(name: str, result) -> str:
     if isinstance(result, dict):
         return compact_json(result, max_len=800)
     return _excerpt(str(result), 400)
-def clean_text(s):
-    s = re.sub(r"<[^>]+>", " ", s or "")
-    s = re.sub(r"https?://\S+", "", s)
-    s = re.sub(r"\s+", " ", s)
-    return s.strip()
 
 
 currentDate = datetime.now().strftime("%Y-%m-%d")
@@ -141,9 +153,11 @@ GLADIUS_SYSTEM = (
     "- When judging a user, prefer user_top_posts (recent + engaged) over random recents.\n"
     "- Default: top_days_back=90, top_k=20 for user_top_posts unless the user asks otherwise.\n"
     "- For ‘who is doing X most’, use search_keywords_timewindow with tight keywords.\n"
+    "- For topic/vibe questions where exact words vary (‘who’s talking about airdrops’, ‘posts like this’), use semantic_search.\n"
     "- If people ask for YOUR past converstaions with someone you can use tool_get_conversation_history to fetch past conversation with that user. Or when people ask you recall me? etc"
     " - You can use tool_top_friends to see who has chatted most with you in last N days. Default is 7 days\n"
     "- For ‘what’s happening on Arena’, you can call get_trending_feed for latest trending posts.\n"
+    "- For ‘is this the same meme / who else posted this’, call find_same_meme with the image or post.\n"
     "- To analyze a post (<url_or_uuid>): call analyze_post with only post_id (not user_id). "
     "Use content + media (captions/OCR). If no image, skip image commentary.\n"
     "- If threadType='quote', ALWAYS analyze repostId as well (the quoted parent).\n"
@@ -206,10 +220,10 @@ def search_keywords_timewindow(query, start_days_offset=0, days_span=1, limit_n=
         "p_mode":  mode,      # requires SQL function to have p_mode DEFAULT 'OR'
     }
 
-    res = supabase.rpc("search_threads_by_keywords_timewindow", payload).execute()
+    rows = repo.rpc("search_threads_by_keywords_timewindow", payload)
 
-    if hasattr(res, "data"):
-        rows = res.data or []
+    if rows is not None:
+        rows = rows or []
         logger.info(
             "search_keywords_timewindow | query=%s | mode=%s | %s",
             q,
@@ -233,8 +247,8 @@ def resolve_user_id(handle_or_id):
 
     # 1) try DB first
     try:
-        r = supabase.table("sa_users").select("id").ilike("handle", s).limit(1).execute()
-        if hasattr(r, "data") and r.data:
+        r = repo.select("sa_users", "id", ilike={"handle": s}, limit=1)
+        if r.data:
             return r.data[0]["id"]
     except Exception:
         pass
@@ -246,12 +260,32 @@ def resolve_user_id(handle_or_id):
 
     raise ValueError(f"Could not resolve user id from '{handle_or_id}'")
 
+def _rollup_rpc(rollup_fn: str, raw_fn: str, payload: dict, raw_payload: dict = None, since_days=None):
+    """
+    Read from the pre-aggregated rollup RPC; fall back to the raw-scan RPC if it fails, is off, or
+    comes back empty (an empty window costs little to scan, and rollups may not be backfilled yet).
+    Windows reaching past the hourly retention (since_days) go straight to the raw RPC, since the
+    rollup readers take a window's partial first day from hourly rows.
+    """
+    if since_days is not None and float(since_days) >= ROLLUP_HOURLY_RETENTION_DAYS:
+        metrics.incr("rollups.beyond_retention")
+    elif USE_ROLLUPS:
+        try:
+            rows = repo.rpc(rollup_fn, payload)
+            if rows:
+                return rows
+            metrics.incr("rollups.empty_fallback")
+        except Exception:
+            logger.exception("rollup rpc failed; using raw | fn=%s", rollup_fn)
+    return repo.rpc(raw_fn, payload if raw_payload is None else raw_payload) or []
+
+
+@tool_cache.cached("get_top_communities", ttl=120)
 def tool_get_top_communities(since_days: int = 7, limit_n: int = 10):
-    res = supabase.rpc("top_communities_by_activity", {
+    rows = _rollup_rpc("rollup_top_communities", "top_communities_by_activity", {
         "since_interval": f"{since_days} days",
         "limit_n": limit_n
-    }).execute()
-    rows = res.data or []
+    }, since_days=since_days)
     return rows  # list of dicts
 
 
@@ -264,23 +298,20 @@ def tool_get_user_top_posts(user_id: str, days_back: int = 90, k: int = 20):
     Fallback: your user_top_posts scorer (if you want to keep it).
     """
     # 1) newest-first
-    res = supabase.rpc("user_recent_posts_simple", {
+    rows = repo.rpc("user_recent_posts_simple", {
         "p_user": uid,
         "limit_n": k
-    }).execute()
-
-    rows = res.data or []
+    }) or []
     if VERBOSE_TOOLS:
         logger.info("user_recent_posts_simple | rows=%s", len(rows))
 
     # Optional fallback to ranked top posts if simple returns 0
     if not rows:
-        res2 = supabase.rpc("user_top_posts", {
+        rows = repo.rpc("user_top_posts", {
             "p_user": user_id,
             "days_back": days_back,
             "k": k
-        }).execute()
-        rows = res2.data or []
+        }) or []
         if VERBOSE_TOOLS:
             logger.info("fallback user_top_posts | rows=%s", len(rows))
 
@@ -295,6 +326,7 @@ def tool_get_user_top_posts(user_id: str, days_back: int = 90, k: int = 20):
     return {"posts": rows, "excerpt": excerpt}
 
 
+@tool_cache.cached("get_trending_feed", ttl=30)
 def tool_get_trending_feed():
     rows = getTrendingFeed()
     return rows
@@ -344,22 +376,22 @@ def tool_get_community_timeseries(community_id_or_contract: str, days_back: int
         days_back = 30
    
     
-    res = supabase.rpc("community_activity_timeseries", {
+    series = _rollup_rpc("rollup_community_timeseries", "community_activity_timeseries", {
         "p_community": community_id_or_contract,
         "days_back": days_back
-    }).execute()
-    return {"community_id": community_id_or_contract, "series": (res.data or [])}
+    })
+    return {"community_id": community_id_or_contract, "series": series}
 
 def tool_search_token_communities(token_name_or_contract_address):
     res= token_community_search(token_name_or_contract_address)
     return res
 
+@tool_cache.cached("get_top_users", ttl=120)
 def tool_get_top_users(since_days: int = 7, limit_n: int = 12):
-    res = supabase.rpc("top_users_by_engagement", {
+    rows = _rollup_rpc("rollup_top_users", "top_users_by_engagement", {
         "since_interval": f"{since_days} days",
         "limit_n": limit_n
-    }).execute()
-    rows = res.data or []
+    }, since_days=since_days)
     # force handle formatting
     for r in rows:
         if r.get("handle"):
@@ -402,27 +434,21 @@ def tool_get_user_recent_posts(user_id: str, limit_n: int = 8):
 
     uid = resolve_user_id(user_id)
 
-    res = supabase.rpc("user_recent_posts", {
+    rows = repo.rpc("user_recent_posts", {
         "p_user": uid,
         "limit_n": limit_n
-    }).execute()
-    rows = res.data or []
+    }) or []
     # light cleanup/truncation for prompt budget
     for r in rows:
         txt = r.get("content_text") or ""
         if len(txt) > 400: r["content_text"] = txt[:400] + "…"
 
+    # Reads whatever is stored; the background scheduler keeps it fresh
+    sync_scheduler.request_sync(uid)
     if len(rows) == 0 :
-        logger.warning("user_recent_posts returned 0 rows | user_id=%s", user_id)
-        data = tool_get_user_stats(user_id, include_posts=True)
-
-        res = supabase.rpc("user_recent_posts", {
-            "p_user": uid,
-            "limit_n": limit_n
-        }).execute()
-        rows = res.data or []
+        logger.warning("user_recent_posts returned 0 rows; sync queued | user_id=%s", user_id)
         return rows
-        
+
     logger.info("user_recent_posts | %s", _summarize_rows(rows))
     return rows
 
@@ -443,10 +469,9 @@ def tool_get_conversation_history(limit_n=20, handle=None):
     if handle:
         payload["p_handle"] = handle
 
-    res = supabase.rpc("tool_get_conversation_history", payload).execute()
+    rows = repo.rpc("tool_get_conversation_history", payload)
 
-    if hasattr(res, "data") and res.data:
-        rows = res.data
+    if rows:
         logger.info(
             "conversation_history | handle=%s | %s",
             handle,
@@ -458,6 +483,66 @@ def tool_get_conversation_history(limit_n=20, handle=None):
         return []
 
 
+def tool_semantic_search(query: str, days_back: int = 30, community: str = None, user: str = None,
+                         limit_n: int = 10, hybrid: bool = True):
+    """
+    Meaning-based post search over sa_embeddings (k-NN), optionally re-ranked together with
+    full-text rank (hybrid). Filters: last `days_back` days, community UUID/contract, user handle/UUID.
+    """
+    q = " ".join((query or "").split())
+    if not q:
+        return {"success": False, "error": "empty query"}
+    n = max(1, min(int(limit_n or 10), 25))
+    vec = embed_query(q)
+
+    days = max(1, int(days_back or 30))
+    start = datetime.now(timezone.utc) - timedelta(days=days)
+    community = (community or "").strip() or None
+    user_id = resolve_user_id(user) if user else None
+
+    rows = None
+    # Pure k-NN can be served by the local mirror (community filter only by UUID there). It only
+    # holds the last ANN_MAX_AGE_DAYS, so wider windows - or too few local hits - go to the DB.
+    if not hybrid and days <= ann_index.MAX_AGE_DAYS and (community is None or POST_UUID_RE.fullmatch(community)):
+        try:
+            rows = ann_index.search(vec, n, start_ts=start.timestamp(), user_id=user_id, community_id=community)
+        except Exception:
+            logger.exception("semantic_search | local ann failed; using db")
+        if rows is not None and len(rows) < n:
+            rows = None
+    if rows is None:
+        payload = {
+            "query_embedding": vec,
+            "match_count": n,
+            "p_start": start.isoformat(),
+            "p_end": None,
+            "p_community": community,
+            "p_user": user_id,
+        }
+        if hybrid:
+            payload.update({"p_query": q})
+            rows = repo.rpc("hybrid_search_threads", payload)
+        else:
+            rows = repo.rpc("match_threads", payload)
+        rows = rows or []
+
+    results = []
+    for r in rows:
+        handle = (r.get("handle") or "").lstrip("@")
+        results.append({
+            "id": r.get("thread_id") or r.get("id"),  # local mirror rows carry the embedding id in "id"
+            "display": f"@{handle}" if handle else None,
+            "text": _excerpt(clean_text(r.get("content_text") or ""), 300),
+            "created_at": r.get("created_at"),
+            "likes": r.get("like_count"),
+            "reposts": r.get("repost_count"),
+            "score": round(float(r.get("score") if r.get("score") is not None else r.get("similarity") or 0.0), 4),
+            "url": f"https://arena.social/{handle}/status/{r.get('thread_id') or r.get('id')}" if handle else None,
+        })
+    logger.info("semantic_search | query=%s | hybrid=%s | %s", q, hybrid, _summarize_rows(results, keys=["display", "text", "score"]))
+    return {"success": True, "query": q, "results": results}
+
+
 # ---------- OpenAI tool schema ----------
 
 def tool_top_friends(start_days_offset=0, days_span=7, limit_n=20):
@@ -475,8 +560,7 @@ def tool_top_friends(start_days_offset=0, days_span=7, limit_n=20):
     p_start, p_end = _ist_window(start_days_offset, days_span)
     payload = {"p_start": p_start, "p_end": p_end, "p_limit": n}
 
-    res = supabase.rpc("tool_top_friends", payload).execute()
-    rows = getattr(res, "data", []) or []
+    rows = _rollup_rpc("rollup_top_friends", "tool_top_friends", payload)
 
     logger.info(
         "top_friends | window=%s->%s | %s",
@@ -760,7 +844,48 @@ tools.append({
     }
   }
 })
+tools.append({
+  "type": "function",
+  "function": {
+    "name": "semantic_search",
+    "description": "Search Arena posts by meaning (embeddings), not just exact keywords. Optionally filter by time window, community and user. Hybrid mode blends keyword rank with semantic similarity.",
+    "parameters": {
+      "type": "object",
+      "properties": {
+        "query": {"type": "string", "description": "Natural-language description of what to find."},
+        "days_back": {"type": "integer", "default": 30, "minimum": 1, "maximum": 365},
+        "community": {"type": "string", "description": "Optional community UUID or contract address."},
+        "user": {"type": "string", "description": "Optional user @handle or UUID."},
+        "limit_n": {"type": "integer", "default": 10, "minimum": 1, "maximum": 25},
+        "hybrid": {"type": "boolean", "default": True, "description": "false = pure semantic (fastest)."}
+      },
+      "required": ["query"]
+    }
+  }
+})
+
+tools.append({
+  "type": "function",
+  "function": {
+    "name": "find_same_meme",
+    "description": "Find other Arena posts using the same meme/image (near-duplicate match, survives re-uploads and resizes). Returns matching images with thread ids, captions and meme_template.",
+    "parameters": {
+      "type": "object",
+      "properties": {
+        "url_or_id": {"type": "string", "description": "Image URL, or arena.social post URL / post UUID (uses its first image)."},
+        "max_distance": {"type": "integer", "default": 6, "minimum": 0, "maximum": 12, "description": "Hamming distance; lower = stricter."},
+        "limit": {"type": "integer", "default": 10, "minimum": 1, "maximum": 25}
+      },
+      "required": ["url_or_id"]
+    }
+  }
+})
 def dispatch_tool(name, arguments):
+    with tracing.span(f"tool.{name}"):
+        return _dispatch_tool(name, arguments)
+
+
+def _dispatch_tool(name, arguments):
 
     logger.info("tool call | name=%s", name)
     if VERBOSE_TOOLS:
@@ -796,6 +921,8 @@ def dispatch_tool(name, arguments):
         return search_keywords_timewindow(**arguments)   # or tool_search_keywords_timewindow(**arguments)
     
     if name == "search_web":                 return tool_search_web(**arguments)
+    if name == "find_same_meme":             return find_same_meme(**arguments)
+    if name == "semantic_search":            return tool_semantic_search(**arguments)
     
     
     if name == "generate_image":
@@ -832,13 +959,8 @@ def dispatch_tool(name, arguments):
 
 def format_event_for_prompt(e: dict) -> str:
     # keep this tiny & model-friendly; strip tags for a quick glance
-    from html import unescape
-    import re
-
-    text = e.get("content") or ""
-    text = unescape(text)
-    text_plain = re.sub(r"<[^>]+>", " ", text)
-    text_plain = re.sub(r"\s+", " ", text_plain).strip()
+    # unlike html_to_text's default, entities are decoded before tags are stripped here
+    text_plain = html_to_text(unescape(e.get("content") or ""), unescape=False)
 
     return (
         "EVENT:\n"
@@ -855,6 +977,7 @@ def format_event_for_prompt(e: dict) -> str:
 
 
 
+@tracing.traced("ask")
 def ask(question: str, model="gpt-5", event= None):
     global CURRENT_EVENT
     CURRENT_EVENT = event or {}
@@ -885,14 +1008,14 @@ def ask(question: str, model="gpt-5", event= None):
 
     force_first_tool = bool(event and event.get("answerId"))
     logger.debug("force first tool=%s", force_first_tool)
-    resp = oai.chat.completions.create(
-        model=model,
-        messages=messages,
-        tools=tools,
-        tool_choice=({"type": "function", "function": {"name": "analyze_post"}} if force_first_tool else "auto"),
-       
-       
-    )
+    chat_round = 0
+    with tracing.span("openai.chat", model=model, round=chat_round):
+        resp = oai.chat.completions.create(
+            model=model,
+            messages=messages,
+            tools=tools,
+            tool_choice=({"type": "function", "function": {"name": "analyze_post"}} if force_first_tool else "auto"),
+        )
     logger.debug("openai response received")
 
     while True:
@@ -987,13 +1110,14 @@ def ask(question: str, model="gpt-5", event= None):
             # ---- end chain walker ----
 
             # Now let the model write the reply with full context
-            resp = oai.chat.completions.create(
-                model=model,
-                messages=messages,
-                tools=tools,
-                tool_choice="auto",
-               
-            )
+            chat_round += 1
+            with tracing.span("openai.chat", model=model, round=chat_round):
+                resp = oai.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    tools=tools,
+                    tool_choice="auto",
+                )
             continue
 
         # Final text
@@ -0,0 +1,38 @@
+# textclean.py
+import re
+from html import unescape as _unescape
+from typing import Optional
+
+# Post HTML -> plain text, for every caller. Callers want slightly different text, so those
+# differences are flags rather than separate implementations:
+#   sep        what a tag becomes ("" glues "<p>a</p><p>b</p>" into "ab", as stored content_text)
+#   unescape   decode entities (&amp; &#39; &nbsp; ...) after tags are gone
+#   drop_urls  remove http(s) links
+#   collapse   squeeze whitespace runs to one space (otherwise only the ends are trimmed)
+# Patterns are compiled once, and each pass is skipped when its trigger character is absent.
+# A tag must start with a letter, "/" or "!", so a stray "<" ("I <3 you", "1 < 2") stays text,
+# and <script>/<style> bodies are dropped, as BeautifulSoup's get_text does.
+# benchmarks/bench_textclean.py checks output parity with the old per-module cleaners.
+
+TAG_RE = re.compile(r"<[A-Za-z/!][^>]*>")
+SCRIPT_RE = re.compile(r"<(script|style)\b[^>]*>.*?</\1\s*>", re.I | re.S)
+URL_RE = re.compile(r"https?://\S+")
+
+
+def html_to_text(html: Optional[str], *, sep: str = " ", unescape: bool = True,
+                 drop_urls: bool = False, collapse: bool = True) -> str:
+    if not html:
+        return ""
+    s = html
+    if "<" in s:
+        if "</script" in s or "</style" in s:
+            s = SCRIPT_RE.sub(sep, s)
+        s = TAG_RE.sub(sep, s)
+    if unescape and "&" in s:
+        s = _unescape(s)
+    if drop_urls and "://" in s:
+        s = URL_RE.sub("", s)
+    if collapse:
+        # same result as re.sub(r"\s+", " ", s).strip(): str.split() and \s agree on whitespace
+        return " ".join(s.split())
+    return s.strip()
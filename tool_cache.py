@@ -0,0 +1,191 @@
+# tool_cache.py
+import os
+import json
+import time
+import inspect
+import threading
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+import metrics
+from ratelimit import parse_limits
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+# In-process result cache for tools whose answer is the same for every caller in a window
+# (leaderboards, trending feed). Per key (tool name + normalized arguments):
+#   age < ttl            -> served from cache
+#   ttl <= age < ttl+stale -> served stale, one background refresh kicked off
+#   older / missing      -> loaded inline (concurrent callers wait on the same load)
+# A refresher thread also reloads entries that were read recently before they go stale,
+# so hot leaderboard entries stay warm.
+
+# -------------------------
+# Config
+# -------------------------
+ENABLED          = os.getenv("TOOL_CACHE", "1").lower() not in ("0", "false", "no")
+DEFAULT_TTL      = int(os.getenv("TOOL_CACHE_TTL", "60"))
+DEFAULT_STALE    = int(os.getenv("TOOL_CACHE_STALE", "300"))
+TTLS             = parse_limits(os.getenv("TOOL_CACHE_TTLS", ""))    # "get_trending_feed=30,get_top_users=300"
+MAX_ENTRIES      = int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "256"))
+REFRESH_SECONDS  = int(os.getenv("TOOL_CACHE_REFRESH_SECONDS", "10"))
+HOT_SECONDS      = int(os.getenv("TOOL_CACHE_HOT_SECONDS", "600"))   # read within this -> kept warm
+_REFRESH_AHEAD = 0.8  # refresh hot entries once they reach this fraction of their ttl
+
+
+class _Entry:
+    __slots__ = ("value", "error", "loaded_at", "read_at", "ttl", "stale", "loader", "loading")
+
+    def __init__(self, ttl: int, stale: int, loader: Callable[[], Any]):
+        self.value = None
+        self.error: Optional[BaseException] = None
+        self.loaded_at = 0.0
+        self.read_at = 0.0
+        self.ttl = ttl
+        self.stale = stale
+        self.loader = loader
+        self.loading: Optional[threading.Event] = None
+
+
+_entries: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+_lock = threading.Lock()
+_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="tool-cache")
+_started = False
+
+
+def _cacheable(value: Any) -> bool:
+    # API wrappers return {"error": ...} instead of raising; never pin those
+    return not (isinstance(value, dict) and value.get("error"))
+
+
+def _load(key: Tuple[str, str], entry: _Entry) -> None:
+    """Run the loader for `entry` (caller has set entry.loading) and publish the result."""
+    t0 = time.perf_counter()
+    error = None
+    try:
+        value = entry.loader()
+        ok = _cacheable(value)
+    except Exception as e:
+        logger.exception("tool cache load failed | tool=%s", key[0])
+        value, ok, error = None, False, e
+    metrics.observe(f"tool_cache.load.{key[0]}", time.perf_counter() - t0)
+    with _lock:
+        if ok:
+            entry.value = value
+            entry.loaded_at = time.time()
+        else:
+            metrics.incr("tool_cache.load_failed")
+            if not entry.loaded_at:
+                # first load: hand the result/error to the waiting callers, but don't keep it
+                entry.value, entry.error = value, error
+        done, entry.loading = entry.loading, None
+        if not ok and not entry.loaded_at:
+            _entries.pop(key, None)
+    done.set()
+
+
+def _refresher() -> None:
+    while True:
+        time.sleep(REFRESH_SECONDS)
+        now = time.time()
+        due = []
+        with _lock:
+            for key, e in _entries.items():
+                if e.loading is None and now - e.read_at < HOT_SECONDS \
+                        and now - e.loaded_at >= e.ttl * _REFRESH_AHEAD:
+                    e.loading = threading.Event()
+                    due.append((key, e))
+        for key, e in due:
+            metrics.incr("tool_cache.refresh_ahead")
+            _pool.submit(_load, key, e)
+
+
+def _start() -> None:
+    global _started
+    with _lock:
+        if _started:
+            return
+        threading.Thread(target=_refresher, name="tool-cache-refresher", daemon=True).start()
+        _started = True
+
+
+def get(name: str, args_key: str, loader: Callable[[], Any], ttl: Optional[int] = None,
+        stale: Optional[int] = None) -> Any:
+    """Cached value of loader() for (name, args_key)."""
+    _start()
+    ttl = TTLS.get(name, DEFAULT_TTL if ttl is None else ttl)
+    stale = DEFAULT_STALE if stale is None else stale
+    key = (name, args_key)
+    now = time.time()
+    with _lock:
+        e = _entries.get(key)
+        if e is None:
+            e = _entries[key] = _Entry(ttl, stale, loader)
+            while len(_entries) > MAX_ENTRIES:
+                _entries.popitem(last=False)
+        _entries.move_to_end(key)
+        e.read_at = now
+        e.loader = loader
+        age = now - e.loaded_at
+        if e.loaded_at and age < e.ttl:
+            metrics.incr(f"tool_cache.hit.{name}")
+            return e.value
+        if e.loaded_at and age < e.ttl + e.stale:
+            metrics.incr(f"tool_cache.stale.{name}")
+            if e.loading is None:
+                e.loading = threading.Event()
+                _pool.submit(_load, key, e)
+            return e.value
+        metrics.incr(f"tool_cache.miss.{name}")
+        if e.loading is None:
+            e.loading = threading.Event()
+            owner = True
+        else:
+            owner = False
+        waiter = e.loading
+    if owner:
+        _load(key, e)
+    else:
+        waiter.wait()
+    if e.error is not None and not e.loaded_at:
+        raise e.error
+    return e.value
+
+
+def cached(name: str, ttl: Optional[int] = None, stale: Optional[int] = None):
+    """Decorator: cache a tool function by `name` + its arguments (defaults applied, so
+    f(7) and f(since_days=7) share an entry). Disabled with TOOL_CACHE=0."""
+    def deco(fn):
+        sig = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            args_key = json.dumps(bound.arguments, sort_keys=True, default=str)
+            return get(name, args_key, lambda: fn(*args, **kwargs), ttl, stale)
+
+        wrapper.uncached = fn
+        return wrapper
+    return deco
+
+
+def invalidate(name: Optional[str] = None) -> None:
+    """Drop cached entries (all, or one tool's)."""
+    with _lock:
+        for key in [k for k in _entries if name is None or k[0] == name]:
+            del _entries[key]
+
+
+def stats() -> Dict[str, Any]:
+    now = time.time()
+    with _lock:
+        return {
+            "entries": len(_entries),
+            "hot": sum(1 for e in _entries.values() if now - e.read_at < HOT_SECONDS),
+            "by_tool": {n: sum(1 for k in _entries if k[0] == n) for n in {k[0] for k in _entries}},
+        }
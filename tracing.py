@@ -0,0 +1,394 @@
+# tracing.py
+import os
+import sys
+import json
+import time
+import atexit
+import random
+import argparse
+import functools
+import threading
+from collections import defaultdict, deque
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Union
+from dotenv import load_dotenv
+import metrics
+from logging_utils import get_logger
+
+load_dotenv()
+logger = get_logger(__name__)
+
+# Spans with parent/child ids around pipeline stages and external calls, so a slow reply can
+# be pinned on getNested vs OpenAI vs a tool RPC vs replyToPost. Off by default.
+#   with tracing.span("openai.chat", round=2): ...      # block
+#   @tracing.traced("arena.reply")                      # whole function
+#   tracing.annotate(post_id=...)                       # attrs on the current span
+# The current span lives in a ContextVar. Threads don't inherit it: use bind(fn) for pool
+# submissions, or pass current_context() along (image jobs) and open the span with parent=.
+#
+# Disabled (TRACE_EXPORT unset), span() returns a shared no-op and traced() returns the function
+# unchanged, so instrumented code pays one global check per block and nothing per decorated call.
+# Enabled, finished spans are buffered and a background thread exports them in batches.
+#
+#   python tracing.py                        # flame-style breakdown of the last 5 mentions
+#   python tracing.py --root poll --last 20  # other roots: poll, ingest, image.job, ...
+#   python tracing.py --trace <trace_id>
+
+# -------------------------
+# Config
+# -------------------------
+EXPORTERS      = {e.strip() for e in os.getenv("TRACE_EXPORT", "").lower().split(",") if e.strip()}  # jsonl,otlp
+ENABLED        = bool(EXPORTERS)
+TRACE_FILE     = os.getenv("TRACE_FILE", "./traces/spans.jsonl")
+OTLP_ENDPOINT  = os.getenv("TRACE_OTLP_ENDPOINT", os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"))
+SERVICE_NAME   = os.getenv("TRACE_SERVICE_NAME", "gladius")
+BUFFER_MAX     = int(os.getenv("TRACE_BUFFER_MAX", "10000"))
+BATCH_SIZE     = int(os.getenv("TRACE_BATCH", "512"))
+FLUSH_SECONDS  = float(os.getenv("TRACE_FLUSH_SECONDS", "2"))
+
+
+class SpanContext(NamedTuple):
+    trace_id: str
+    span_id: str
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attrs", "error", "_token")
+
+    def __init__(self, name: str, parent: Optional[SpanContext], attrs: Dict[str, Any]):
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.attrs = attrs
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.error: Optional[str] = None
+        self._token = None
+
+    @property
+    def context(self) -> SpanContext:
+        return SpanContext(self.trace_id, self.span_id)
+
+    def set(self, **attrs: Any) -> "Span":
+        self.attrs.update(attrs)
+        return self
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.end_ns = time.time_ns()
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"[:500]
+        _current.reset(self._token)
+        _finish(self)
+        return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attrs": self.attrs,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    __slots__ = ()
+    context = None
+
+    def set(self, **attrs: Any) -> "_NoopSpan":
+        return self
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+_NOOP = _NoopSpan()
+_current: ContextVar[Optional[Span]] = ContextVar("trace_span", default=None)
+
+_buf: "deque[Span]" = deque()
+_lock = threading.Lock()
+_write_lock = threading.Lock()
+_wake = threading.Event()
+_started = False
+
+
+# -------------------------
+# Public API
+# -------------------------
+def span(name: str, parent: Optional[SpanContext] = None, **attrs: Any) -> Union[Span, _NoopSpan]:
+    """Context manager for one span; child of `parent` if given, else of the current span."""
+    if not ENABLED:
+        return _NOOP
+    if parent is None:
+        cur = _current.get()
+        parent = cur.context if cur is not None else None
+    return Span(name, parent, attrs)
+
+
+def traced(name: str) -> Callable[[Callable], Callable]:
+    """Decorator form of span(); a no-op (returns fn itself) when tracing is off."""
+    def deco(fn):
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+def annotate(**attrs: Any) -> None:
+    """Add attributes to the current span (if any)."""
+    if ENABLED:
+        cur = _current.get()
+        if cur is not None:
+            cur.attrs.update(attrs)
+
+
+def current_context() -> Optional[SpanContext]:
+    """Ids of the current span, to hand to work that runs on another thread later."""
+    if not ENABLED:
+        return None
+    cur = _current.get()
+    return cur.context if cur is not None else None
+
+
+def bind(fn: Callable) -> Callable:
+    """fn, running under the caller's current span wherever it is called (thread pools)."""
+    if not ENABLED:
+        return fn
+    parent = _current.get()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        token = _current.set(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return run
+
+
+# -------------------------
+# Export
+# -------------------------
+def _finish(s: Span) -> None:
+    start()
+    with _lock:
+        if len(_buf) >= BUFFER_MAX:
+            _buf.popleft()
+            metrics.incr("trace.dropped")
+        _buf.append(s)
+        depth = len(_buf)
+    if depth >= BATCH_SIZE:
+        _wake.set()
+
+
+def _write_jsonl(batch: List[Span]) -> None:
+    d = os.path.dirname(TRACE_FILE)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    lines = "".join(json.dumps(s.to_dict(), default=str) + "\n" for s in batch)
+    with open(TRACE_FILE, "a", encoding="utf-8") as f:
+        f.write(lines)
+
+
+def _otlp_value(v: Any) -> Dict[str, Any]:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": v if isinstance(v, str) else json.dumps(v, default=str)}
+
+
+def _otlp_payload(batch: List[Span]) -> Dict[str, Any]:
+    spans = []
+    for s in batch:
+        o = {
+            "traceId": s.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "kind": 1,  # INTERNAL
+            "startTimeUnixNano": str(s.start_ns),
+            "endTimeUnixNano": str(s.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attrs.items() if v is not None],
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+        }
+        if s.parent_id:
+            o["parentSpanId"] = s.parent_id
+        spans.append(o)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "tracing"}, "spans": spans}],
+    }]}
+
+
+def _write_otlp(batch: List[Span]) -> None:
+    import requests
+    r = requests.post(f"{OTLP_ENDPOINT.rstrip('/')}/v1/traces", json=_otlp_payload(batch), timeout=10)
+    r.raise_for_status()
+
+
+def flush() -> int:
+    """Export everything buffered now. Returns spans exported."""
+    with _write_lock:
+        with _lock:
+            batch = list(_buf)
+            _buf.clear()
+        if not batch:
+            return 0
+        for i in range(0, len(batch), BATCH_SIZE):
+            chunk = batch[i:i + BATCH_SIZE]
+            for name, write in (("jsonl", _write_jsonl), ("otlp", _write_otlp)):
+                if name not in EXPORTERS:
+                    continue
+                try:
+                    write(chunk)
+                    metrics.incr(f"trace.exported.{name}", len(chunk))
+                except Exception:
+                    metrics.incr(f"trace.export_failed.{name}", len(chunk))
+                    logger.exception("trace export failed | exporter=%s | spans=%s", name, len(chunk))
+        return len(batch)
+
+
+def _exporter() -> None:
+    while True:
+        _wake.wait(FLUSH_SECONDS)
+        _wake.clear()
+        try:
+            flush()
+        except Exception:
+            logger.exception("trace exporter error")
+
+
+def start() -> None:
+    global _started
+    if _started:
+        return
+    with _lock:
+        if _started:
+            return
+        threading.Thread(target=_exporter, name="trace-exporter", daemon=True).start()
+        atexit.register(flush)
+        _started = True
+        logger.info("tracing on | export=%s | file=%s", ",".join(sorted(EXPORTERS)), TRACE_FILE)
+
+
+# -------------------------
+# CLI: flame-style breakdown
+# -------------------------
+_BAR_WIDTH = 40
+
+
+def load(path: str) -> Dict[str, List[Dict[str, Any]]]:
+    """trace_id -> spans, from a JSONL export."""
+    traces: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                s = json.loads(line)
+                traces[s["trace_id"]].append(s)
+            except (ValueError, KeyError):
+                continue
+    return traces
+
+
+def _self_ms(s: Dict[str, Any], children: Dict[Optional[str], List[Dict[str, Any]]]) -> float:
+    return max(0.0, s["duration_ms"] - sum(c["duration_ms"] for c in children.get(s["span_id"], ())))
+
+
+def render(spans: List[Dict[str, Any]], out=sys.stdout) -> None:
+    """Tree of one trace; each bar is the span's position on the trace's timeline."""
+    ids = {s["span_id"] for s in spans}
+    children: Dict[Optional[str], List[Dict[str, Any]]] = defaultdict(list)
+    for s in sorted(spans, key=lambda s: s["start_ns"]):
+        children[s["parent_id"] if s["parent_id"] in ids else None].append(s)
+    t0 = min(s["start_ns"] for s in spans)
+    t1 = max(s["start_ns"] + s["duration_ms"] * 1e6 for s in spans)
+    scale = _BAR_WIDTH / max(t1 - t0, 1.0)
+    width = max(len(s["name"]) for s in spans) + 2 * 6
+
+    def walk(s, prefix, last, depth):
+        branch = "" if depth == 0 else ("└─ " if last else "├─ ")
+        a = int((s["start_ns"] - t0) * scale)
+        b = max(a + 1, int((s["start_ns"] + s["duration_ms"] * 1e6 - t0) * scale))
+        bar = " " * a + "█" * (b - a)
+        label = (prefix + branch + s["name"])[:width]
+        extra = " ".join(f"{k}={v}" for k, v in (s.get("attrs") or {}).items() if v is not None)
+        err = f"  ERROR {s['error']}" if s.get("error") else ""
+        out.write(f"{label:<{width}} {s['duration_ms']:>9.1f}ms  |{bar:<{_BAR_WIDTH}}|  {extra[:80]}{err}\n")
+        kids = children.get(s["span_id"], [])
+        for i, c in enumerate(kids):
+            walk(c, prefix + ("" if depth == 0 else ("   " if last else "│  ")), i == len(kids) - 1, depth + 1)
+
+    for root in children[None]:
+        walk(root, "", True, 0)
+
+
+def breakdown(traces: List[List[Dict[str, Any]]], out=sys.stdout) -> None:
+    """Self time by span name over the given traces (where the time actually went)."""
+    agg: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0, 0.0])  # count, total_ms, self_ms
+    total_self = 0.0
+    for spans in traces:
+        children: Dict[Optional[str], List[Dict[str, Any]]] = defaultdict(list)
+        for s in spans:
+            children[s["parent_id"]].append(s)
+        for s in spans:
+            a = agg[s["name"]]
+            own = _self_ms(s, children)
+            a[0] += 1
+            a[1] += s["duration_ms"]
+            a[2] += own
+            total_self += own
+    out.write(f"\n{'span':<36} {'count':>6} {'total ms':>11} {'self ms':>11} {'self %':>7}\n")
+    for name, (n, tot, own) in sorted(agg.items(), key=lambda kv: -kv[1][2]):
+        out.write(f"{name:<36} {n:>6} {tot:>11.1f} {own:>11.1f} {100 * own / max(total_self, 1e-9):>6.1f}%\n")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Per-trace breakdown of a tracing JSONL export.")
+    ap.add_argument("file", nargs="?", default=TRACE_FILE)
+    ap.add_argument("--root", default="mention", help="show traces whose root span has this name")
+    ap.add_argument("--trace", help="one trace id (overrides --root/--last)")
+    ap.add_argument("--last", type=int, default=5, help="most recent N matching traces")
+    ap.add_argument("--min-ms", type=float, default=0.0, help="only traces at least this long")
+    args = ap.parse_args()
+
+    traces = load(args.file)
+    if args.trace:
+        picked = [traces[args.trace]] if args.trace in traces else []
+    else:
+        picked = []
+        for spans in traces.values():
+            ids = {s["span_id"] for s in spans}
+            roots = [s for s in spans if s["parent_id"] not in ids]
+            if any(r["name"] == args.root and r["duration_ms"] >= args.min_ms for r in roots):
+                picked.append(spans)
+        picked.sort(key=lambda spans: min(s["start_ns"] for s in spans))
+        picked = picked[-args.last:] if args.last > 0 else picked
+    if not picked:
+        print(f"no matching traces in {args.file}")
+        return
+    for spans in picked:
+        print(f"\ntrace {spans[0]['trace_id']}  ({len(spans)} spans)")
+        render(spans)
+    breakdown(picked)
+
+
+if __name__ == "__main__":
+    main()
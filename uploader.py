@@ -0,0 +1,191 @@
+# uploader.py
+import os
+import time
+import json
+import base64
+import threading
+import urllib.parse
+import requests
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional
+from dotenv import load_dotenv
+import metrics
+import tracing
+from logging_utils import get_logger
+
+load_dotenv()
+logger = get_logger(__name__)
+
+JWT = os.getenv("JWT")
+
+API_BASE    = os.getenv("ARENA_API_BASE", "https://api.starsarena.com").rstrip("/")
+UPLOAD_URL  = os.getenv("ARENA_UPLOAD_URL", "https://storage.googleapis.com/starsarena-s3-01/")
+STATIC_BASE = os.getenv("ARENA_STATIC_BASE", "https://static.starsarena.com").rstrip("/")
+
+UPLOAD_RETRIES     = int(os.getenv("UPLOAD_RETRIES", "3"))
+UPLOAD_TIMEOUT     = float(os.getenv("UPLOAD_TIMEOUT", "30"))
+POLICY_TTL         = float(os.getenv("UPLOAD_POLICY_TTL", "600"))      # used when the policy has no expiration
+POLICY_MARGIN      = float(os.getenv("UPLOAD_POLICY_MARGIN", "30"))    # don't start an upload this close to expiry
+PREFETCH_PER_TYPE  = int(os.getenv("UPLOAD_POLICY_PREFETCH", "0"))     # 0 disables the prefetch pool
+PREFETCH_TYPES     = [t.strip() for t in os.getenv("UPLOAD_POLICY_PREFETCH_TYPES", "image/png").split(",") if t.strip()]
+
+_UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:133.0) Gecko/20100101 Firefox/133.0"
+
+# Pooled keep-alive sessions: one for the Arena API, one for the storage host
+_api = requests.Session()
+_api.headers.update({
+    "Authorization": f"Bearer {JWT}",
+    "User-Agent": _UA,
+    "Referrer": "https://arena.social",
+    "Content-Type": "application/json",
+})
+_storage = requests.Session()
+_storage.headers.update({"User-Agent": _UA, "Referrer": "https://arena.social"})
+_storage.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=8))
+
+_pool: Dict[str, deque] = defaultdict(deque)   # file_type -> deque[(policy, expires_at)]
+_pool_lock = threading.Lock()
+_prefetch_started = False
+
+
+class _Retryable(Exception):
+    pass
+
+
+def _policy_expiry(policy: Dict[str, Any], fetched_at: float) -> float:
+    """Read `expiration` from the base64 policy document when present; else assume POLICY_TTL."""
+    try:
+        doc = json.loads(base64.b64decode(policy["policy"]))
+        exp = datetime.fromisoformat(doc["expiration"].replace("Z", "+00:00"))
+        return exp.astimezone(timezone.utc).timestamp()
+    except Exception:
+        return fetched_at + POLICY_TTL
+
+
+@tracing.traced("arena.upload_policy")
+def _fetch_policy(file_type: str, file_name: str):
+    """Returns (policy, expires_at) or raises (_Retryable for connection errors, timeouts, 5xx/408/429)."""
+    url = (
+        f"{API_BASE}/uploads/getUploadPolicy"
+        f"?fileType={urllib.parse.quote(file_type, safe='')}&fileName={urllib.parse.quote(file_name, safe='')}"
+    )
+    t0 = time.perf_counter()
+    try:
+        r = _api.get(url, timeout=15)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise _Retryable(f"upload policy: {e}")
+    metrics.observe("upload.policy_fetch", time.perf_counter() - t0)
+    if r.status_code >= 500 or r.status_code in (408, 429):
+        raise _Retryable(f"upload policy {r.status_code}")
+    if r.status_code != 200:
+        raise RuntimeError(f"Failed to fetch upload policy: {r.status_code}")
+    policy = r.json()["uploadPolicy"]
+    return policy, _policy_expiry(policy, time.time())
+
+
+def _take_policy(file_type: str, file_name: str):
+    now = time.time()
+    with _pool_lock:
+        q = _pool.get(file_type)
+        while q:
+            policy, expires_at = q.popleft()
+            if expires_at - now > POLICY_MARGIN:
+                metrics.incr("upload.policy_pool_hit")
+                return policy, expires_at
+    if PREFETCH_PER_TYPE > 0:
+        metrics.incr("upload.policy_pool_miss")
+    return _fetch_policy(file_type, file_name)
+
+
+@tracing.traced("storage.post")
+def _post(policy: Dict[str, Any], data: bytes, file_name: str, file_type: str) -> str:
+    form = dict(policy)
+    form["Content-Type"] = file_type
+    form.pop("enctype", None)
+    form.pop("url", None)
+    try:
+        r = _storage.post(
+            UPLOAD_URL,
+            files={"file": (file_name, data, file_type)},
+            data=form,
+            timeout=(5, UPLOAD_TIMEOUT),
+        )
+    except (requests.ConnectionError, requests.Timeout) as e:
+        raise _Retryable(str(e))
+    if r.status_code == 204:
+        return f"{STATIC_BASE}/{policy['key']}"
+    if r.status_code >= 500 or r.status_code in (408, 429):
+        raise _Retryable(f"storage {r.status_code}")
+    raise RuntimeError(f"Failed to upload image: {r.status_code} {r.text[:300]}")
+
+
+@tracing.traced("upload")
+def upload_bytes(data: bytes, file_name: str, file_type: str = "image/png") -> Dict[str, Any]:
+    """
+    Upload bytes to Arena storage. Transient failures are retried with the same policy
+    until it expires (then a fresh one is fetched). Returns
+    {"success": bool, "url": str|None, "error": str|None, "seconds": float}.
+    """
+    t0 = time.perf_counter()
+    err = None
+    policy = expires_at = None
+    for attempt in range(1, UPLOAD_RETRIES + 1):
+        try:
+            if policy is None or expires_at - time.time() <= POLICY_MARGIN:
+                policy, expires_at = _take_policy(file_type, file_name)
+            url = _post(policy, data, file_name, file_type)
+            secs = time.perf_counter() - t0
+            metrics.observe("upload.seconds", secs)
+            logger.info("upload ok | bytes=%s | attempts=%s | seconds=%.2f", len(data), attempt, secs)
+            return {"success": True, "url": url, "error": None, "seconds": secs}
+        except _Retryable as e:
+            err = str(e)
+            logger.warning("upload transient failure | attempt=%s | error=%s", attempt, err)
+            if attempt < UPLOAD_RETRIES:  # no backoff after the last try; just report the failure
+                metrics.incr("upload.retry")
+                time.sleep(min(0.5 * (2 ** (attempt - 1)), 4.0))
+        except Exception as e:
+            err = str(e)
+            break
+
+    secs = time.perf_counter() - t0
+    metrics.observe("upload.seconds", secs)
+    metrics.incr("upload.failed")
+    logger.error("upload failed | bytes=%s | seconds=%.2f | error=%s", len(data), secs, err)
+    return {"success": False, "url": None, "error": err, "seconds": secs}
+
+
+# -------------------------
+# Policy prefetch pool
+# -------------------------
+def _prefetch_loop():
+    while True:
+        try:
+            now = time.time()
+            for file_type in PREFETCH_TYPES:
+                with _pool_lock:
+                    q = _pool[file_type]
+                    while q and q[0][1] - now <= POLICY_MARGIN:
+                        q.popleft()  # expired
+                    missing = PREFETCH_PER_TYPE - len(q)
+                ext = file_type.split("/")[-1]
+                for _ in range(max(0, missing)):
+                    item = _fetch_policy(file_type, f"gladius_{os.urandom(6).hex()}.{ext}")
+                    with _pool_lock:
+                        _pool[file_type].append(item)
+        except Exception:
+            logger.exception("upload policy prefetch failed")
+        time.sleep(max(5.0, POLICY_MARGIN / 2))
+
+
+def start_prefetch():
+    """Keep UPLOAD_POLICY_PREFETCH ready policies per type so uploads skip the policy round trip."""
+    global _prefetch_started
+    if PREFETCH_PER_TYPE <= 0:
+        return
+    with _pool_lock:
+        if _prefetch_started:
+            return
+        _prefetch_started = True
+    threading.Thread(target=_prefetch_loop, name="upload-policy-prefetch", daemon=True).start()
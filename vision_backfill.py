@@ -0,0 +1,133 @@
+# vision_backfill.py
+import os
+import json
+import time
+from datetime import datetime, timezone
+from db import repo
+from ingest import oai
+from function import analyze_and_persist_images
+from ratelimit import TokenBucket
+import metrics
+from logging_utils import get_logger
+
+logger = get_logger(__name__)
+
+# Offline worker: analyzes images ahead of time (popular + recent first) so
+# tool_analyze_post usually finds analysis already stored.
+POLL_SECONDS     = int(os.getenv("VISION_BACKFILL_POLL_SECONDS", "30"))
+BATCH_SIZE       = int(os.getenv("VISION_BACKFILL_BATCH", "16"))
+MAX_AGE_DAYS     = int(os.getenv("VISION_BACKFILL_MAX_AGE_DAYS", "30"))
+RPM              = float(os.getenv("VISION_BACKFILL_RPM", "60"))
+DAILY_BUDGET_USD = float(os.getenv("VISION_BACKFILL_DAILY_USD", "2.0"))
+COST_PER_IMAGE   = float(os.getenv("VISION_COST_PER_IMAGE_USD", "0.003"))  # rough gpt-4o-mini estimate
+MAX_FAILURES     = int(os.getenv("VISION_BACKFILL_MAX_FAILURES", "3"))
+MODEL            = os.getenv("VISION_BACKFILL_MODEL", "gpt-4o-mini")
+STATE_PATH       = os.getenv("VISION_BACKFILL_STATE", "./vision_backfill_state.json")
+
+_rate = TokenBucket.per_minute(RPM, burst=max(1.0, min(BATCH_SIZE, RPM)))
+
+
+# -------------------------
+# Resumable state (spend per UTC day). Failing images are tracked in sa_images (migrations/007).
+# -------------------------
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+def load_state():
+    try:
+        with open(STATE_PATH, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        state = {}
+    state.pop("failures", None)  # pre-007 state files kept per-image failure counts here
+    if state.get("day") != _today():
+        state["day"] = _today()
+        state["spent_usd"] = 0.0
+    state.setdefault("spent_usd", 0.0)
+    return state
+
+def save_state(state):
+    tmp = STATE_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, STATE_PATH)
+
+
+def fetch_pending(limit):
+    return repo.rpc("images_pending_analysis", {
+        "p_limit": limit,
+        "p_max_age_days": MAX_AGE_DAYS,
+        "p_max_failures": MAX_FAILURES,
+    }) or []
+
+
+def record_failures(image_ids):
+    """Count a failed attempt for each id; the RPC backs them off and eventually stops returning them."""
+    if image_ids:
+        repo.rpc("record_image_analysis_failures", {"p_ids": list(image_ids)})
+
+
+def run_once(state=None):
+    """Analyze one prioritized batch. Returns number of images analyzed (incl. dedupe reuse)."""
+    state = state or load_state()
+    if state.get("day") != _today():
+        state.update({"day": _today(), "spent_usd": 0.0})
+
+    remaining_usd = DAILY_BUDGET_USD - state["spent_usd"]
+    if remaining_usd < COST_PER_IMAGE:
+        logger.info("vision backfill | daily budget spent | spent=%.3f", state["spent_usd"])
+        return 0
+
+    batch = []
+    for r in fetch_pending(BATCH_SIZE):
+        if (len(batch) + 1) * COST_PER_IMAGE > remaining_usd:
+            break
+        _rate.acquire()
+        batch.append(r)
+    if not batch:
+        logger.info("vision backfill | nothing pending")
+        return 0
+
+    t0 = time.perf_counter()
+    out = analyze_and_persist_images(oai, batch, model=MODEL)
+    secs = time.perf_counter() - t0
+
+    done = {o["image_id"] for o in out}
+    paid = sum(1 for o in out if not (o["analysis"].get("meta") or {}).get("dedup"))
+    record_failures([r["id"] for r in batch if r["id"] not in done])
+    state["spent_usd"] = round(state["spent_usd"] + paid * COST_PER_IMAGE, 6)
+    save_state(state)
+
+    metrics.incr("vision_backfill.analyzed", len(out))
+    metrics.incr("vision_backfill.paid", paid)
+    metrics.observe("vision_backfill.batch", secs)
+    logger.info(
+        "vision backfill | batch=%s | analyzed=%s | paid=%s | failed=%s | spent_today=%.3f | seconds=%.2f | top_priority=%.3f",
+        len(batch),
+        len(out),
+        paid,
+        len(batch) - len(done),
+        state["spent_usd"],
+        secs,
+        batch[0].get("priority") or 0.0,
+    )
+    return len(out)
+
+
+def main():
+    state = load_state()
+    backoff = POLL_SECONDS
+    while True:
+        try:
+            n = run_once(state)
+            backoff = POLL_SECONDS
+            if n:
+                continue  # keep draining while there is work and budget
+        except Exception:
+            logger.exception("vision backfill error")
+            backoff = min(max(backoff * 2, POLL_SECONDS), 600)
+        time.sleep(backoff)
+
+
+if __name__ == "__main__":
+    main()